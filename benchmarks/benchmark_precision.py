@@ -0,0 +1,80 @@
+"""
+Benchmarks the reduced precision variants of the models against fp32.
+
+Usage:
+    python benchmarks/benchmark_precision.py ~/.hsf/models/bagging/accurate/ \
+        crop1.nii.gz crop2.nii.gz --repeats 3
+
+For each model and variant, the best latency of a forward pass and the
+per-class Dice with the fp32 hard predictions are reported. The first crop
+is also used to calibrate the int8_static variants if they are missing.
+"""
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+from omegaconf import OmegaConf
+
+from hsf.engines import InferenceEngine
+from hsf.quantization import (PRECISIONS, build_variant, get_model_variant,
+                              load_crops, variant_path)
+
+
+def dice(a, b, label):
+    a, b = a == label, b == label
+    total = a.sum() + b.sum()
+    return 2 * np.logical_and(a, b).sum() / total if total else 1.
+
+
+def run(model, crops, repeats):
+    engine = InferenceEngine(model=model,
+                             engine_name="onnxruntime",
+                             engine_settings=OmegaConf.create({
+                                 "execution_providers": ["CPUExecutionProvider"],
+                                 "batch_size": 1
+                             }))
+    timings, predictions = [], []
+    for crop in crops:
+        x = crop[None].astype(np.float32)
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            prediction = engine(x)[0]
+            best = min(best, time.perf_counter() - start)
+        timings.append(best)
+        predictions.append(prediction[0].argmax(axis=0))
+    return float(np.mean(timings)), predictions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("models_path", type=Path)
+    parser.add_argument("crops", nargs="+", type=Path)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    crops = load_crops(args.crops)
+    for model in sorted(args.models_path.expanduser().glob("*.onnx")):
+        if not variant_path(model, "int8_static").exists():
+            build_variant(model, "int8_static", crops=crops[:1])
+
+        reference, labels = run(model, crops, args.repeats)
+        n_classes = int(max(label.max() for label in labels)) + 1
+        print(f"{model.name}: fp32 {1000 * reference:.1f}ms")
+
+        for precision in PRECISIONS[1:]:
+            latency, predictions = run(get_model_variant(model, precision),
+                                       crops, args.repeats)
+            scores = np.mean([[
+                dice(prediction, label, c) for c in range(1, n_classes)
+            ] for prediction, label in zip(predictions, labels)],
+                             axis=0)
+            print(f"  {precision}: {1000 * latency:.1f}ms "
+                  f"(x{reference / latency:.2f}), Dice vs fp32: "
+                  f"mean {scores.mean():.4f}, "
+                  f"per class {np.round(scores, 4).tolist()}")
+
+
+if __name__ == "__main__":
+    main()
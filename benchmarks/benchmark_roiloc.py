@@ -0,0 +1,92 @@
+"""
+Benchmarks the localization of the hippocampi at reduced registration
+resolutions against the full resolution registration.
+
+Usage:
+    python benchmarks/benchmark_roiloc.py tse1.nii.gz tse2.nii.gz \
+        --resolutions 1 1.5 2 3 --seeds 1 2 3
+
+For each MRI, seed and resolution, the registration time and the largest
+difference between the bounding boxes and those of the full resolution
+registration with the same seed are reported, in voxels and in mm. The
+spread of the full resolution boxes across seeds is the reference: it is
+how much ROILoc already varies from one run to another.
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import ants
+import numpy as np
+from omegaconf import OmegaConf
+
+from hsf.roiloc_wrapper import fit_locator, make_locator
+
+
+def locate(image, roiloc_cfg, resolution, seed):
+    locator = make_locator(roiloc_cfg)
+    with tempfile.TemporaryDirectory() as outprefix:
+        start = time.perf_counter()
+        fit_locator(locator,
+                    image,
+                    outprefix + "/",
+                    resolution=resolution,
+                    random_seed=seed)
+        elapsed = time.perf_counter() - start
+    return elapsed, np.array([locator.coords[side] for side in ("right", "left")])
+
+
+def deviation(coords, reference, spacing):
+    voxels = np.abs(coords - reference).reshape(-1, 3)
+    return int(voxels.max()), float((voxels * spacing).max())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("mris", nargs="+", type=Path)
+    parser.add_argument("--roiloc",
+                        type=Path,
+                        default=Path(__file__).parents[1] / "hsf" / "conf" /
+                        "roiloc" / "default_corot2.yaml")
+    parser.add_argument("--resolutions",
+                        nargs="+",
+                        type=float,
+                        default=[1., 1.5, 2., 3.])
+    parser.add_argument("--seeds", nargs="+", type=int, default=[1, 2, 3])
+    args = parser.parse_args()
+
+    roiloc_cfg = OmegaConf.load(args.roiloc)
+    for mri in args.mris:
+        image = ants.image_read(str(mri.expanduser()), reorient="LPI")
+        spacing = np.array(image.spacing)
+        print(f"{mri.name}: {image.shape}, "
+              f"{np.round(spacing, 2).tolist()} mm")
+
+        references = {}
+        for seed in args.seeds:
+            references[seed] = locate(image, roiloc_cfg, None, seed)
+        timings = [elapsed for elapsed, _ in references.values()]
+        first = references[args.seeds[0]][1]
+        spread = max(
+            deviation(coords, first, spacing)
+            for _, coords in references.values())
+        print(f"  full resolution: {np.mean(timings):.2f}s, spread across "
+              f"seeds {spread[0]} voxels ({spread[1]:.1f} mm)")
+
+        for resolution in args.resolutions:
+            results = [
+                locate(image, roiloc_cfg, resolution, seed)
+                for seed in args.seeds
+            ]
+            elapsed = np.mean([elapsed for elapsed, _ in results])
+            worst = max(
+                deviation(coords, references[seed][1], spacing)
+                for seed, (_, coords) in zip(args.seeds, results))
+            print(f"  {resolution:g} mm: {elapsed:.2f}s "
+                  f"(x{np.mean(timings) / elapsed:.1f}), max deviation vs "
+                  f"full resolution {worst[0]} voxels ({worst[1]:.1f} mm)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmarks the batched test-time augmentation against the TorchIO pipeline.
+
+Usage:
+    python benchmarks/benchmark_tta.py [crop.nii.gz] --n-aug 20 --repeats 3
+
+Without an input crop, a synthetic volume of 64x24x80 voxels is used.
+"""
+import argparse
+import time
+from pathlib import Path
+
+import torch
+import torchio as tio
+from omegaconf import OmegaConf
+
+from hsf.augmentation import (BatchedAugmentation, get_augmentation_pipeline,
+                              get_augmented_subject)
+from hsf.segment import mri_to_subject
+
+CONF = Path(__file__).parents[1] / "hsf" / "conf"
+
+
+def torchio_tta(subject, augmentation_cfg, segmentation_cfg, n_classes):
+    subjects = get_augmented_subject(subject, augmentation_cfg,
+                                     segmentation_cfg)
+    results = []
+    for aug in subjects:
+        logits = torch.rand(n_classes, *aug.spatial_shape)
+        aug.add_image(tio.LabelMap(tensor=logits, affine=aug.mri.affine),
+                      "label")
+        results.append(aug.apply_inverse_transform(warn=False).label.data)
+    return results
+
+
+def batched_tta(subject, augmentation_cfg, n_aug, n_classes):
+    augmentation = BatchedAugmentation(subject, augmentation_cfg, n_aug)
+    data = augmentation.augment()
+    logits = torch.rand(len(augmentation), n_classes, *data.shape[2:])
+    return augmentation.inverse(logits, range(len(augmentation)))
+
+
+def timeit(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("crop", nargs="?", type=Path)
+    parser.add_argument("--n-aug", type=int, default=20)
+    parser.add_argument("--n-classes", type=int, default=6)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.crop:
+        subject = mri_to_subject(args.crop)
+    else:
+        image = tio.ScalarImage(tensor=torch.rand(1, 64, 24, 80),
+                                affine=torch.diag(torch.tensor(
+                                    [0.4, 2.6, 0.4, 1.])).numpy())
+        subject = tio.ZNormalization()(tio.Subject(mri=image))
+
+    augmentation_cfg = OmegaConf.load(CONF / "augmentation" / "default.yaml")
+    segmentation_cfg = OmegaConf.create({
+        "test_time_augmentation": True,
+        "test_time_num_aug": args.n_aug
+    })
+    # Pipeline built once to exclude the parsing of the configuration
+    get_augmentation_pipeline(augmentation_cfg)
+
+    reference = timeit(
+        lambda: torchio_tta(subject, augmentation_cfg, segmentation_cfg,
+                            args.n_classes), args.repeats)
+    batched = timeit(
+        lambda: batched_tta(subject, augmentation_cfg, args.n_aug,
+                            args.n_classes), args.repeats)
+
+    print(f"Volume: {tuple(subject.spatial_shape)}, TTA: {args.n_aug}")
+    print(f"TorchIO (augment + inverse): {reference:.3f}s")
+    print(f"Batched (augment + inverse): {batched:.3f}s")
+    print(f"Speedup: x{reference / batched:.2f}")
+
+
+if __name__ == "__main__":
+    main()
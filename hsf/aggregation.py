@@ -0,0 +1,168 @@
+from typing import Optional
+
+import torch
+
+from hsf.uncertainty import voxelwise_uncertainty
+
+
+class EnsembleAggregator:
+    """
+    Online aggregation of the soft predictions of an ensemble (models x TTA).
+
+    Instead of stacking every prediction, it keeps running sums of the
+    probabilities, per-class vote counts and per-sample entropies, so that
+    memory stays in O(classes x voxels) whatever the size of the ensemble.
+
+    Args:
+        eps (float): Epsilon factor to avoid log(0).
+
+    Attributes:
+        count (int): Number of aggregated predictions.
+    """
+
+    def __init__(self, eps: float = 1e-5):
+        self.eps = eps
+        self.count = 0
+        self._sum: Optional[torch.Tensor] = None
+        self._votes: Optional[torch.Tensor] = None
+        self._entropy: Optional[torch.Tensor] = None
+
+    def update(self, prediction: torch.Tensor) -> None:
+        """
+        Adds a prediction to the ensemble.
+
+        Args:
+            prediction (torch.Tensor): Softmaxed prediction in CHWD format.
+        """
+        prediction = prediction.float()
+        if self._sum is None:
+            self._sum = torch.zeros_like(prediction)
+            self._votes = torch.zeros(prediction.shape, dtype=torch.int16)
+            self._entropy = torch.zeros(prediction.shape[1:])
+
+        self._sum += prediction
+        self._votes.scatter_add_(
+            0,
+            prediction.argmax(dim=0, keepdim=True),
+            torch.ones((1, *prediction.shape[1:]), dtype=torch.int16))
+        self._entropy -= torch.sum(prediction *
+                                   torch.log(prediction + self.eps),
+                                   dim=0)
+        self.count += 1
+
+    @property
+    def mean(self) -> torch.Tensor:
+        """
+        Mean soft prediction, in NCHWD format with N=1.
+
+        It can be given to `voxelwise_uncertainty` in place of the stacked
+        predictions, as the entropy is computed on their mean.
+        """
+        return (self._sum / self.count).unsqueeze(0)
+
+    @property
+    def hard_prediction(self) -> torch.Tensor:
+        """Plurality vote of the hard predictions of the ensemble."""
+        return self._votes.argmax(dim=0)
+
+    @property
+    def expected_entropy(self) -> torch.Tensor:
+        """Mean entropy of the individual predictions."""
+        return self._entropy / self.count
+
+    def uncertainty(self) -> torch.Tensor:
+        """
+        Computes the voxelwise uncertainty map of the ensemble.
+
+        Returns:
+            torch.Tensor: Entropy of the mean prediction.
+        """
+        return voxelwise_uncertainty(self.mean, eps=self.eps)
+
+
+class ConvergenceMonitor:
+    """
+    Watches how much the consensus of an `EnsembleAggregator` still changes
+    as predictions come in, to stop the ensemble early.
+
+    Two quantities are compared between consecutive checks: the fraction of
+    foreground voxels whose voted label changed, and the relative change of
+    the mean entropy of the mean prediction.
+
+    Args:
+        tolerance (float): Maximum change of both quantities for a check to
+            be considered stable.
+        patience (int): Number of consecutive stable checks after which the
+            ensemble has converged.
+
+    Attributes:
+        checks (int): Number of checks since the last reset.
+    """
+
+    def __init__(self, tolerance: float = 0.005, patience: int = 2):
+        self.tolerance = tolerance
+        self.patience = patience
+        self.checks = 0
+        self._stable = 0
+        self._labels: Optional[torch.Tensor] = None
+        self._entropy: Optional[float] = None
+
+    def reset(self) -> None:
+        """Starts over, e.g. to watch the predictions of a new model."""
+        self.checks = 0
+        self._stable = 0
+        self._labels = None
+        self._entropy = None
+
+    def update(self, aggregator: EnsembleAggregator) -> bool:
+        """
+        Compares the current consensus with the one of the previous check.
+
+        Args:
+            aggregator (EnsembleAggregator): The watched ensemble.
+
+        Returns:
+            bool: Whether the ensemble has converged.
+        """
+        labels = aggregator.hard_prediction
+        entropy = aggregator.uncertainty().mean().item()
+        self.checks += 1
+
+        if self._labels is not None:
+            label_change = _label_change(labels, self._labels)
+            entropy_change = abs(entropy - self._entropy) / max(
+                self._entropy, aggregator.eps)
+
+            if max(label_change, entropy_change) < self.tolerance:
+                self._stable += 1
+            else:
+                self._stable = 0
+
+        self._labels = labels
+        self._entropy = entropy
+
+        return self._stable >= self.patience
+
+    def agrees(self, aggregator: EnsembleAggregator,
+               reference: torch.Tensor) -> bool:
+        """
+        Whether the consensus of an ensemble matches reference labels, e.g.
+        whether a new model agrees with the models before it.
+
+        Args:
+            aggregator (EnsembleAggregator): The compared ensemble.
+            reference (torch.Tensor): Voted labels to compare with.
+
+        Returns:
+            bool: Whether the fraction of changed foreground voxels is below
+                the tolerance.
+        """
+        return _label_change(aggregator.hard_prediction,
+                             reference) < self.tolerance
+
+
+def _label_change(labels: torch.Tensor, reference: torch.Tensor) -> float:
+    """Fraction of the foreground voxels whose label changed."""
+    foreground = torch.logical_or(labels > 0, reference > 0)
+    changed = torch.logical_and(labels != reference, foreground)
+    return changed.sum().item() / max(foreground.sum().item(), 1)
@@ -0,0 +1,264 @@
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import PosixPath
+from typing import Callable, Iterable, Iterator, List, Tuple, Union
+
+import ants
+from rich.logging import RichHandler
+
+from hsf.tracing import span
+
+FORMAT = "%(message)s"
+logging.basicConfig(level=logging.INFO,
+                    format=FORMAT,
+                    datefmt="[%X]",
+                    handlers=[RichHandler()])
+
+log = logging.getLogger(__name__)
+
+
+def write_image(image: ants.ANTsImage,
+                path: Union[str, PosixPath],
+                compression_level: int = 6) -> None:
+    """
+    Writes an image atomically, compressing `.nii.gz` files with the given
+    gzip level.
+
+    The image is first written uncompressed by ANTs, then compressed by
+    `gzip`, which releases the GIL, into a temporary file renamed at the end.
+    An interrupted write thus never leaves a truncated image behind.
+
+    Args:
+        image (ants.ANTsImage): Image to write.
+        path (Union[str, PosixPath]): Output path.
+        compression_level (int): gzip compression level, from 0 (no
+            compression) to 9. Defaults to 6.
+    """
+    with span("write", file=os.path.basename(str(path))):
+        _write_image(image, str(path), compression_level)
+
+
+def _write_image(image: ants.ANTsImage, path: str,
+                 compression_level: int) -> None:
+    directory = os.path.dirname(path) or "."
+    if not path.endswith(".gz"):
+        # Same extension, so that ANTs picks the same format
+        fd, tmp = tempfile.mkstemp(suffix="_" + os.path.basename(path),
+                                   dir=directory)
+        os.close(fd)
+        try:
+            ants.image_write(image, tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return
+
+    fd, raw = tempfile.mkstemp(suffix=".nii", dir=directory)
+    os.close(fd)
+    fd, compressed = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    os.close(fd)
+    try:
+        ants.image_write(image, raw)
+        with open(raw, "rb") as src, open(compressed, "wb") as dst:
+            with gzip.GzipFile(fileobj=dst,
+                               mode="wb",
+                               compresslevel=compression_level) as gz:
+                shutil.copyfileobj(src, gz, 1 << 20)
+        os.replace(compressed, path)
+    finally:
+        for tmp in (raw, compressed):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class AsyncWriter:
+    """
+    Write-behind queue of images, so that compression and disk writes happen
+    off the critical path.
+
+    Args:
+        compression_level (int): gzip compression level. Defaults to 6.
+        asynchronous (bool): Whether to write in a background thread. If
+            False, images are written when submitted. Defaults to True.
+        max_pending (int): Maximum number of images waiting to be written,
+            after which `submit` blocks. Defaults to 16.
+    """
+
+    def __init__(self,
+                 compression_level: int = 6,
+                 asynchronous: bool = True,
+                 max_pending: int = 16):
+        self.compression_level = compression_level
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="hsf-writer") if asynchronous else None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures: List[Tuple[str, Future]] = []
+
+    def submit(self, image: ants.ANTsImage, path: Union[str,
+                                                         PosixPath]) -> Future:
+        """
+        Queues an image to be written.
+
+        Args:
+            image (ants.ANTsImage): Image to write. It must not be modified
+                afterwards.
+            path (Union[str, PosixPath]): Output path.
+
+        Returns:
+            Future: Completed once the image is on disk.
+        """
+        if self._executor is None:
+            future = Future()
+            try:
+                write_image(image, path, self.compression_level)
+                future.set_result(path)
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            self._slots.acquire()
+            future = self._executor.submit(self._write, image, path)
+
+        self._futures.append((str(path), future))
+        return future
+
+    def _write(self, image: ants.ANTsImage, path: Union[str,
+                                                        PosixPath]) -> str:
+        try:
+            write_image(image, path, self.compression_level)
+        finally:
+            self._slots.release()
+        return path
+
+    def wait(self, paths: Iterable[Union[str, PosixPath]]) -> None:
+        """
+        Waits for some images to be written.
+
+        Args:
+            paths (Iterable[Union[str, PosixPath]]): Paths to wait for.
+
+        Raises:
+            Exception: The error of the first failed write, if any.
+        """
+        paths = {str(path) for path in paths}
+        waited = [future for path, future in self._futures if path in paths]
+        self._futures = [(path, future)
+                         for path, future in self._futures
+                         if path not in paths]
+        for future in waited:
+            future.result()
+
+    def when_written(self, paths: Iterable[Union[str, PosixPath]],
+                     callback: Callable) -> None:
+        """
+        Calls a function once some images are written, without waiting.
+
+        The call is queued after the writes, so that `flush` also waits for
+        it.
+
+        Args:
+            paths (Iterable[Union[str, PosixPath]]): Paths to wait for.
+                Paths that were not submitted are considered written.
+            callback (Callable): Called with the list of error messages of
+                the failed writes (empty if all succeeded).
+        """
+        paths = {str(path) for path in paths}
+        futures = [future for path, future in self._futures if path in paths]
+
+        def _call():
+            errors = []
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+            callback(errors)
+
+        if self._executor is None:
+            _call()
+        else:
+            self._futures.append(("<callback>", self._executor.submit(_call)))
+
+    def collect(self) -> List[Tuple[str, str]]:
+        """
+        Forgets the finished writes, without waiting for the others.
+
+        Returns:
+            List[Tuple[str, str]]: Failed writes with their error message.
+        """
+        errors, pending = [], []
+        for path, future in self._futures:
+            if not future.done():
+                pending.append((path, future))
+            elif future.exception() is not None:
+                e = future.exception()
+                log.error(f"Could not write {path}: {e}")
+                errors.append((path, f"{type(e).__name__}: {e}"))
+        self._futures = pending
+        return errors
+
+    def flush(self) -> List[Tuple[str, str]]:
+        """
+        Waits for all queued images to be written.
+
+        Returns:
+            List[Tuple[str, str]]: Failed writes with their error message.
+        """
+        for _, future in self._futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+        return self.collect()
+
+    def close(self) -> List[Tuple[str, str]]:
+        """
+        Flushes the queue and stops the background thread.
+
+        Returns:
+            List[Tuple[str, str]]: Failed writes with their error message.
+        """
+        errors = self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+        return errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def prefetch(items: Iterable,
+             load: Callable,
+             depth: int = 1) -> Iterator[Tuple[object, Future]]:
+    """
+    Loads items in a background thread, `depth` items ahead of the consumer.
+
+    Args:
+        items (Iterable): Items to load (e.g. paths to MRIs).
+        load (Callable): Loading function, called on each item.
+        depth (int): Number of items loaded in advance. Defaults to 1.
+
+    Yields:
+        Tuple[object, Future]: The item and the future of its loading.
+            Loading errors are raised by `future.result()`.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=1,
+                            thread_name_prefix="hsf-reader") as executor:
+        queue = deque()
+        for item in items:
+            queue.append((item, executor.submit(load, item)))
+            if len(queue) > depth:
+                yield queue.popleft()
+        while queue:
+            yield queue.popleft()
@@ -1,10 +1,17 @@
 import logging
 from multiprocessing.pool import ThreadPool
+from typing import Sequence
 
+import numpy as np
+import SimpleITK as sitk
+import torch
+import torch.nn.functional as F
 import torchio as tio
 from omegaconf.dictconfig import DictConfig
 from rich.logging import RichHandler
 
+from hsf.threads import augmentation_pool
+
 FORMAT = "%(message)s"
 logging.basicConfig(level=logging.INFO,
                     format=FORMAT,
@@ -57,9 +64,348 @@ def get_augmented_subject(subject: tio.Subject, augmentation_cfg: DictConfig,
     if n_aug > 1:
         log.info(f"Augmenting {n_aug} times...")
         subjects = [subject] * n_aug
-        with ThreadPool(n_aug) as pool:
+        with augmentation_pool(n_aug) as n_threads, \
+                ThreadPool(n_threads) as pool:
             subjects = pool.map(augment, subjects)
         subjects.append(subject)
 
         return subjects
     return [subject]
+
+
+def get_batched_augmentation(subject: tio.Subject,
+                             augmentation_cfg: DictConfig,
+                             segmentation_cfg: DictConfig) -> list:
+    """
+    Returns the augmented samples of a subject, computed at once by a
+    `BatchedAugmentation`.
+
+    Args:
+        subject (tio.Subject): The subject to augment.
+        augmentation_cfg (DictConfig): Augmentation configuration.
+        segmentation_cfg (DictConfig): Segmentation configuration.
+
+    Returns:
+        list: (BatchedAugmentation, sample index, augmented tensor) tuples.
+    """
+    n_aug = segmentation_cfg.test_time_num_aug if segmentation_cfg.test_time_augmentation else 1
+    n_aug = n_aug if n_aug > 1 else 0
+
+    if n_aug:
+        log.info(f"Augmenting {n_aug} times (batched)...")
+    augmentation = BatchedAugmentation(subject, augmentation_cfg, n_aug)
+    data = augmentation.augment()
+
+    return [(augmentation, k, data[k]) for k in range(len(augmentation))]
+
+
+def _rotation_matrix(radians: Sequence[float]) -> np.ndarray:
+    """
+    Rotation matrix of an ITK Euler3DTransform (Z * X * Y convention).
+
+    Args:
+        radians (Sequence[float]): Rotation around each LPS axis.
+
+    Returns:
+        np.ndarray: 3x3 rotation matrix.
+    """
+    cx, cy, cz = np.cos(radians)
+    sx, sy, sz = np.sin(radians)
+    rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+
+    return rz @ rx @ ry
+
+
+def _bspline_weights(u: torch.Tensor, n_control_points: int) -> torch.Tensor:
+    """
+    Cubic B-spline weights of each position w.r.t. the control points.
+
+    Args:
+        u (torch.Tensor): Continuous indices in the control point grid.
+        n_control_points (int): Number of control points along the axis.
+
+    Returns:
+        torch.Tensor: Weights of shape (len(u), n_control_points).
+    """
+    start = torch.floor(u) - 1
+    t = u - torch.floor(u)
+    basis = torch.stack([(1 - t)**3, 3 * t**3 - 6 * t**2 + 4,
+                         -3 * t**3 + 3 * t**2 + 3 * t + 1, t**3], -1) / 6
+
+    weights = torch.zeros(len(u), n_control_points, dtype=u.dtype)
+    index = (start.long()[:, None] + torch.arange(4)).clamp(
+        0, n_control_points - 1)
+    weights.scatter_add_(1, index, basis)
+
+    return weights
+
+
+class BatchedAugmentation:
+    """
+    Test-time augmentation of a subject, with all augmented copies computed
+    at once by a single batched `grid_sample`.
+
+    Flips, affine and elastic parameters are sampled up front from the same
+    distributions as `get_augmentation_pipeline`, and follow the conventions
+    of TorchIO (i.e. SimpleITK resampling in LPS space). The same parameters
+    are used to warp the logits back with `inverse`.
+
+    Args:
+        subject (tio.Subject): The preprocessed subject to augment.
+        augmentation_cfg (DictConfig): Augmentation configuration.
+        n_aug (int): Number of augmented copies. As in
+            `get_augmented_subject`, the original subject is the last sample.
+    """
+
+    def __init__(self, subject: tio.Subject, augmentation_cfg: DictConfig,
+                 n_aug: int):
+        self.subject = subject
+        image = subject.mri
+        self.affine = image.affine
+        self.spatial_shape = image.spatial_shape
+        self.n_aug = n_aug
+
+        flip = tio.RandomFlip(**augmentation_cfg.flip)
+        affine = tio.RandomAffine(**augmentation_cfg.affine)
+        elastic = tio.RandomElasticDeformation(**augmentation_cfg.elastic)
+        self.interpolation = "nearest" if affine.image_interpolation == "nearest" else "bilinear"
+
+        axes = [
+            3 + image.axis_name_to_index(axis) if isinstance(axis, str) else
+            axis for axis in flip.axes
+        ]
+        p_affine = augmentation_cfg.affine_probability
+        p_affine /= p_affine + augmentation_cfg.elastic_probability
+
+        # Voxel to LPS world coordinates
+        self._vox2lps = np.diag([-1., -1., 1., 1.]) @ self.affine
+
+        self.flips = torch.zeros(n_aug + 1, 3, dtype=torch.bool)
+        self.is_elastic = torch.zeros(n_aug + 1, dtype=torch.bool)
+        self.matrices = torch.eye(4, dtype=torch.float64).repeat(
+            n_aug + 1, 1, 1)
+        control_points = []
+        for n in range(n_aug):
+            flipped = torch.tensor(flip.get_params(flip.flip_probability))
+            self.flips[n, axes] = flipped[axes]
+
+            if torch.rand(1).item() < p_affine:
+                self.matrices[n] = self._affine_matrix(
+                    *affine.get_params(affine.scales, affine.degrees,
+                                       affine.translation, affine.isotropic))
+            else:
+                self.is_elastic[n] = True
+                control_points.append(
+                    elastic.get_params(elastic.num_control_points,
+                                       elastic.max_displacement,
+                                       elastic.num_locked_borders))
+
+        self.displacements = self._elastic_displacements(control_points)
+
+    def __len__(self) -> int:
+        return self.n_aug + 1
+
+    def _affine_matrix(self, scales: torch.Tensor, degrees: torch.Tensor,
+                       translation: torch.Tensor) -> torch.Tensor:
+        """
+        Voxel mapping from output to input of a `tio.Affine` transform.
+
+        Args:
+            scales (torch.Tensor): Scaling factors.
+            degrees (torch.Tensor): Rotation angles (RAS).
+            translation (torch.Tensor): Translation in mm (RAS).
+
+        Returns:
+            torch.Tensor: 4x4 voxel mapping.
+        """
+        ras_to_lps = np.array([-1., -1., 1.])
+        center = self._vox2lps @ np.append(
+            (np.array(self.spatial_shape) - 1) / 2, 1)
+
+        scaling = np.eye(4)
+        scaling[:3, :3] = np.diag(scales.numpy())
+        rotation = np.eye(4)
+        rotation[:3, :3] = _rotation_matrix(
+            ras_to_lps * np.radians(degrees.numpy()))
+        rotation[:3, 3] = ras_to_lps * translation.numpy()
+
+        centering = np.eye(4)
+        centering[:3, 3] = -center[:3]
+        uncentering = np.eye(4)
+        uncentering[:3, 3] = center[:3]
+
+        # Composite transform (scaling after rotation), both around the center
+        transform = uncentering @ scaling @ rotation @ centering
+        mapping = np.linalg.inv(
+            self._vox2lps) @ np.linalg.inv(transform) @ self._vox2lps
+
+        return torch.from_numpy(mapping)
+
+    def _elastic_displacements(self, control_points: list) -> torch.Tensor:
+        """
+        Dense voxel displacements of the sampled B-spline deformations.
+
+        Args:
+            control_points (list): Displacements of the control points (mm).
+
+        Returns:
+            torch.Tensor: Displacements of shape (N, X, Y, Z, 3).
+        """
+        if not control_points:
+            return torch.zeros(0, *self.spatial_shape, 3)
+
+        coefficients = torch.from_numpy(np.stack(control_points)).double()
+        n_control_points = coefficients.shape[1:4]
+
+        origin, spacing, direction = tio.io.get_sitk_metadata_from_ras_affine(
+            self.affine)
+        reference = sitk.Image([int(s) for s in self.spatial_shape],
+                               sitk.sitkUInt8)
+        reference.SetOrigin(origin)
+        reference.SetSpacing(spacing)
+        reference.SetDirection(direction)
+        grid = sitk.BSplineTransformInitializer(
+            reference, [n - 3 for n in n_control_points]).GetFixedParameters()
+        grid_origin = np.array(grid[3:6])
+        grid_spacing = np.array(grid[6:9])
+        grid_direction = np.array(grid[9:]).reshape(3, 3)
+
+        # The grid shares the image direction: each axis is separable
+        to_grid = grid_direction.T @ self._vox2lps[:3, :3]
+        offset = grid_direction.T @ (self._vox2lps[:3, 3] - grid_origin)
+        weights = [
+            _bspline_weights(
+                (torch.arange(size, dtype=torch.float64) * to_grid[a, a] +
+                 offset[a]) / grid_spacing[a], n_control_points[a])
+            for a, size in enumerate(self.spatial_shape)
+        ]
+
+        displacements = torch.einsum("xi,yj,zk,nijkd->nxyzd", *weights,
+                                     coefficients)
+        lps_to_vox = torch.from_numpy(np.linalg.inv(self._vox2lps[:3, :3]))
+
+        return (displacements @ lps_to_vox.T).float()
+
+    def _grids(self,
+               indices: Sequence[int],
+               inverse: bool = False) -> torch.Tensor:
+        """
+        Sampling grids of the given samples, in voxel coordinates.
+
+        Args:
+            indices (Sequence[int]): Indices of the samples.
+            inverse (bool): Whether to build the grids undoing the augmentations.
+
+        Returns:
+            torch.Tensor: Grids of shape (n, X, Y, Z, 3).
+        """
+        size = torch.tensor(self.spatial_shape, dtype=torch.float32)
+        voxels = torch.stack(torch.meshgrid(
+            *[torch.arange(s, dtype=torch.float32) for s in self.spatial_shape],
+            indexing="ij"),
+                             dim=-1)
+        elastic_index = torch.cumsum(self.is_elastic, 0) - 1
+
+        grids = []
+        for n in indices:
+            if self.is_elastic[n]:
+                sign = -1 if inverse else 1
+                grid = voxels + sign * self.displacements[elastic_index[n]]
+            else:
+                matrix = self.matrices[n]
+                if inverse:
+                    matrix = torch.linalg.inv(matrix)
+                matrix = matrix.float()
+                grid = voxels @ matrix[:3, :3].T + matrix[:3, 3]
+
+            axes = torch.where(self.flips[n])[0]
+            if inverse:
+                # Undo the resampling on flipped positions
+                grid = torch.flip(grid, dims=axes.tolist())
+            else:
+                # Resample from the flipped image
+                grid[..., axes] = size[axes] - 1 - grid[..., axes]
+            grids.append(grid)
+
+        return torch.stack(grids)
+
+    def _normalize(self, grids: torch.Tensor) -> torch.Tensor:
+        """
+        Normalizes voxel grids to [-1, 1], as expected by `grid_sample`.
+
+        Args:
+            grids (torch.Tensor): Grids in voxel coordinates.
+
+        Returns:
+            torch.Tensor: Normalized grids, with (x, y, z) as (W, H, D).
+        """
+        size = torch.tensor(self.spatial_shape, dtype=torch.float32)
+        grids = 2 * grids / (size - 1).clamp(min=1) - 1
+
+        return grids.flip(-1)
+
+    def augment(self) -> torch.Tensor:
+        """
+        Augments the subject.
+
+        Returns:
+            torch.Tensor: Augmented copies of shape (N, C, X, Y, Z).
+        """
+        data = self.subject.mri.data.float()
+        minimum = data.amin(dim=(1, 2, 3), keepdim=True)
+
+        grids = self._grids(range(len(self)))
+        n, x = grids.shape[:2]
+
+        # As ITK, voxels are extended by half a voxel before padding
+        size = torch.tensor(self.spatial_shape, dtype=torch.float32)
+        outside = ((grids < -0.5) | (grids > size - 0.5)).any(-1)
+
+        # A single input sampled by all grids stacked along the first axis
+        grids = self._normalize(grids).reshape(1, n * x, *grids.shape[2:])
+        warped = F.grid_sample(data[None],
+                               grids,
+                               mode=self.interpolation,
+                               padding_mode="border",
+                               align_corners=True)[0]
+        warped = warped.reshape(data.shape[0], n, *outside.shape[1:])
+        warped = torch.where(outside, minimum[:, None], warped).transpose(0, 1)
+
+        # The original subject is kept untouched
+        warped[-1] = data
+
+        return warped
+
+    def inverse(self, logits: torch.Tensor, indices: Sequence[int]) -> torch.Tensor:
+        """
+        Warps logits back to the space of the original subject, and undoes
+        its preprocessing.
+
+        Args:
+            logits (torch.Tensor): Logits of shape (n, K, X, Y, Z).
+            indices (Sequence[int]): Sample index of each logit.
+
+        Returns:
+            torch.Tensor: Logits in the space of the original subject.
+        """
+        grids = self._normalize(self._grids(indices, inverse=True))
+
+        # Label maps are padded with 0 (affine) or their minimum (elastic)
+        padding = logits.amin(dim=(2, 3, 4), keepdim=True)
+        padding = padding * self.is_elastic[list(indices)].view(-1, 1, 1, 1, 1)
+        back = F.grid_sample(logits.float() - padding,
+                             grids,
+                             mode="nearest",
+                             padding_mode="zeros",
+                             align_corners=True) + padding
+
+        n, k = back.shape[:2]
+        label = tio.LabelMap(tensor=back.reshape(n * k, *back.shape[2:]),
+                             affine=self.affine)
+        subject = tio.Subject(label=label)
+        subject.applied_transforms = self.subject.applied_transforms
+        back = subject.apply_inverse_transform(warn=False).label.data
+
+        return back.reshape(n, k, *back.shape[1:])
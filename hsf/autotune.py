@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import time
+from itertools import product
+from pathlib import Path, PosixPath
+from typing import List, Sequence, Tuple
+
+import hydra
+import numpy as np
+from omegaconf import DictConfig, OmegaConf
+from rich.logging import RichHandler
+
+from hsf.engines import InferenceEngine, machine_key
+from hsf.fetch_models import fetch_models_from_config
+from hsf.threads import available_cores, configure_from_config
+
+FORMAT = "%(message)s"
+logging.basicConfig(level=logging.INFO,
+                    format=FORMAT,
+                    datefmt="[%X]",
+                    handlers=[RichHandler()])
+
+log = logging.getLogger(__name__)
+
+
+def thread_layouts(num_threads: int) -> List[dict]:
+    """
+    Lists the candidate thread layouts for a number of cores.
+
+    Args:
+        num_threads (int): Number of cores available to one process.
+
+    Returns:
+        List[dict]: Candidate session options.
+    """
+    intra = sorted({2**i for i in range(num_threads.bit_length())} |
+                   {num_threads})
+    layouts = [{
+        "intra_op_num_threads": n,
+        "inter_op_num_threads": 1,
+        "execution_mode": "sequential"
+    } for n in intra]
+    layouts += [{
+        "intra_op_num_threads": n,
+        "inter_op_num_threads": m,
+        "execution_mode": "parallel"
+    } for n, m in product(intra, (2, 4)) if n * m <= num_threads]
+
+    return layouts
+
+
+def benchmark(model: PosixPath,
+              engine_settings: DictConfig,
+              shape: Sequence[int],
+              repeats: int = 5) -> float:
+    """
+    Measures the best latency of a model for given engine settings.
+
+    Args:
+        model (PosixPath): Path to the model.
+        engine_settings (DictConfig): Engine settings.
+        shape (Sequence[int]): Input shape, in NCHWD format.
+        repeats (int): Number of timed runs, after one warm-up run.
+
+    Returns:
+        float: Best latency, in seconds.
+    """
+    engine = InferenceEngine(engine_name="onnxruntime",
+                             engine_settings=engine_settings,
+                             model=model)
+    x = np.random.default_rng(0).standard_normal(shape).astype(np.float32)
+    engine(x)
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        engine(x)
+        timings.append(time.perf_counter() - start)
+    engine.close()
+
+    return min(timings)
+
+
+def autotune(model: PosixPath,
+             engine_settings: DictConfig,
+             shape: Sequence[int],
+             num_threads: int,
+             repeats: int = 5) -> Tuple[dict, float]:
+    """
+    Picks the fastest thread layout for a model on this machine.
+
+    Args:
+        model (PosixPath): Path to the model.
+        engine_settings (DictConfig): Engine settings, whose other session
+            options are kept.
+        shape (Sequence[int]): Input shape, in NCHWD format.
+        num_threads (int): Number of cores available to one process.
+        repeats (int): Number of timed runs per layout.
+
+    Returns:
+        Tuple[dict, float]: Best layout and its latency, in seconds.
+    """
+    results = []
+    for layout in thread_layouts(num_threads):
+        settings = OmegaConf.merge(engine_settings, {
+            "session_options": {
+                **layout, "use_autotune": False
+            }
+        })
+        latency = benchmark(model, settings, shape, repeats)
+        log.info(f"{layout}: {1000 * latency:.1f}ms")
+        results.append((latency, layout))
+
+    latency, layout = min(results, key=lambda result: result[0])
+    return layout, latency
+
+
+def save_thread_layout(path: PosixPath, providers: Sequence,
+                       layout: dict) -> None:
+    """
+    Saves the thread layout of this machine, keeping other machines' ones.
+
+    Args:
+        path (PosixPath): Path to the autotune file.
+        providers (Sequence): Execution providers.
+        layout (dict): Tuned session options.
+    """
+    path = Path(path).expanduser()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    layouts = json.loads(path.read_text()) if path.exists() else {}
+    layouts[machine_key(providers)] = layout
+
+    tmp = path.with_suffix(f".tmp{os.getpid()}")
+    tmp.write_text(json.dumps(layouts, indent=2))
+    os.replace(tmp, path)
+
+
+@hydra.main(config_path="conf", config_name="config", version_base="1.1")
+def main(cfg: DictConfig) -> None:
+    if cfg.hardware.engine != "onnxruntime":
+        raise ValueError("Only the onnxruntime engine can be tuned.")
+    fetch_models_from_config(cfg)
+
+    engine_settings = cfg.hardware.engine_settings
+    options = engine_settings.get("session_options", {})
+    autotune_cfg = cfg.hardware.get("autotune", {})
+    # Same threads as the sessions of a run, within `hardware.threads`
+    num_threads = configure_from_config(cfg) or max(
+        available_cores() // cfg.hardware.get("jobs", 1), 1)
+    shape = [engine_settings.batch_size, 1] + \
+        list(autotune_cfg.get("shape", [64, 32, 64]))
+
+    model = sorted(Path(cfg.segmentation.models_path).expanduser().glob(
+        "*.onnx"))[0]
+    log.info(f"Tuning {model.name} on {num_threads} threads, "
+             f"with inputs of shape {shape}.")
+    layout, latency = autotune(model, engine_settings, shape, num_threads,
+                               autotune_cfg.get("repeats", 5))
+
+    path = options.get("autotune_file", "~/.hsf/autotune.json")
+    save_thread_layout(path, engine_settings.execution_providers, layout)
+    log.info(f"Best layout: {layout} ({1000 * latency:.1f}ms), saved to "
+             f"{path}. Use it with "
+             "`hardware.engine_settings.session_options.use_autotune=true`.")
+
+
+def start():
+    main()
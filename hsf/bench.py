@@ -0,0 +1,309 @@
+import json
+import logging
+import platform
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path, PosixPath
+from typing import Callable, List
+
+import ants
+import hydra
+import numpy as np
+import torch
+from hydra.utils import to_absolute_path
+from omegaconf import DictConfig, OmegaConf
+from rich.logging import RichHandler
+
+from hsf import __version__
+from hsf.aggregation import EnsembleAggregator
+from hsf.async_io import write_image
+from hsf.augmentation import get_augmented_subject, get_batched_augmentation
+from hsf.engines import InferenceEnginePool
+from hsf.fetch_models import fetch_models_from_config
+from hsf.roiloc_wrapper import get_hippocampi, get_mri, load_from_config
+from hsf.segment import (infer, invert, invert_augmented, mri_to_subject,
+                         to_ca_mode)
+from hsf.threads import budget_engine_settings, configure_from_config
+from hsf.tracing import process_peak_rss
+from hsf.uncertainty import voxelwise_uncertainty
+
+FORMAT = "%(message)s"
+logging.basicConfig(level=logging.INFO,
+                    format=FORMAT,
+                    datefmt="[%X]",
+                    handlers=[RichHandler()])
+
+log = logging.getLogger(__name__)
+
+
+class StageRecorder:
+    """
+    Times the stages of the pipeline and records their results.
+
+    Args:
+        repeats (int): Number of timed runs of each stage.
+
+    Attributes:
+        results (List[dict]): One record per stage and input.
+    """
+
+    def __init__(self, repeats: int = 3):
+        self.repeats = repeats
+        self.results: List[dict] = []
+
+    def run(self, stage: str, fn: Callable, items: int = 1, **info):
+        """
+        Runs a stage `repeats` times.
+
+        Args:
+            stage (str): Name of the stage.
+            fn (Callable): Stage, called without arguments.
+            items (int): Number of items (e.g. volumes, samples) processed
+                by one run, to compute the throughput.
+            **info: Description of the input, added to the record.
+
+        Returns:
+            The output of the last run.
+        """
+        timings = []
+        for _ in range(self.repeats):
+            start = time.perf_counter()
+            output = fn()
+            timings.append(time.perf_counter() - start)
+
+        wall_time = statistics.median(timings)
+        self.results.append({
+            "stage": stage,
+            **info,
+            "repeats": self.repeats,
+            "wall_time_s": wall_time,
+            "min_wall_time_s": min(timings),
+            "throughput_per_s": items / wall_time if wall_time else None,
+            "process_peak_rss_mb": process_peak_rss(),
+        })
+        log.info(f"{stage} ({info.get('input', '')}): {wall_time:.3f}s")
+
+        return output
+
+
+def synthetic_volume(shape: List[int], spacing: List[float]) -> ants.ANTsImage:
+    """
+    Generates a smooth random volume.
+
+    Args:
+        shape (List[int]): Shape of the volume.
+        spacing (List[float]): Spacing of the volume, in mm.
+
+    Returns:
+        ants.ANTsImage: Synthetic volume, in LPI orientation.
+    """
+    rng = np.random.default_rng(0)
+    data = rng.random([max(dim // 4, 2) for dim in shape]).astype(np.float32)
+    image = ants.resample_image(ants.from_numpy(data), tuple(shape), True, 4)
+    image.set_spacing(tuple(spacing))
+
+    return image
+
+
+def bench_crop(recorder: StageRecorder, crop: ants.ANTsImage, engines,
+               cfg: DictConfig, batch_sizes: List[int], output_dir: PosixPath,
+               name: str) -> None:
+    """
+    Benchmarks the stages applied to a hippocampal crop.
+
+    Args:
+        recorder (StageRecorder): Recorder.
+        crop (ants.ANTsImage): The crop.
+        engines (dict): Engine pools, per batch size.
+        cfg (DictConfig): Configuration.
+        batch_sizes (List[int]): Batch sizes to benchmark.
+        output_dir (PosixPath): Directory of the saved outputs.
+        name (str): Name of the input.
+    """
+    info = {"input": name, "shape": list(crop.shape)}
+    subject = recorder.run("mri_to_subject", lambda: mri_to_subject(crop),
+                           **info)
+
+    batched = cfg.augmentation.get("batched", False)
+    augment = get_batched_augmentation if batched else get_augmented_subject
+    segmentation_cfg = cfg.segmentation.segmentation
+    n_aug = segmentation_cfg.test_time_num_aug if \
+        segmentation_cfg.test_time_augmentation else 1
+    samples = recorder.run(
+        "tta",
+        lambda: augment(subject, cfg.augmentation, segmentation_cfg),
+        items=max(n_aug, 1),
+        **info)
+    data = [sample[2] if batched else sample.mri.data for sample in samples]
+
+    logits = None
+    for batch_size in batch_sizes:
+        batch = [data[i % len(data)] for i in range(batch_size)]
+        # Every model of the bag runs on every crop
+        for engine in engines[batch_size]:
+            output = recorder.run(
+                "inference",
+                lambda: to_ca_mode(infer(batch, engine),
+                                   cfg.segmentation.ca_mode),
+                items=batch_size,
+                batch_size=batch_size,
+                model=Path(engine.model).name,
+                **info)
+            if logits is None:
+                # Buffers of the engine may be reused, the logits are kept
+                logits = output.clone()
+
+    # Whole ensemble of one model, in batches of the first batch size
+    logits = logits.repeat(-(-len(samples) // len(logits)), 1, 1, 1,
+                           1)[:len(samples)]
+    if batched:
+        predictions = recorder.run("inverse",
+                                   lambda: invert_augmented(logits, samples),
+                                   items=len(samples),
+                                   **info)
+    else:
+        predictions = recorder.run("inverse",
+                                   lambda: invert(logits, samples),
+                                   items=len(samples),
+                                   **info)
+
+    def _aggregate():
+        aggregator = EnsembleAggregator()
+        for prediction in predictions:
+            aggregator.update(prediction)
+        return aggregator
+
+    aggregator = recorder.run("aggregation",
+                              _aggregate,
+                              items=len(predictions),
+                              **info)
+    uncertainty = recorder.run(
+        "uncertainty", lambda: voxelwise_uncertainty(aggregator.mean), **info)
+
+    compression_level = cfg.files.get("compression_level", 6)
+
+    def _save():
+        hard = crop.new_image_like(
+            aggregator.hard_prediction.numpy().astype("float32"))
+        unc = crop.new_image_like(uncertainty.squeeze().numpy().astype(
+            "float32"))
+        write_image(hard.astype("uint8"), output_dir / f"{name}_seg.nii.gz",
+                    compression_level)
+        write_image(unc, output_dir / f"{name}_unc.nii.gz", compression_level)
+
+    recorder.run("save", _save, items=2, **info)
+
+
+def bench(cfg: DictConfig) -> dict:
+    """
+    Runs sample and synthetic volumes through each stage of the pipeline.
+
+    Sample MRIs go through every stage, from loading to saving. Synthetic
+    volumes are loaded, then synthetic crops start at the preprocessing, as
+    ROILoc cannot locate anything in noise.
+
+    Args:
+        cfg (DictConfig): Configuration.
+
+    Returns:
+        dict: Report, with the environment and one record per stage.
+    """
+    bench_cfg = cfg.get("bench", {})
+    recorder = StageRecorder(bench_cfg.get("repeats", 3))
+    batch_sizes = list(
+        bench_cfg.get("batch_sizes") or
+        [cfg.hardware.engine_settings.batch_size])
+
+    mris = []
+    if not OmegaConf.is_missing(cfg.files, "path") and cfg.files.path:
+        mris = load_from_config(cfg.files.path, cfg.files.pattern)
+        mris = mris[:bench_cfg.get("num_volumes", 1)]
+
+    threads = configure_from_config(cfg, jobs=1)
+    engines, models = {}, []
+    with tempfile.TemporaryDirectory() as tmp:
+        output_dir = Path(tmp)
+        try:
+            for batch_size in batch_sizes:
+                settings = OmegaConf.merge(
+                    budget_engine_settings(cfg.hardware.engine,
+                                           cfg.hardware.engine_settings,
+                                           threads), {"batch_size": batch_size})
+                engines[batch_size] = InferenceEnginePool(
+                    cfg.segmentation.models_path,
+                    engine_name=cfg.hardware.engine,
+                    engine_settings=settings)
+            models = [Path(engine.model).name for engine in engines[batch_size]]
+
+            for mri in mris:
+                info = {"input": mri.name}
+                image, mask = recorder.run(
+                    "get_mri",
+                    lambda: get_mri(mri, cfg.files.mask_pattern),
+                    **info)
+                if image.orientation != "LPI":
+                    image = ants.reorient_image2(image, orientation="LPI")
+
+                _, right, _ = recorder.run(
+                    "roiloc",
+                    lambda: get_hippocampi(image, cfg.roiloc, mask),
+                    **info)
+                bench_crop(recorder, right, engines, cfg, batch_sizes,
+                           output_dir, f"{mri.name.split('.')[0]}_right")
+
+            synthetic = bench_cfg.get("synthetic", {})
+            for shape in synthetic.get("volumes", []):
+                name = "x".join(map(str, shape))
+                path = output_dir / f"synthetic_{name}.nii.gz"
+                ants.image_write(
+                    synthetic_volume(shape, synthetic.get("spacing", [1.] * 3)),
+                    str(path))
+                recorder.run("get_mri",
+                             lambda: get_mri(path),
+                             input=f"synthetic_{name}")
+
+            for shape in synthetic.get("crops", []):
+                crop = synthetic_volume(
+                    shape, synthetic.get("crop_spacing", [0.4, 2., 0.4]))
+                bench_crop(recorder, crop, engines, cfg, batch_sizes,
+                           output_dir, f"synthetic_{'x'.join(map(str, shape))}")
+        finally:
+            for pool in engines.values():
+                pool.close()
+
+    return {
+        "version": __version__,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "python": platform.python_version(),
+            "torch_threads": torch.get_num_threads(),
+            "thread_budget": threads,
+        },
+        "engine": cfg.hardware.engine,
+        "engine_settings": OmegaConf.to_container(cfg.hardware.engine_settings),
+        "segmentation": {
+            "models": models,
+            "test_time_num_aug": cfg.segmentation.segmentation.test_time_num_aug,
+            "batched_augmentation": cfg.augmentation.get("batched", False),
+        },
+        "stages": recorder.results,
+    }
+
+
+@hydra.main(config_path="conf", config_name="config", version_base="1.1")
+def main(cfg: DictConfig) -> None:
+    fetch_models_from_config(cfg)
+
+    report = bench(cfg)
+
+    output = Path(to_absolute_path(cfg.bench.get("output", "hsf_bench.json")))
+    output.write_text(json.dumps(report, indent=2))
+    log.info(f"Benchmark saved to {output}")
+
+
+def start():
+    main()
@@ -0,0 +1,199 @@
+import io
+import json
+import logging
+import os
+import tarfile
+from pathlib import Path, PosixPath
+from typing import Dict, List, Optional
+
+import hydra
+import xxhash
+from hydra.utils import to_absolute_path
+from omegaconf import DictConfig, OmegaConf
+from rich.logging import RichHandler
+
+from hsf import __version__
+from hsf.fetch_models import (DOWNLOAD_CHUNK_SIZE, fetch_all, file_identity,
+                              get_model_hash, update_verification_cache)
+
+FORMAT = "%(message)s"
+logging.basicConfig(level=logging.INFO,
+                    format=FORMAT,
+                    datefmt="[%X]",
+                    handlers=[RichHandler()])
+
+log = logging.getLogger(__name__)
+
+PRESETS_DIR = Path(__file__).parent / "conf" / "segmentation"
+MANIFEST = "bundle.json"
+
+
+def load_presets(names: Optional[List[str]] = None) -> Dict[str, DictConfig]:
+    """
+    Loads segmentation presets from `conf/segmentation`.
+
+    Args:
+        names (List[str], optional): Names of the presets (e.g.
+            "bagging_accurate"). Defaults to all the presets but the
+            previous versions (`*.prev`), whose models have the same names as
+            the current ones.
+
+    Returns:
+        Dict[str, DictConfig]: Configuration of each preset.
+    """
+    available = {path.stem: path for path in sorted(PRESETS_DIR.glob("*.yaml"))}
+    if names is None:
+        names = [name for name in available if not name.endswith(".prev")]
+
+    unknown = set(names) - set(available)
+    if unknown:
+        raise ValueError(f"Unknown segmentation presets: {sorted(unknown)}")
+
+    return {name: OmegaConf.load(available[name]) for name in names}
+
+
+def bundle_manifest(presets: Dict[str, DictConfig]) -> dict:
+    """
+    Describes the models of the presets, and checks that they can be
+    installed together.
+
+    Args:
+        presets (Dict[str, DictConfig]): Configuration of each preset.
+
+    Returns:
+        dict: Version of HSF, and directory and models of each preset.
+    """
+    installed = {}
+    manifest = {"hsf": __version__, "presets": {}}
+    for name, preset in presets.items():
+        models = OmegaConf.to_container(preset.models, resolve=True)
+        for filename, model in models.items():
+            path = Path(preset.models_path).expanduser() / filename
+            other = installed.setdefault(path, (name, model["xxh3_64"]))
+            if other[1] != model["xxh3_64"]:
+                raise ValueError(f"Presets {other[0]} and {name} need "
+                                 f"different versions of {path}.")
+
+        manifest["presets"][name] = {
+            "models_path": preset.models_path,
+            "models": models
+        }
+
+    return manifest
+
+
+def export_bundle(output: PosixPath, presets: Dict[str, DictConfig]) -> None:
+    """
+    Downloads the models of the presets, and writes them with their
+    configuration into a single tar archive, to install them on compute
+    nodes without internet access. Models shared by several presets are
+    stored once.
+
+    Args:
+        output (PosixPath): Path of the bundle.
+        presets (Dict[str, DictConfig]): Configuration of each preset.
+    """
+    manifest = bundle_manifest(presets)
+
+    paths = {}
+    for preset in manifest["presets"].values():
+        for filename, model in preset["models"].items():
+            paths.setdefault(model["xxh3_64"],
+                             (preset["models_path"], filename, model["url"]))
+    fetch_all((directory, filename, url, xxh3_64)
+              for xxh3_64, (directory, filename, url) in paths.items())
+
+    output = Path(output).expanduser()
+    tmp = output.with_name(f"{output.name}.part")
+    with tarfile.open(tmp, "w") as tar:
+        data = json.dumps(manifest, indent=2).encode()
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+        for xxh3_64, (directory, filename, _) in paths.items():
+            tar.add(Path(directory).expanduser() / filename,
+                    arcname=f"models/{xxh3_64}.onnx")
+    os.replace(tmp, output)
+
+    log.info(f"Exported {len(paths)} models of {len(presets)} presets to "
+             f"{output}")
+
+
+def _extract_model(tar: tarfile.TarFile, xxh3_64: str,
+                   outfile: PosixPath) -> None:
+    member = tar.getmember(f"models/{xxh3_64}.onnx")
+    partfile = outfile.with_name(f"{outfile.name}.part")
+
+    xxh = xxhash.xxh3_64()
+    source = tar.extractfile(member)
+    with open(partfile, "wb") as f:
+        for chunk in iter(lambda: source.read(DOWNLOAD_CHUNK_SIZE), b""):
+            f.write(chunk)
+            xxh.update(chunk)
+
+    if xxh.hexdigest() != xxh3_64:
+        partfile.unlink()
+        raise Exception(f"xxh3_64 checksum failed for {outfile.name}")
+    os.replace(partfile, outfile)
+
+
+def import_bundle(bundle: PosixPath) -> int:
+    """
+    Installs the models of a bundle in the `models_path` of their presets,
+    where `hsf` looks for them. Up to date models are kept.
+
+    Args:
+        bundle (PosixPath): Path of the bundle, from `export_bundle`.
+
+    Returns:
+        int: Number of installed models.
+    """
+    installed = 0
+    with tarfile.open(Path(bundle).expanduser(), "r") as tar:
+        manifest = json.load(tar.extractfile(MANIFEST))
+
+        for name, preset in manifest["presets"].items():
+            directory = Path(preset["models_path"]).expanduser()
+            directory.mkdir(parents=True, exist_ok=True)
+
+            for filename, model in preset["models"].items():
+                if Path(filename).name != filename:
+                    raise ValueError(f"Invalid model name in {name}: "
+                                     f"{filename}")
+                outfile = directory / filename
+                xxh3_64 = model["xxh3_64"]
+                if outfile.exists() and get_model_hash(outfile) == xxh3_64:
+                    continue
+
+                _extract_model(tar, xxh3_64, outfile)
+                update_verification_cache(outfile, {
+                    "identity": file_identity(str(outfile)),
+                    "xxh3_64": xxh3_64
+                })
+                installed += 1
+
+    log.info(f"Installed {installed} models of "
+             f"{len(manifest['presets'])} presets from {bundle}")
+
+    return installed
+
+
+@hydra.main(config_path="conf", config_name="config", version_base="1.1")
+def main(cfg: DictConfig) -> None:
+    bundle_cfg = cfg.get("bundle", {})
+    if bundle_cfg.get("output"):
+        presets = bundle_cfg.get("presets")
+        export_bundle(
+            Path(to_absolute_path(os.path.expanduser(bundle_cfg.output))),
+            load_presets(list(presets) if presets is not None else None))
+    elif bundle_cfg.get("input"):
+        import_bundle(
+            Path(to_absolute_path(os.path.expanduser(bundle_cfg.input))))
+    else:
+        raise ValueError("Either bundle.output (to export the models) or "
+                         "bundle.input (to install them) is required.")
+
+
+def start():
+    main()
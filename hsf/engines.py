@@ -1,10 +1,19 @@
+import json
+import os
+import platform
 from pathlib import Path, PosixPath
-from typing import Generator
+from typing import Callable, Dict, Generator, Iterator, List, Sequence
+
+import numpy as np
 
 import onnxruntime as ort
+import xxhash
 from omegaconf.dictconfig import DictConfig
 from omegaconf.listconfig import ListConfig
 
+from hsf.fetch_models import get_model_hash
+from hsf.quantization import get_model_variant
+
 # If DeepSparse is installed, import it
 try:
     import deepsparse
@@ -47,6 +56,157 @@ def print_deepsparse_support():
         deepsparse_support())
 
 
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+THREAD_LAYOUT_KEYS = ("intra_op_num_threads", "inter_op_num_threads",
+                      "execution_mode")
+
+
+def machine_key(providers: Sequence) -> str:
+    """
+    Identifies the machine and execution providers a tuning or an optimized
+    graph is valid for.
+
+    Args:
+        providers (Sequence): Execution providers.
+
+    Returns:
+        str: Key of the machine.
+    """
+    return f"{platform.node()}-{platform.machine()}-{os.cpu_count()}-" + \
+        "+".join(str(p if isinstance(p, str) else p[0]) for p in providers)
+
+
+def load_thread_layout(path: PosixPath, providers: Sequence) -> dict:
+    """
+    Loads the thread layout picked by `hsf-autotune` for this machine.
+
+    Args:
+        path (PosixPath): Path to the autotune file.
+        providers (Sequence): Execution providers.
+
+    Returns:
+        dict: Tuned session options, empty if the machine was never tuned.
+    """
+    path = Path(path).expanduser()
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f).get(machine_key(providers), {})
+
+
+def get_session_options(options: DictConfig,
+                        providers: Sequence = ()) -> ort.SessionOptions:
+    """
+    Builds the ONNXRuntime session options from `engine_settings.session_options`.
+
+    Args:
+        options (DictConfig): Session options. Missing keys keep
+            ONNXRuntime's defaults.
+        providers (Sequence): Execution providers, to look up the tuned
+            thread layout if `use_autotune` is set.
+
+    Returns:
+        ort.SessionOptions: Session options.
+    """
+    options = dict(options or {})
+    if options.get("use_autotune", False):
+        options.update(
+            load_thread_layout(
+                options.get("autotune_file", "~/.hsf/autotune.json"),
+                providers))
+
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = options.get("intra_op_num_threads", 0)
+    sess_options.inter_op_num_threads = options.get("inter_op_num_threads", 0)
+    sess_options.execution_mode = EXECUTION_MODES[options.get(
+        "execution_mode", "sequential")]
+    sess_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[
+        options.get("graph_optimization_level", "all")]
+    sess_options.enable_cpu_mem_arena = options.get("enable_cpu_mem_arena",
+                                                    True)
+    sess_options.enable_mem_pattern = options.get("enable_mem_pattern", True)
+
+    return sess_options
+
+
+def optimized_model_path(model: PosixPath, providers: Sequence,
+                         options: DictConfig) -> PosixPath:
+    """
+    Returns where the offline-optimized graph of a model is cached.
+
+    Optimized graphs may contain nodes specific to an execution provider and
+    a CPU, so they are keyed by the source model, the machine, the
+    optimization level and the ONNXRuntime version.
+
+    Args:
+        model (PosixPath): Path to the model.
+        providers (Sequence): Execution providers.
+        options (DictConfig): Session options.
+
+    Returns:
+        PosixPath: Path to the optimized model, in `optimized/` next to the
+            original.
+    """
+    model = Path(model)
+    xxh = xxhash.xxh3_64()
+    xxh.update(
+        json.dumps([
+            machine_key(providers),
+            (options or {}).get("graph_optimization_level", "all"),
+            ort.__version__
+        ]).encode())
+
+    return model.parent / "optimized" / \
+        f"{model.stem}_{get_model_hash(str(model))}_{xxh.hexdigest()}.onnx"
+
+
+def run_padded(x: np.ndarray, batch_sizes: Sequence[int],
+               run: Callable) -> List[np.ndarray]:
+    """
+    Runs a model compiled for fixed batch sizes on a batch of any size.
+
+    The batch is split into chunks of the compiled sizes. Each chunk uses the
+    smallest size that fits it, or the largest one. The last partial chunk is
+    padded with zeros, and the padded outputs are dropped.
+
+    Args:
+        x (np.ndarray): Input batch.
+        batch_sizes (Sequence[int]): Compiled batch sizes.
+        run (Callable): Called with (batch_size, chunk), returns the list of
+            outputs of the model compiled for `batch_size`.
+
+    Returns:
+        List[np.ndarray]: Outputs of the model for the whole batch.
+    """
+    outputs = []
+    start = 0
+    while start < len(x):
+        remaining = len(x) - start
+        size = min((b for b in batch_sizes if b >= remaining),
+                   default=max(batch_sizes))
+        chunk = x[start:start + size]
+        n = len(chunk)
+        if n < size:
+            padding = np.zeros((size - n, *chunk.shape[1:]), dtype=chunk.dtype)
+            chunk = np.concatenate([chunk, padding])
+
+        outputs.append([output[:n] for output in run(size, chunk)])
+        start += n
+
+    return [np.concatenate(parts) for parts in zip(*outputs)]
+
+
 def get_inference_engines(models_path: PosixPath, engine_name: str,
                           engine_settings: DictConfig) -> Generator:
     """
@@ -68,12 +228,56 @@ def get_inference_engines(models_path: PosixPath, engine_name: str,
     p = Path(models_path).expanduser()
     models = list(p.glob("*.onnx"))
 
+    precision = engine_settings.get("precision", "fp32")
+    if engine_name == "onnxruntime" and precision != "fp32":
+        models = [get_model_variant(model, precision) for model in models]
+
     for model in models:
         yield InferenceEngine(engine_name=engine_name,
                               engine_settings=engine_settings,
                               model=model)
 
 
+class InferenceEnginePool:
+    """
+    Pool of Inference Engines kept alive for a whole run.
+
+    Sessions are created (or compiled, for DeepSparse) once, then reused
+    for every subject and every side. They are released by `close()`,
+    or when leaving the context manager.
+
+    Args:
+        models_path (PosixPath): Path to the models.
+        engine_name (str): Name of the engine. Can be "onnxruntime" or "deepsparse".
+        engine_settings (DictConfig): Engine settings.
+    """
+
+    def __init__(self, models_path: PosixPath, engine_name: str,
+                 engine_settings: DictConfig):
+        self.engines: List[InferenceEngine] = list(
+            get_inference_engines(models_path,
+                                  engine_name=engine_name,
+                                  engine_settings=engine_settings))
+
+    def __iter__(self) -> Iterator["InferenceEngine"]:
+        return iter(self.engines)
+
+    def __len__(self) -> int:
+        return len(self.engines)
+
+    def __enter__(self) -> "InferenceEnginePool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Releases every session held by the pool."""
+        for engine in self.engines:
+            engine.close()
+        self.engines = []
+
+
 class InferenceEngine:
     """
     Base class for inference engines.
@@ -89,6 +293,7 @@ class InferenceEngine:
         self.engine_name = engine_name
         self.engine_settings = engine_settings
         self.model = model
+        self._model_hash = None
 
         if engine_name == "deepsparse":
             print_deepsparse_support()
@@ -100,12 +305,95 @@ class InferenceEngine:
 
     def __call__(self, x):
         if self.engine_name == "onnxruntime":
-            feed_names = [i.name for i in self.engine.get_inputs()]
-            assert len(feed_names) == 1, "Only one input is supported"
-            return self.engine.run(None, {feed_names[0]: x})
+            return self.engine.run(None, {self.input_name: x})
 
         if self.engine_name == "deepsparse":
-            return self.engine.run([x])
+            if len(x) == self.engine_settings.batch_size:
+                return self.engine.run([x])
+            return run_padded(
+                x, list(self.engines),
+                lambda size, chunk: self.engines[size].run([chunk]))
+
+    def input_buffer(self, shape: Sequence[int]) -> np.ndarray:
+        """
+        Returns an input batch to fill in place, reused by the next calls
+        with the same shape when IOBinding is enabled.
+
+        Args:
+            shape (Sequence[int]): Shape of the batch, in NCHWD format.
+
+        Returns:
+            np.ndarray: Uninitialized float32 batch.
+        """
+        shape = tuple(shape)
+        if self.engine_name != "onnxruntime" or self._binding is None:
+            return np.empty(shape, dtype=np.float32)
+        buffer = self._buffer(shape)
+        if buffer[0] is None:
+            buffer[0] = np.empty(shape, dtype=np.float32)
+        return buffer[0]
+
+    def _buffer(self, shape: tuple) -> list:
+        if shape not in self._buffers:
+            # Only full batches and the last partial one are worth keeping
+            if len(self._buffers) >= 2:
+                del self._buffers[next(iter(self._buffers))]
+            self._buffers[shape] = [None, None]
+        return self._buffers[shape]
+
+    def infer(self, x: np.ndarray) -> np.ndarray:
+        """
+        Runs the model on a batch and returns its first output.
+
+        With `engine_settings.io_binding`, the batch and the output are bound
+        to ONNXRuntime without copies, and the output is a preallocated
+        buffer, overwritten by the next call with the same input shape.
+
+        Args:
+            x (np.ndarray): Input batch in NCHWD format.
+
+        Returns:
+            np.ndarray: First output of the model.
+        """
+        if self.engine_name != "onnxruntime" or self._binding is None:
+            return self(x)[0]
+
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        buffer = self._buffer(x.shape)
+        output = buffer[1]
+
+        self._binding.clear_binding_inputs()
+        self._binding.clear_binding_outputs()
+        self._binding.bind_input(self.input_name, "cpu", 0, np.float32,
+                                 x.shape, x.ctypes.data)
+        if output is None:
+            # The output shape is only known after a first run
+            self._binding.bind_output(self.output_names[0], "cpu")
+        else:
+            self._binding.bind_output(self.output_names[0], "cpu", 0,
+                                      np.float32, output.shape,
+                                      output.ctypes.data)
+        self.engine.run_with_iobinding(self._binding)
+
+        if output is None:
+            # Copied once, so that the buffer is owned by numpy
+            output = buffer[1] = self._binding.get_outputs()[0].numpy().copy()
+
+        return output
+
+    @property
+    def model_hash(self) -> str:
+        """xxh3_64 of the model, computed on first access."""
+        if self._model_hash is None:
+            self._model_hash = get_model_hash(str(self.model))
+        return self._model_hash
+
+    def close(self):
+        """Releases the underlying session."""
+        self.engine = None
+        self.engines = {}
+        self._binding = None
+        self._buffers = {}
 
     def set_deepsparse_engine(self, model: PosixPath):
         """
@@ -114,10 +402,19 @@ class InferenceEngine:
         Args:
             model (PosixPath): Path to the model.
         """
-        self.engine = deepsparse.compile_model(
-            str(model),
-            batch_size=self.engine_settings.batch_size,
-            num_cores=self.engine_settings.num_cores)
+        batch_sizes = {self.engine_settings.batch_size}
+        batch_sizes.update(self.engine_settings.get("extra_batch_sizes", []))
+
+        # DeepSparse fixes the batch size at compile time
+        self.engines: Dict[int, object] = {
+            batch_size:
+                deepsparse.compile_model(
+                    str(model),
+                    batch_size=batch_size,
+                    num_cores=self.engine_settings.num_cores)
+            for batch_size in sorted(batch_sizes)
+        }
+        self.engine = self.engines[self.engine_settings.batch_size]
 
     def set_ort_engine(self, model):
         """
@@ -141,4 +438,40 @@ class InferenceEngine:
             _correct_provider(provider)
             for provider in self.engine_settings.execution_providers
         ]
-        self.engine = ort.InferenceSession(str(model), providers=providers)
+        options = self.engine_settings.get("session_options", {})
+        sess_options = get_session_options(options, providers)
+
+        if not options.get("cache_optimized_model", False) or \
+                options.get("graph_optimization_level", "all") == "disable":
+            self.engine = ort.InferenceSession(str(model),
+                                               sess_options=sess_options,
+                                               providers=providers)
+        else:
+            # Hashes the model, so only when caching
+            optimized = optimized_model_path(model, providers, options)
+            if optimized.exists():
+                # Already optimized offline, only the session is left to
+                # create
+                sess_options.graph_optimization_level = \
+                    ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+                self.engine = ort.InferenceSession(str(optimized),
+                                                   sess_options=sess_options,
+                                                   providers=providers)
+            else:
+                optimized.parent.mkdir(parents=True, exist_ok=True)
+                tmp = optimized.with_suffix(f".tmp{os.getpid()}.onnx")
+                sess_options.optimized_model_filepath = str(tmp)
+                self.engine = ort.InferenceSession(str(model),
+                                                   sess_options=sess_options,
+                                                   providers=providers)
+                if tmp.exists():
+                    os.replace(tmp, optimized)
+
+        inputs = self.engine.get_inputs()
+        assert len(inputs) == 1, "Only one input is supported"
+        self.input_name = inputs[0].name
+        self.output_names = [output.name for output in self.engine.get_outputs()]
+
+        self._binding = self.engine.io_binding() if self.engine_settings.get(
+            "io_binding", False) else None
+        self._buffers: Dict[tuple, list] = {}
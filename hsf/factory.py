@@ -1,21 +1,39 @@
 import logging
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path, PosixPath
-from typing import Generator, List, Optional
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import ants
 import hydra
+import numpy as np
 import torch
+from hydra.utils import to_absolute_path
 from omegaconf import DictConfig
 from rich.logging import RichHandler
-from roiloc.locator import RoiLocator
 
-from hsf.engines import get_inference_engines
-from hsf.fetch_models import fetch_models
+from hsf.aggregation import EnsembleAggregator
+from hsf.async_io import AsyncWriter, prefetch, write_image
+from hsf.engines import InferenceEnginePool
+from hsf.fetch_models import fetch_models_from_config
+from hsf.logits import LogitsCache
+from hsf.manifest import RunManifest, config_hash
 from hsf.multispectrality import (get_additional_hippocampi,
-                                  get_second_contrast, register)
-from hsf.roiloc_wrapper import (get_hippocampi, get_mri, load_from_config,
-                                save_hippocampi)
-from hsf.segment import mri_to_subject, save_prediction, segment
+                                  get_second_contrast, register,
+                                  register_crops)
+from hsf.roiloc_wrapper import (get_hippocampi, get_hippocampi_paths,
+                                get_mri, load_from_config, native_indices,
+                                save_hippocampi, to_native_space)
+from hsf.segment import (mri_to_subject, prediction_path, save_prediction,
+                         segment_sides)
+from hsf.server import RemoteEnginePool
+from hsf.sharding import get_run_manifest, select_shard
+from hsf.threads import budget_engine_settings, configure_from_config
+from hsf.threads import configure as configure_threads
+from hsf.threads import get_budget
+from hsf.tracing import (configure as configure_tracer, print_summary,
+                         read_trace, span)
 from hsf.uncertainty import voxelwise_uncertainty
 from hsf.welcome import welcome
 
@@ -27,126 +45,324 @@ logging.basicConfig(level=logging.INFO,
 
 log = logging.getLogger(__name__)
 
+# Engines, writer and manifest owned by a worker process of the
+# subject-level pool
+_WORKER_ENGINES = None
+_WORKER_WRITER = None
+_WORKER_MANIFEST = None
 
-def get_lr_hippocampi(mri: PosixPath, cfg: DictConfig) -> tuple:
+
+def get_lr_hippocampi(mri: PosixPath,
+                      cfg: DictConfig,
+                      loaded: Optional[tuple] = None,
+                      writer: Optional[AsyncWriter] = None) -> tuple:
     """
     Get left and right hippocampi from a given MRI.
 
     Args:
         mri (PosixPath): Path to the MRI.
         cfg (DictConfig): Configuration.
+        loaded (tuple, optional): The MRI and its mask, if already loaded
+            (e.g. prefetched).
+        writer (AsyncWriter, optional): Write-behind queue.
 
     Returns:
-        tuple: Tuple containing locator, orientation, left and right hippocampi.
+        tuple: Tuple containing locator, the MRI in its original orientation,
+            paths to the right and left hippocampi, and the hippocampi
+            themselves.
     """
-    image, bet_mask = get_mri(mri, cfg.files.mask_pattern)
+    if loaded is None:
+        loaded = get_mri(mri, cfg.files.mask_pattern)
+    image, bet_mask = loaded
     log.info(image)
-    original_orientation = image.orientation
+    native = image
 
-    if original_orientation != "LPI":
+    if image.orientation != "LPI":
         log.warning(
             "The image is not in LPI orientation, we encourage you to save it in LPI."
         )
         image = ants.reorient_image2(image, orientation="LPI")
 
     log.info("Started locating left and right hippocampi...")
-    locator, right_mri, left_mri = get_hippocampi(mri=image,
-                                                  roiloc_cfg=cfg.roiloc,
-                                                  mask=bet_mask)
+    locator, right_mri, left_mri = get_hippocampi(
+        mri=image,
+        roiloc_cfg=cfg.roiloc,
+        mask=bet_mask,
+        cache_cfg=cfg.get("cache", {}).get("roiloc"))
+
+    if cfg.files.get("save_crops", True):
+        log.info("Saving left and right hippocampi (LPI orientation)...")
+        hippocampi = save_hippocampi(right_mri=right_mri,
+                                     left_mri=left_mri,
+                                     dir_name=cfg.files.output_dir,
+                                     original_mri_path=mri,
+                                     writer=writer)
+    else:
+        hippocampi = get_hippocampi_paths(dir_name=cfg.files.output_dir,
+                                          original_mri_path=mri)
+
+    return locator, native, hippocampi, (right_mri, left_mri)
+
+
+def get_engine_pool(cfg: DictConfig):
+    """
+    Builds the engines of a run: a local InferenceEnginePool, or the engines
+    of an HSF server if `server.url` is set.
+
+    Args:
+        cfg (DictConfig): Configuration.
+
+    Returns:
+        Union[InferenceEnginePool, RemoteEnginePool]: The engines.
+    """
+    server_cfg = cfg.get("server", {})
+    url = server_cfg.get("url")
+    if url:
+        log.info(f"Using the models served by {url}")
+        return RemoteEnginePool(url, server_cfg.get("timeout"))
 
-    log.info("Saving left and right hippocampi (LPI orientation)...")
-    return locator, original_orientation, save_hippocampi(
-        right_mri=right_mri,
-        left_mri=left_mri,
-        dir_name=cfg.files.output_dir,
-        original_mri_path=mri)
+    return InferenceEnginePool(cfg.segmentation.models_path,
+                               engine_name=cfg.hardware.engine,
+                               engine_settings=budget_engine_settings(
+                                   cfg.hardware.engine,
+                                   cfg.hardware.engine_settings,
+                                   get_budget()))
 
 
-def predict(mri: PosixPath, second_mri: Optional[PosixPath],
-            engines: Generator, cfg: DictConfig) -> tuple:
+def get_writer(cfg: DictConfig) -> AsyncWriter:
+    """
+    Builds the queue writing the outputs, from `files.compression_level`
+    and `hardware.async_io`.
+
+    Args:
+        cfg (DictConfig): Configuration.
+
+    Returns:
+        AsyncWriter: Write-behind queue.
+    """
+    return AsyncWriter(compression_level=cfg.files.get("compression_level", 6),
+                       asynchronous=cfg.hardware.get("async_io", True))
+
+
+def get_logits_cache(mri: PosixPath,
+                     cfg: DictConfig) -> Optional[LogitsCache]:
+    """
+    Returns the cache of raw per-model predictions, if enabled. It is stored
+    next to the hippocampal crops.
+
+    Args:
+        mri (PosixPath): Path to a hippocampal crop (which may not be
+            written).
+        cfg (DictConfig): Configuration.
+
+    Returns:
+        Optional[LogitsCache]: The cache, or None if disabled.
+    """
+    logits_cfg = cfg.get("cache", {}).get("logits", {})
+    if not logits_cfg.get("enabled", False):
+        return None
+    return LogitsCache(Path(mri).parent / "logits",
+                       logits_cfg.get("max_size", 1024))
+
+
+def predict(mri: Union[PosixPath, ants.ANTsImage],
+            second_mri: Optional[Union[PosixPath, ants.ANTsImage]],
+            engines: Iterable,
+            cfg: DictConfig,
+            logits_cache: Optional[LogitsCache] = None) -> EnsembleAggregator:
     """
     Predict the hippocampal segmentation for a given MRI.
 
     Args:
-        mri (PosixPath): Path to the MRI.
-        second_mri (PosixPath): Path to the second MRI.
-        engines (Generator): Generator of InferenceEngines.
+        mri (Union[PosixPath, ants.ANTsImage]): The MRI, or its path.
+        second_mri (Union[PosixPath, ants.ANTsImage]): The second MRI, or
+            its path.
+        engines (Iterable): InferenceEngines (e.g. an InferenceEnginePool).
         cfg (DictConfig): Configuration.
+        logits_cache (LogitsCache, optional): Cache of raw predictions.
 
     Returns:
-        tuple: Tuple containing soft and hard segmentations.
+        EnsembleAggregator: Aggregated soft and hard segmentations.
     """
-    if second_mri:
+    if second_mri is not None:
         subjects = [mri_to_subject(mri), mri_to_subject(second_mri)]
     else:
         subjects = [mri_to_subject(mri)]
 
     log.info("Starting segmentation...")
-    return segment(subjects=subjects,
-                   augmentation_cfg=cfg.augmentation,
-                   segmentation_cfg=cfg.segmentation.segmentation,
-                   n_engines=len(cfg.segmentation.models),
-                   engines=engines,
-                   ca_mode=str(cfg.segmentation.ca_mode),
-                   batch_size=cfg.hardware.engine_settings.batch_size)
+    return segment_sides(groups=[subjects],
+                         augmentation_cfg=cfg.augmentation,
+                         segmentation_cfg=cfg.segmentation.segmentation,
+                         n_engines=len(cfg.segmentation.models),
+                         engines=engines,
+                         ca_mode=str(cfg.segmentation.ca_mode),
+                         batch_size=cfg.hardware.engine_settings.batch_size,
+                         logits_cache=logits_cache)[0]
+
+
+def predict_sides(
+        sides: List[tuple],
+        engines: Iterable,
+        cfg: DictConfig,
+        logits_cache: Optional[LogitsCache] = None
+) -> List[EnsembleAggregator]:
+    """
+    Predict the hippocampal segmentations of both sides at once, by batching
+    the crops of every side (and all their augmentations) together.
 
+    Args:
+        sides (List[tuple]): (MRI, second MRI) crops of each side, as images
+            or paths.
+        engines (Iterable): InferenceEngines (e.g. an InferenceEnginePool).
+        cfg (DictConfig): Configuration.
+        logits_cache (LogitsCache, optional): Cache of raw predictions.
 
-def compute_uncertainty(mri: PosixPath, soft_pred: torch.Tensor) -> None:
+    Returns:
+        List[EnsembleAggregator]: Aggregated segmentations of each side.
+    """
+    groups = [[mri_to_subject(mri)] +
+              ([mri_to_subject(second_mri)] if second_mri is not None else [])
+              for mri, second_mri in sides]
+
+    log.info("Starting segmentation of both sides...")
+    return segment_sides(groups=groups,
+                         augmentation_cfg=cfg.augmentation,
+                         segmentation_cfg=cfg.segmentation.segmentation,
+                         n_engines=len(cfg.segmentation.models),
+                         engines=engines,
+                         ca_mode=str(cfg.segmentation.ca_mode),
+                         batch_size=cfg.hardware.engine_settings.batch_size,
+                         logits_cache=logits_cache)
+
+
+def compute_uncertainty(mri: PosixPath,
+                        soft_pred: torch.Tensor,
+                        reference: Optional[ants.ANTsImage] = None,
+                        writer: Optional[AsyncWriter] = None
+                        ) -> torch.Tensor:
     """
     Compute uncertainty for a given set of segmentations.
 
     Args:
         mri (PosixPath): Path to the MRI.
         soft_pred (torch.Tensor): Soft segmentations.
+        reference (ants.ANTsImage, optional): The loaded MRI.
+        writer (AsyncWriter, optional): Write-behind queue.
+
+    Returns:
+        torch.Tensor: Voxel-wise uncertainty map.
     """
     uncertainty = voxelwise_uncertainty(soft_pred)
     log.info(f"Saving voxel-wise uncertainty map in {str(mri.parent)}")
     _ = save_prediction(mri=mri,
                         prediction=uncertainty,
                         suffix="unc_crop",
-                        astype="float64")
+                        astype="float64",
+                        reference=reference,
+                        writer=writer)
+
+    return uncertainty
 
 
-def save(mri: PosixPath, hippocampus: PosixPath, hard_pred: torch.Tensor,
-         locator: RoiLocator, orientation: str) -> None:
+def save(mri: PosixPath,
+         hippocampus: PosixPath,
+         hard_pred: torch.Tensor,
+         native: ants.ANTsImage,
+         reference: Optional[ants.ANTsImage] = None,
+         writer: Optional[AsyncWriter] = None,
+         soft_pred: Optional[torch.Tensor] = None,
+         uncertainty: Optional[torch.Tensor] = None) -> List[PosixPath]:
     """
     Save segmentations.
 
+    The native-space outputs are mapped straight from the crop into the grid
+    and orientation of the original MRI.
+
     Args:
         mri (PosixPath): Path to the MRI.
         hippocampus (PosixPath): Path to the hippocampus.
         hard_pred (torch.Tensor): Hard segmentations.
-        locator (RoiLocator): RoiLocator.
-        orientation (str): Orientation of the original MRI.
-    """
-    log.info("Saving cropped segmentation in LPI orientation.")
-    segmentation = save_prediction(mri=hippocampus,
-                                   prediction=hard_pred,
-                                   suffix="seg_crop")
+        native (ants.ANTsImage): The MRI in its original orientation.
+        reference (ants.ANTsImage, optional): The loaded hippocampus.
+        writer (AsyncWriter, optional): Write-behind queue.
+        soft_pred (torch.Tensor, optional): Soft segmentations, to also save
+            in native space.
+        uncertainty (torch.Tensor, optional): Uncertainty map, to also save
+            in native space.
 
-    native_segmentation = locator.inverse_transform(segmentation)
+    Returns:
+        List[PosixPath]: Paths of the saved segmentations.
+    """
+    if reference is None:
+        reference = ants.image_read(str(hippocampus))
 
-    if orientation != "LPI":
-        log.info("Reorienting segmentation to original orientation...")
-        native_segmentation = ants.reorient_image2(native_segmentation,
-                                                   orientation=orientation)
+    log.info("Saving cropped segmentation in LPI orientation.")
+    _ = save_prediction(mri=hippocampus,
+                        prediction=hard_pred,
+                        suffix="seg_crop",
+                        reference=reference,
+                        writer=writer)
+    output_paths = [prediction_path(hippocampus, "seg_crop")]
+
+    indices = native_indices(reference, native)
+    outputs = {
+        "seg":
+            to_native_space(hard_pred.numpy().astype("uint8"),
+                            reference,
+                            native,
+                            indices=indices)
+    }
+
+    if soft_pred is not None:
+        soft_pred = np.moveaxis(soft_pred.squeeze(0).float().numpy(), 0, -1)
+        # Outside of the crop, everything is background
+        background = np.zeros(soft_pred.shape[-1], dtype=soft_pred.dtype)
+        background[0] = 1.
+        outputs["prob"] = to_native_space(soft_pred,
+                                          reference,
+                                          native,
+                                          background=background,
+                                          indices=indices)
+
+    if uncertainty is not None:
+        outputs["unc"] = to_native_space(uncertainty.float().numpy(),
+                                         reference,
+                                         native,
+                                         indices=indices)
 
     extensions = "".join(hippocampus.suffixes)
-    fname = hippocampus.name.replace(extensions, "") + "_seg.nii.gz"
-    output_path = mri.parent / fname
+    for suffix, image in outputs.items():
+        fname = hippocampus.name.replace(extensions, "") + f"_{suffix}.nii.gz"
+        output_path = mri.parent / fname
 
-    ants.image_write(native_segmentation, str(output_path))
+        if writer:
+            writer.submit(image, output_path)
+        else:
+            write_image(image, output_path)
+        output_paths.append(output_path)
+
+        log.info(f"Saved {suffix} in native space to {str(output_path)}")
 
-    log.info(f"Saved segmentation in native space to {str(output_path)}")
+    return output_paths
 
 
-def filter_mris(mris: List[PosixPath], overwrite: bool) -> List[PosixPath]:
+def filter_mris(mris: List[PosixPath],
+                overwrite: bool,
+                manifest: Optional[RunManifest] = None,
+                config: Optional[str] = None) -> List[PosixPath]:
     """
     Filter mris.
 
+    MRIs known to the manifest are skipped if both of their sides were
+    segmented with the same configuration and their outputs still exist,
+    and resumed otherwise. Only the others are looked up on disk.
+
     Args:
         mris (List[PosixPath]): List of MRI paths.
         overwrite (bool): Overwrite existing segmentations.
+        manifest (RunManifest, optional): Manifest of the previous runs.
+        config (str, optional): Hash of the current configuration, from
+            `config_hash`. Required with a manifest.
 
     Returns:
         List[PosixPath]: List of filtered MRI paths.
@@ -176,31 +392,376 @@ def filter_mris(mris: List[PosixPath], overwrite: bool) -> List[PosixPath]:
     if overwrite:
         return mris
 
-    mris = [mri for mri in mris if len(_get_segmentations(mri)) == 0]
-    return mris
+    if manifest is None:
+        return [mri for mri in mris if len(_get_segmentations(mri)) == 0]
 
+    filtered = []
+    for mri in mris:
+        if manifest.is_done(mri, config):
+            log.info(f"{mri} is already segmented according to "
+                     f"{manifest.path}. Skipping segmentation.")
+        elif manifest.knows(mri) or len(_get_segmentations(mri)) == 0:
+            filtered.append(mri)
+    return filtered
 
-@hydra.main(config_path="conf", config_name="config", version_base="1.1")
-def main(cfg: DictConfig) -> None:
-    fetch_models(cfg.segmentation.models_path, cfg.segmentation.models)
 
-    if cfg.hardware.engine == "deepsparse":
-        tta = cfg.segmentation.segmentation.test_time_num_aug
-        bs = cfg.hardware.engine_settings.batch_size
-        multispectral = 2 if cfg.multispectrality.pattern else 1
+def label_volumes(hard_pred: torch.Tensor,
+                  reference: ants.ANTsImage) -> Dict[str, float]:
+    """
+    Computes the volume of each label of a segmentation.
 
-        if multispectral * (tta + 1) % bs != 0:
-            raise AssertionError(
-                "test_time_num_aug+1 must be a multiple of batch_size for deepsparse"
-            )
+    Args:
+        hard_pred (torch.Tensor): Hard segmentation.
+        reference (ants.ANTsImage): The segmented crop, for its spacing.
+
+    Returns:
+        Dict[str, float]: Volume of each label but the background, in mm3.
+    """
+    counts = torch.bincount(hard_pred.flatten().long())
+    voxel = float(np.prod(reference.spacing))
+    return {
+        str(label): round(count * voxel, 3)
+        for label, count in enumerate(counts.tolist())
+        if label > 0
+    }
+
+
+def _record_when_written(manifest: Optional[RunManifest],
+                         writer: Optional[AsyncWriter], mri: PosixPath,
+                         stage: str, outputs: List[PosixPath],
+                         **info) -> None:
+    """Records a stage in the manifest once its outputs are on disk."""
+    if manifest is None:
+        return
+
+    def _record(errors):
+        manifest.record(mri, stage, outputs, errors, **info)
+
+    if writer:
+        writer.when_written(outputs, _record)
+    else:
+        _record([])
+
+
+def segment_mri(mri: PosixPath,
+                cfg: DictConfig,
+                engines: Iterable,
+                subject: str = "",
+                writer: Optional[AsyncWriter] = None,
+                loaded: Optional[tuple] = None,
+                manifest: Optional[RunManifest] = None) -> None:
+    """
+    Segments both hippocampi of a given MRI.
+
+    With a manifest, each stage is recorded once its outputs are written,
+    and the stages completed by a previous run are skipped.
+
+    Args:
+        mri (PosixPath): Path to the MRI.
+        cfg (DictConfig): Configuration.
+        engines (Iterable): InferenceEngines (e.g. an InferenceEnginePool).
+        subject (str, optional): Progress prefix used in logs.
+        writer (AsyncWriter, optional): Write-behind queue. If None, outputs
+            are written synchronously.
+        loaded (tuple, optional): The MRI and its mask, if already loaded.
+        manifest (RunManifest, optional): Manifest of the run.
+    """
+    with span("subject", subject=mri.name):
+        _segment_mri(mri, cfg, engines, subject, writer, loaded, manifest)
+
+
+def _segment_mri(mri: PosixPath, cfg: DictConfig, engines: Iterable,
+                 subject: str, writer: Optional[AsyncWriter],
+                 loaded: Optional[tuple],
+                 manifest: Optional[RunManifest]) -> None:
+    second_contrast = get_second_contrast(mri, cfg.multispectrality.pattern)
+    completed = manifest.start(mri, config_hash(cfg),
+                               reset=cfg.files.overwrite) if manifest else {}
+
+    # The second contrast is cropped by the locator, which is not saved
+    if "located" in completed and not second_contrast:
+        log.info(f"{subject}resuming from the saved hippocampi.")
+        if loaded is None:
+            loaded = _load_mri(mri, cfg)
+        native = loaded[0]
+        hippocampi = completed["located"]
+        crops = tuple(
+            ants.image_read(str(hippocampus)) for hippocampus in hippocampi)
+    else:
+        with span("roiloc"):
+            locator, native, hippocampi, crops = get_lr_hippocampi(
+                mri, cfg, loaded, writer)
+        if cfg.files.get("save_crops", True):
+            _record_when_written(manifest, writer, mri, "located",
+                                 list(hippocampi))
+    hippocampi = [Path(hippocampus) for hippocampus in hippocampi]
+
+    crop_registration = not cfg.multispectrality.same_space and \
+        cfg.multispectrality.get("registration_mode", "whole") == "crop"
+    if second_contrast and crop_registration:
+        with span("registration", mode="crop"):
+            additional_hippocampi = register_crops(mri, second_contrast,
+                                                   locator, cfg)
+    elif second_contrast:
+        with span("registration"):
+            second_contrast = register(mri, second_contrast, cfg)
+            additional_hippocampi = get_additional_hippocampi(
+                mri, second_contrast, locator, cfg)
+    else:
+        additional_hippocampi = [None, None]
+
+    # Crops are handed over in memory, only the second contrast is read
+    sides = [(crop, Path(second) if second_contrast else None)
+             for crop, second in zip(crops, additional_hippocampi)]
+    logits_cache = get_logits_cache(hippocampi[0], cfg)
+
+    pending = [j for j in range(len(sides)) if f"side_{j+1}" not in completed]
+    if len(pending) < len(sides):
+        log.info(f"{subject}skipping the sides segmented by a previous run.")
+
+    batch_sides = cfg.hardware.get("batch_sides", False)
+    if batch_sides and pending:
+        log.info(f"{subject}both sides")
+        with span("segmentation", side="both"):
+            predictions = dict(
+                zip(
+                    pending,
+                    predict_sides([sides[j] for j in pending], engines, cfg,
+                                  logits_cache)))
+
+    for j in pending:
+        crop, second_hippocampus = sides[j]
+        first_hippocampus = hippocampi[j]
+        if batch_sides:
+            prediction = predictions[j]
+        else:
+            log.info(f"{subject}side {j+1}/2")
+            with span("segmentation", side=j + 1):
+                prediction = predict(crop, second_hippocampus, engines, cfg,
+                                     logits_cache)
+
+        log.info(f"{subject}side {j+1}/2 used {prediction.count} "
+                 "forward passes.")
+
+        uncertainty = None
+        with span("uncertainty", side=j + 1):
+            if prediction.count > 1:
+                uncertainty = compute_uncertainty(first_hippocampus,
+                                                  prediction.mean,
+                                                  reference=crop,
+                                                  writer=writer)
+            elif cfg.files.get("native_uncertainty", False):
+                uncertainty = prediction.uncertainty()
+
+        with span("save", side=j + 1):
+            outputs = save(
+                mri,
+                first_hippocampus,
+                prediction.hard_prediction,
+                native,
+                reference=crop,
+                writer=writer,
+                soft_pred=prediction.mean
+                if cfg.files.get("native_soft", False) else None,
+                uncertainty=uncertainty
+                if cfg.files.get("native_uncertainty", False) else None)
+        if prediction.count > 1:
+            outputs.append(prediction_path(first_hippocampus, "unc_crop"))
+        _record_when_written(manifest,
+                             writer,
+                             mri,
+                             f"side_{j+1}",
+                             outputs,
+                             volumes=label_volumes(prediction.hard_prediction,
+                                                   crop))
+
+
+def _init_worker(cfg: DictConfig, threads: Optional[int] = None) -> None:
+    """
+    Builds the InferenceEnginePool, the writer and the manifest of a worker
+    process, once per process.
+
+    Args:
+        cfg (DictConfig): Configuration.
+        threads (int, optional): Thread budget of the process.
+    """
+    global _WORKER_ENGINES, _WORKER_WRITER, _WORKER_MANIFEST
+    configure_threads(threads)
+    _WORKER_ENGINES = get_engine_pool(cfg)
+    _WORKER_WRITER = get_writer(cfg)
+    # Workers append to the manifest of the main process
+    _WORKER_MANIFEST = get_run_manifest(cfg)
+    # Workers append to the trace started by the main process
+    configure_tracer(get_trace_cfg(cfg))
+
+
+def _segment_in_worker(mri: PosixPath, cfg: DictConfig,
+                       subject: str) -> Tuple[PosixPath, Optional[str]]:
+    """
+    Segments an MRI inside a worker process.
+
+    Args:
+        mri (PosixPath): Path to the MRI.
+        cfg (DictConfig): Configuration.
+        subject (str): Progress prefix used in logs.
+
+    Returns:
+        tuple: The MRI, and the error message if the segmentation failed.
+    """
+    try:
+        segment_mri(mri,
+                    cfg,
+                    _WORKER_ENGINES,
+                    subject,
+                    _WORKER_WRITER,
+                    manifest=_WORKER_MANIFEST)
+    except Exception as e:
+        log.exception(f"Segmentation of {mri} failed.")
+        _WORKER_WRITER.flush()
+        if _WORKER_MANIFEST:
+            _WORKER_MANIFEST.fail(mri, f"{type(e).__name__}: {e}")
+        return mri, f"{type(e).__name__}: {e}"
+
+    # The last writes overlap the localization of the next subject
+    errors = _WORKER_WRITER.flush()
+    if errors:
+        return mri, "; ".join(error for _, error in errors)
+    return mri, None
+
+
+def _load_mri(mri: PosixPath, cfg: DictConfig) -> tuple:
+    with span("get_mri", subject=mri.name):
+        return get_mri(mri, cfg.files.mask_pattern)
+
+
+def get_trace_cfg(cfg: DictConfig) -> Optional[DictConfig]:
+    """
+    Returns the trace configuration, with an absolute path so that it does
+    not depend on Hydra's working directory.
+
+    Args:
+        cfg (DictConfig): Configuration.
+
+    Returns:
+        Optional[DictConfig]: Trace configuration, None if disabled.
+    """
+    trace_cfg = cfg.get("trace")
+    if not trace_cfg or not trace_cfg.get("enabled", False):
+        return None
+
+    trace_cfg = trace_cfg.copy()
+    trace_cfg.path = to_absolute_path(str(Path(trace_cfg.path).expanduser()))
+    return trace_cfg
+
+
+def run_cohort(
+        mris: List[PosixPath],
+        cfg: DictConfig,
+        manifest: Optional[RunManifest] = None
+) -> List[Tuple[PosixPath, str]]:
+    """
+    Segments a list of MRIs, either sequentially or over a process pool.
+
+    With `hardware.jobs > 1`, subjects are spread over `jobs` worker
+    processes, each owning its InferenceEnginePool. At most `2 * jobs`
+    subjects are queued at once, so that the preprocessing of the next
+    subjects overlaps the inference of the current ones.
+
+    Args:
+        mris (List[PosixPath]): List of MRI paths.
+        cfg (DictConfig): Configuration.
+        manifest (RunManifest, optional): Manifest of the run. Worker
+            processes open their own.
+
+    Returns:
+        List[Tuple[PosixPath, str]]: Failed MRIs (or outputs that could not
+            be written) with their error message.
+    """
+    N = len(mris)
+    jobs = min(cfg.hardware.get("jobs", 1), N)
+    failures = []
+    # Also exported to the environment inherited by the workers
+    threads = configure_from_config(cfg, max(jobs, 1))
+
+    if jobs <= 1:
+        with get_engine_pool(cfg) as engines, get_writer(cfg) as writer:
+            # The next MRI is read while the current one is segmented
+            loader = prefetch(mris, lambda mri: _load_mri(mri, cfg))
+            for i, (mri, loaded) in enumerate(loader):
+                try:
+                    segment_mri(mri, cfg, engines, f"Subject {i+1}/{N}, ",
+                                writer, loaded.result(), manifest)
+                except Exception as e:
+                    log.exception(f"Segmentation of {mri} failed.")
+                    failures.append((mri, f"{type(e).__name__}: {e}"))
+                    if manifest:
+                        manifest.fail(mri, failures[-1][1])
+                failures.extend(
+                    (Path(path), error) for path, error in writer.collect())
+            failures.extend(
+                (Path(path), error) for path, error in writer.flush())
+        return failures
+
+    log.info(f"Segmenting subjects over {jobs} worker processes.")
+    # Spawned workers do not inherit the thread pools of ANTs/ORT
+    context = multiprocessing.get_context("spawn")
+    queue = list(enumerate(mris))
+    while queue:
+        # A worker that dies (e.g. OOM) breaks the pool: the subjects it was
+        # running with fail, and the remaining ones go to a new pool
+        broken = False
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 mp_context=context,
+                                 initializer=_init_worker,
+                                 initargs=(cfg, threads)) as executor:
+            submitted = {}
+            while queue or submitted:
+                if queue and not broken and len(submitted) < 2 * jobs:
+                    i, mri = queue.pop(0)
+                    try:
+                        future = executor.submit(_segment_in_worker, mri,
+                                                 cfg, f"Subject {i+1}/{N}, ")
+                    except BrokenProcessPool:
+                        queue.insert(0, (i, mri))
+                        broken = True
+                        continue
+                    submitted[future] = mri
+                    continue
+                if not submitted:
+                    break
+                done, _ = wait(submitted, return_when=FIRST_COMPLETED)
+                for future in done:
+                    mri = submitted.pop(future)
+                    try:
+                        failures.append(future.result())
+                    except Exception as e:
+                        broken |= isinstance(e, BrokenProcessPool)
+                        log.error(f"Segmentation of {mri} failed: "
+                                  f"{type(e).__name__}: {e}")
+                        failures.append((mri, f"{type(e).__name__}: {e}"))
+                        if manifest:
+                            manifest.fail(mri, failures[-1][1])
+
+    return [(mri, error) for mri, error in failures if error]
+
+
+@hydra.main(config_path="conf", config_name="config", version_base="1.1")
+def main(cfg: DictConfig) -> None:
+    if not cfg.get("server", {}).get("url"):
+        fetch_models_from_config(cfg)
 
     mris = load_from_config(cfg.files.path, cfg.files.pattern)
+    mris = select_shard(mris, cfg.files.path, cfg.files.get("shard"))
     _n = len(mris)
 
-    mris = filter_mris(mris, cfg.files.overwrite)
+    manifest = get_run_manifest(cfg)
+    mris = filter_mris(mris, cfg.files.overwrite, manifest,
+                       config_hash(cfg))
 
     if len(mris) == 0 and _n > 0:
         log.info("No new MRI found. Skipping segmentation.")
+        if manifest:
+            manifest.close()
         return
 
     log.warning(
@@ -214,41 +775,26 @@ def main(cfg: DictConfig) -> None:
     N = len(mris)
     log.info(f"HSF found {N} MRIs to segment following to your configuration.")
 
-    pattern = cfg.multispectrality.pattern
-    if pattern:
+    if cfg.multispectrality.pattern:
         log.warning("Multispectrality is currently in beta stage.")
 
-    for i, mri in enumerate(mris):
-        second_contrast = get_second_contrast(mri, pattern)
-
-        locator, orientation, hippocampi = get_lr_hippocampi(mri, cfg)
-
-        if second_contrast:
-            second_contrast = register(mri, second_contrast, cfg)
-            additional_hippocampi = get_additional_hippocampi(
-                mri, second_contrast, locator, cfg)
-        else:
-            additional_hippocampi = [None, None]
-
-        for j, hippocampus in enumerate(zip(hippocampi,
-                                            additional_hippocampi)):
-            engines = get_inference_engines(
-                cfg.segmentation.models_path,
-                engine_name=cfg.hardware.engine,
-                engine_settings=cfg.hardware.engine_settings)
-
-            first_hippocampus = Path(hippocampus[0])
-            second_hippocampus = Path(
-                hippocampus[1]) if second_contrast else None
-
-            log.info(f"Subject {i+1}/{N}, side {j+1}/2")
-            soft_pred, hard_pred = predict(first_hippocampus,
-                                           second_hippocampus, engines, cfg)
-
-            if soft_pred.shape[0] > 1:
-                compute_uncertainty(first_hippocampus, soft_pred)
-
-            save(mri, first_hippocampus, hard_pred, locator, orientation)
+    trace_cfg = get_trace_cfg(cfg)
+    tracer = configure_tracer(trace_cfg, truncate=True)
+    try:
+        failures = run_cohort(mris, cfg, manifest)
+    finally:
+        tracer.close()
+        if manifest:
+            manifest.close()
+        if trace_cfg:
+            log.info(f"Trace saved to {trace_cfg.path}")
+            if trace_cfg.get("summary", True):
+                print_summary(read_trace(trace_cfg.path))
+
+    if failures:
+        for mri, error in failures:
+            log.error(f"Failed to segment {mri}: {error}")
+        raise RuntimeError(f"{len(failures)}/{N} MRIs failed to be segmented.")
 
 
 def start():
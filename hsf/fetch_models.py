@@ -1,5 +1,17 @@
+import json
 import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Iterable, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import requests
 import xxhash
@@ -13,6 +25,35 @@ logging.basicConfig(
 
 log = logging.getLogger(__name__)
 
+# Large reads, so that hashing a model is bound by the disk, not by syscalls
+HASH_BUFFER_SIZE = 16 * 1024**2
+
+# Hashes of the verified models, stored next to them
+VERIFICATION_CACHE = ".hsf_verified.json"
+_VERIFICATION_CACHE_LOCK = threading.Lock()
+
+# Models downloaded concurrently
+DOWNLOAD_JOBS = 4
+# Attempts to resume an interrupted download
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_CHUNK_SIZE = 1024**2
+# Seconds without receiving data before a download is interrupted
+DOWNLOAD_TIMEOUT = 60
+
+
+def update_hash(xxh: xxhash.xxh3_64, fname: str) -> None:
+    """
+    Update a hash with the content of a file
+
+    Args:
+        xxh (xxhash.xxh3_64): Hash to update
+        fname (str): Path to file
+    """
+    buffer = memoryview(bytearray(HASH_BUFFER_SIZE))
+    with open(fname, "rb", buffering=0) as f:
+        for n in iter(lambda: f.readinto(buffer), 0):
+            xxh.update(buffer[:n])
+
 
 def get_hash(fname: str) -> str:
     """
@@ -25,13 +66,221 @@ def get_hash(fname: str) -> str:
         str: xxHash3 of file
     """
     xxh = xxhash.xxh3_64()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            xxh.update(chunk)
+    update_hash(xxh, fname)
     return xxh.hexdigest()
 
 
-def fetch(directory: str, filename: str, url: str, xxh3_64: str) -> None:
+def file_identity(fname: str) -> dict:
+    """
+    Identity of a file on disk, which changes whenever the file is replaced
+    or modified.
+
+    Args:
+        fname (str): Path to file
+
+    Returns:
+        dict: Size, modification time and inode of the file
+    """
+    stat = os.stat(fname)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "inode": stat.st_ino
+    }
+
+
+@contextmanager
+def _file_lock(lockfile: Path):
+    """
+    Prevents concurrent jobs, processes included, from entering the same
+    critical section (e.g. writing the same partial download)
+
+    The lock file is removed on release. A job which locked it after it was
+    removed holds a stale lock, and locks the new file instead.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    while True:
+        lock = open(lockfile, "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(lockfile)):
+                break
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+    try:
+        yield
+    finally:
+        lockfile.unlink()
+        lock.close()
+
+
+def _read_verification_cache(directory: Path) -> dict:
+    try:
+        with open(directory / VERIFICATION_CACHE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_verification_cache(path: Path, entry: Optional[dict]) -> None:
+    """
+    Records the hash of a model, or forgets it
+
+    Args:
+        path (Path): Path to the model
+        entry (dict, optional): Identity of the model (see `file_identity`)
+            and its xxHash3, None to remove the model from the cache
+    """
+    directory = path.parent
+    # Downloads of the same process, and other processes (workers, shards,
+    # hsf-server), update the cache concurrently
+    with _VERIFICATION_CACHE_LOCK:
+        try:
+            with _file_lock(directory / f"{VERIFICATION_CACHE}.lock"):
+                _write_verification_cache(directory, path.name, entry)
+        except OSError:
+            # e.g. a read-only shared installation: models are hashed every
+            # time
+            pass
+
+
+def _write_verification_cache(directory: Path, name: str,
+                              entry: Optional[dict]) -> None:
+    entries = _read_verification_cache(directory)
+    if entry is None:
+        entries.pop(name, None)
+    else:
+        entries[name] = entry
+
+    fd, tmp = tempfile.mkstemp(dir=directory,
+                               prefix=f"{VERIFICATION_CACHE}.",
+                               suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        # Atomic, so that readers never see a partial cache
+        os.replace(tmp, directory / VERIFICATION_CACHE)
+    except OSError:
+        Path(tmp).unlink(missing_ok=True)
+
+
+def get_model_hash(fname: str, verify: bool = False) -> str:
+    """
+    Get xxHash3 of a model, without reading it again if it did not change
+    since it was last hashed (same path, size, modification time and inode).
+
+    Args:
+        fname (str): Path to the model
+        verify (bool): Whether to hash the model even if it did not change.
+            Defaults to False.
+
+    Returns:
+        str: xxHash3 of the model
+    """
+    path = Path(fname).expanduser()
+    identity = file_identity(str(path))
+    entry = _read_verification_cache(path.parent).get(path.name, {})
+    if not verify and entry.get("identity") == identity:
+        return entry["xxh3_64"]
+
+    xxh3_64 = get_hash(str(path))
+    update_verification_cache(path, {
+        "identity": identity,
+        "xxh3_64": xxh3_64
+    })
+    return xxh3_64
+
+
+def _download(url: str, partfile: Path, xxh: xxhash.xxh3_64) -> bool:
+    """
+    Download a file, resuming a partial download with a HTTP Range request,
+    and hash it while it is written
+
+    Args:
+        url (str): Url to download the file from
+        partfile (Path): Partial download, appended to
+        xxh (xxhash.xxh3_64): Hash of the whole file, updated
+
+    Returns:
+        bool: Whether a partial download was resumed
+    """
+    offset = partfile.stat().st_size if partfile.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    with requests.get(url,
+                      stream=True,
+                      headers=headers,
+                      timeout=DOWNLOAD_TIMEOUT) as response:
+        if offset and response.status_code == 416:
+            # Nothing left to download
+            update_hash(xxh, str(partfile))
+            return True
+        response.raise_for_status()
+
+        resumed = offset > 0 and response.status_code == 206
+        if resumed:
+            log.info(f"Resuming {url} from {offset} bytes")
+            update_hash(xxh, str(partfile))
+
+        with open(partfile, "ab" if resumed else "wb") as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                xxh.update(chunk)
+
+    return resumed
+
+
+def download(url: str, outfile: Path, xxh3_64: str) -> None:
+    """
+    Download a file to `outfile.part`, retrying from where an interrupted
+    download stopped, and move it to `outfile` once its checksum is valid
+
+    Args:
+        url (str): Url to download the file from
+        outfile (Path): Destination of the file
+        xxh3_64 (str): xxh3_64 of the file
+    """
+    partfile = outfile.with_name(f"{outfile.name}.part")
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        xxh = xxhash.xxh3_64()
+        try:
+            resumed = _download(url, partfile, xxh)
+            break
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            log.warning(f"Download of {url} interrupted ({e}), retrying")
+
+    if resumed and xxh.hexdigest() != xxh3_64:
+        # The partial download was corrupted, or of another version
+        log.warning(f"Checksum of the resumed {outfile.name} failed, "
+                    "downloading it again")
+        partfile.unlink()
+        xxh = xxhash.xxh3_64()
+        _download(url, partfile, xxh)
+
+    if xxh.hexdigest() != xxh3_64:
+        partfile.unlink()
+        raise Exception(f"xxh3_64 checksum failed for {outfile.name}")
+
+    os.replace(partfile, outfile)
+    update_verification_cache(outfile, {
+        "identity": file_identity(str(outfile)),
+        "xxh3_64": xxh3_64
+    })
+
+
+def fetch(directory: str,
+          filename: str,
+          url: str,
+          xxh3_64: str,
+          verify: bool = False) -> None:
     """
     Fetch a model from a url
 
@@ -40,38 +289,82 @@ def fetch(directory: str, filename: str, url: str, xxh3_64: str) -> None:
         filename (str): Filename of model
         url (str): Url to download model from
         xxh3_64 (str): xxh3_64 of model
+        verify (bool): Whether to hash an existing model even if it did not
+            change since its last verification. Defaults to False.
     """
     p = Path(directory).expanduser()
     p.mkdir(parents=True, exist_ok=True)
     outfile = p / filename
 
     if outfile.exists():
-        if get_hash(str(outfile)) == xxh3_64:
+        if get_model_hash(str(outfile), verify) == xxh3_64:
             log.info(f"{filename} already exists and is up to date")
             return
         log.info(f"{filename} already exists but is not up to date")
-        outfile.unlink()
 
-    log.info(f"Fetching {url}")
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-    with open(outfile, "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
-    print("\n")
+    with _file_lock(outfile.with_name(f".{outfile.name}.lock")):
+        # Another job may have downloaded it in the meantime
+        if outfile.exists() and get_model_hash(str(outfile)) == xxh3_64:
+            return
+
+        log.info(f"Fetching {url}")
+        download(url, outfile, xxh3_64)
+
+
+def fetch_all(models: Iterable[Tuple[str, str, str, str]],
+              verify: bool = False,
+              jobs: int = DOWNLOAD_JOBS) -> None:
+    """
+    Fetch models concurrently
 
-    if not xxh3_64 == get_hash(str(outfile)):
-        outfile.unlink()
-        raise Exception("xxh3_64 checksum failed")
+    Args:
+        models (Iterable[Tuple[str, str, str, str]]): Directory, filename,
+            url and xxh3_64 of each model
+        verify (bool): Whether to hash all the existing models. Defaults to
+            False.
+        jobs (int): Maximum number of concurrent downloads. Defaults to
+            `DOWNLOAD_JOBS`.
+    """
+    models = list(models)
+    if not models:
+        return
 
+    with ThreadPoolExecutor(max_workers=min(jobs, len(models))) as executor:
+        futures = [
+            executor.submit(fetch, directory, filename, url, xxh3_64, verify)
+            for directory, filename, url, xxh3_64 in models
+        ]
+        for future in futures:
+            future.result()
 
-def fetch_models(directory: str, models: DictConfig) -> None:
+
+def fetch_models(directory: str,
+                 models: DictConfig,
+                 verify: bool = False) -> None:
     """
     Fetch all models
 
     Args:
         directory (str): Directory to save models
         models (DictConfig): Models to fetch
+        verify (bool): Whether to hash all the existing models, instead of
+            trusting those which did not change since their last
+            verification. Defaults to False.
+    """
+    fetch_all(((directory, str(model), models[model]["url"],
+                models[model]["xxh3_64"]) for model in models),
+              verify=verify)
+
+
+def fetch_models_from_config(cfg: DictConfig) -> None:
+    """
+    Fetch the models of the segmentation preset
+
+    Args:
+        cfg (DictConfig): Configuration, with `cache.models.verify` to hash
+            all the existing models
     """
-    for model in models:
-        fetch(directory, filename=str(model), **models[model])
+    verify = cfg.get("cache", {}).get("models", {}).get("verify", False)
+    fetch_models(cfg.segmentation.models_path,
+                 cfg.segmentation.models,
+                 verify=verify)
@@ -0,0 +1,195 @@
+import json
+import os
+import tempfile
+import zipfile
+from pathlib import Path, PosixPath
+from typing import Iterator
+
+import numpy as np
+import torch
+import torchio as tio
+import xxhash
+from omegaconf import DictConfig, OmegaConf
+
+
+class LogitsWriter:
+    """
+    Writes the soft predictions of a model for one crop, one sample at a
+    time, as separately compressed float16 members of a `.npz` archive.
+    The archive only becomes visible once closed.
+
+    Args:
+        path (PosixPath): Path of the archive.
+
+    Attributes:
+        count (int): Number of written samples.
+    """
+
+    def __init__(self, path: PosixPath):
+        self.path = path
+        fd, self._tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        os.close(fd)
+        self._archive = zipfile.ZipFile(self._tmp,
+                                        "w",
+                                        compression=zipfile.ZIP_DEFLATED,
+                                        compresslevel=1)
+        self.count = 0
+
+    def add(self, prediction: torch.Tensor) -> None:
+        """
+        Adds the prediction of a sample.
+
+        Args:
+            prediction (torch.Tensor): Soft prediction in CHWD format.
+        """
+        with self._archive.open(f"sample_{self.count:04d}.npy",
+                                "w",
+                                force_zip64=True) as f:
+            np.lib.format.write_array(
+                f, prediction.numpy().astype(np.float16))
+        self.count += 1
+
+    def close(self, partial: bool = False) -> None:
+        """
+        Finalizes the archive.
+
+        Args:
+            partial (bool): Whether some samples were skipped (e.g. by an
+                early stop). Partial archives are kept under another name,
+                so that they are not taken for complete ones. Defaults to
+                False.
+        """
+        self._archive.close()
+        os.replace(self._tmp,
+                   partial_path(self.path) if partial else self.path)
+
+    def abort(self) -> None:
+        """Discards the archive, e.g. when the inference failed."""
+        self._archive.close()
+        Path(self._tmp).unlink(missing_ok=True)
+
+
+def partial_path(path: PosixPath) -> PosixPath:
+    """
+    Returns the path of an archive whose samples are incomplete.
+
+    Args:
+        path (PosixPath): Path of the complete archive.
+
+    Returns:
+        PosixPath: Path with a `.partial.npz` extension.
+    """
+    return path.with_suffix(".partial.npz")
+
+
+class LogitsCache:
+    """
+    Store of the raw soft predictions of each model, before any `ca_mode`
+    merging, in the space of the original crops.
+
+    Archives are keyed by the hash of the preprocessed crop (including the
+    augmentation settings) and the hash of the model, so that changing the
+    `ca_mode`, removing a model from the bag, or recomputing uncertainty
+    maps only re-reads cached tensors. The least recently used archives are
+    evicted once the cache exceeds `max_size` MB.
+
+    Args:
+        path (PosixPath): Directory of the cache.
+        max_size (float): Maximum size of the cache in MB.
+    """
+
+    def __init__(self, path: PosixPath, max_size: float = 1024):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size * 1024**2
+
+    @staticmethod
+    def key(subject: tio.Subject, augmentation_cfg: DictConfig,
+            segmentation_cfg: DictConfig) -> str:
+        """
+        Computes the key of a crop.
+
+        Args:
+            subject (tio.Subject): The preprocessed crop.
+            augmentation_cfg (DictConfig): Augmentation configuration.
+            segmentation_cfg (DictConfig): Segmentation configuration.
+
+        Returns:
+            str: xxh3_64 hex digest.
+        """
+        xxh = xxhash.xxh3_64()
+        xxh.update(subject.mri.data.numpy().tobytes())
+        xxh.update(subject.mri.affine.tobytes())
+        settings = [
+            OmegaConf.to_container(OmegaConf.create(augmentation_cfg)),
+            OmegaConf.to_container(OmegaConf.create(segmentation_cfg))
+        ]
+        xxh.update(json.dumps(settings, sort_keys=True).encode())
+
+        return xxh.hexdigest()
+
+    def _archive(self, key: str, model_hash: str) -> PosixPath:
+        return self.path / f"{key}_{model_hash}.npz"
+
+    def exists(self, key: str, model_hash: str) -> bool:
+        """
+        Checks whether the predictions of a model for a crop are cached.
+
+        Args:
+            key (str): Crop key.
+            model_hash (str): Model hash.
+
+        Returns:
+            bool: Whether the archive exists.
+        """
+        return self._archive(key, model_hash).exists()
+
+    def load(self, key: str, model_hash: str) -> Iterator[torch.Tensor]:
+        """
+        Reads the cached predictions of a model for a crop, one sample at a
+        time.
+
+        Args:
+            key (str): Crop key.
+            model_hash (str): Model hash.
+
+        Yields:
+            torch.Tensor: Soft prediction of each sample, in float32.
+        """
+        path = self._archive(key, model_hash)
+        # Mark the archive as recently used
+        os.utime(path)
+        with np.load(path) as archive:
+            for name in sorted(archive.files):
+                yield torch.from_numpy(archive[name].astype(np.float32))
+
+    def writer(self, key: str, model_hash: str) -> LogitsWriter:
+        """
+        Returns a writer for the predictions of a model for a crop.
+
+        Args:
+            key (str): Crop key.
+            model_hash (str): Model hash.
+
+        Returns:
+            LogitsWriter: Writer of the archive.
+        """
+        return LogitsWriter(self._archive(key, model_hash))
+
+    def evict(self) -> None:
+        """Removes the least recently used archives above `max_size`."""
+        archives = []
+        for archive in self.path.glob("*.npz"):
+            try:
+                stat = archive.stat()
+            except OSError:
+                # Evicted by another process
+                continue
+            archives.append((stat.st_mtime, stat.st_size, archive))
+
+        total = sum(size for _, size, _ in archives)
+        for _, size, archive in sorted(archives, key=lambda a: a[0]):
+            if total <= self.max_size:
+                break
+            archive.unlink(missing_ok=True)
+            total -= size
@@ -0,0 +1,312 @@
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path, PosixPath
+from typing import Dict, Iterable, List, Optional, Union
+
+import xxhash
+from omegaconf import DictConfig, OmegaConf
+from rich.logging import RichHandler
+
+from hsf.fetch_models import get_hash
+
+FORMAT = "%(message)s"
+logging.basicConfig(level=logging.INFO,
+                    format=FORMAT,
+                    datefmt="[%X]",
+                    handlers=[RichHandler()])
+
+log = logging.getLogger(__name__)
+
+# Stages of a subject, in order. A subject is done once both sides are.
+STAGES = ("located", "side_1", "side_2")
+
+
+def fingerprint(mri: PosixPath) -> dict:
+    """
+    Cheap identity of an input file, to detect that it changed.
+
+    Args:
+        mri (PosixPath): Path to the MRI.
+
+    Returns:
+        dict: Size and modification time of the file.
+    """
+    stat = Path(mri).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def config_hash(cfg: DictConfig) -> str:
+    """
+    Hashes the parts of the configuration that change the outputs.
+
+    Args:
+        cfg (DictConfig): Configuration.
+
+    Returns:
+        str: xxHash3 of the configuration.
+    """
+    sections = {
+        name: OmegaConf.to_container(cfg[name], resolve=True)
+        for name in ("roiloc", "segmentation", "augmentation",
+                     "multispectrality")
+        if name in cfg
+    }
+    sections["files"] = {
+        key: cfg.files.get(key)
+        for key in ("output_dir", "native_soft", "native_uncertainty")
+    }
+    sections["precision"] = cfg.hardware.engine_settings.get("precision")
+
+    return xxhash.xxh3_64(
+        json.dumps(sections, sort_keys=True,
+                   default=str).encode()).hexdigest()
+
+
+def read_records(path: PosixPath) -> List[dict]:
+    """
+    Reads the records of a manifest, ignoring a line truncated by a crash.
+
+    Args:
+        path (PosixPath): Path of the manifest.
+
+    Returns:
+        List[dict]: Records, in order.
+    """
+    records = []
+    for line in Path(path).read_text().splitlines():
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+
+def apply_record(subjects: Dict[str, dict], record: dict) -> None:
+    """
+    Updates the state of the subjects with a record.
+
+    Args:
+        subjects (Dict[str, dict]): State of each MRI: its fingerprint,
+            configuration hash, xxHash3, completed stages (with their
+            records) and last error.
+        record (dict): Record of a manifest.
+    """
+    subject = subjects.get(record["mri"])
+    if record["stage"] == "started":
+        # The reused stages are recorded again after each start
+        subjects[record["mri"]] = {
+            "fingerprint": record["fingerprint"],
+            "config": record["config"],
+            "xxh3": record.get("xxh3"),
+            "stages": {},
+            "error": None
+        }
+    elif subject is None:
+        return
+    elif record["stage"] in STAGES:
+        subject["stages"][record["stage"]] = record
+    elif record["stage"] == "failed":
+        subject["error"] = record.get("error")
+
+
+class RunManifest:
+    """
+    Journal of a cohort run, recording the completed stages of each subject
+    with their outputs, so that an interrupted run can resume where it
+    stopped.
+
+    Records are appended as JSON lines, so that the worker processes of a
+    cohort can share the same file, and a crash loses at most the stages
+    that were not completed.
+
+    Args:
+        path (PosixPath): Path of the manifest.
+        previous (Iterable[PosixPath]): Other manifests to read first, but
+            not to write (e.g. the merged manifest of a sharded run).
+    """
+
+    def __init__(self, path: PosixPath, previous: Iterable[PosixPath] = ()):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.subjects: Dict[str, dict] = {}
+
+        for manifest in [*previous, self.path]:
+            if Path(manifest).exists():
+                for record in read_records(manifest):
+                    apply_record(self.subjects, record)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a")
+        if self.path.stat().st_size:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read() != b"\n":
+                    self._file.write("\n")
+
+    def _append(self, record: dict) -> None:
+        record["time"] = time.time()
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            apply_record(self.subjects, record)
+            if self._file is not None:
+                self._file.write(line)
+                self._file.flush()
+
+    def is_done(self, mri: PosixPath, config: str) -> bool:
+        """
+        Whether both sides of an MRI were segmented, from this very file and
+        configuration, and their outputs still exist.
+
+        Args:
+            mri (PosixPath): Path to the MRI.
+            config (str): Hash of the configuration, from `config_hash`.
+
+        Returns:
+            bool: True if the MRI can be skipped.
+        """
+        subject = self.subjects.get(str(mri))
+        if subject is None or not {"side_1", "side_2"} <= set(
+                subject["stages"]):
+            return False
+        if (subject["fingerprint"], subject["config"]) != (fingerprint(mri),
+                                                           config):
+            return False
+        return all(
+            Path(output).exists()
+            for record in subject["stages"].values()
+            for output in record["outputs"])
+
+    def knows(self, mri: PosixPath) -> bool:
+        """
+        Whether an MRI was ever started in this manifest.
+
+        Args:
+            mri (PosixPath): Path to the MRI.
+
+        Returns:
+            bool: True if the MRI has records.
+        """
+        return str(mri) in self.subjects
+
+    def start(self,
+              mri: PosixPath,
+              config: str,
+              reset: bool = False) -> Dict[str, List[str]]:
+        """
+        Records the start of a subject, and returns the stages that can be
+        reused: those completed from the same input and configuration, whose
+        outputs still exist.
+
+        Args:
+            mri (PosixPath): Path to the MRI.
+            config (str): Hash of the configuration, from `config_hash`.
+            reset (bool): Whether to discard the completed stages (e.g. to
+                overwrite the outputs). Defaults to False.
+
+        Returns:
+            Dict[str, List[str]]: Outputs of each reusable stage.
+        """
+        current = fingerprint(mri)
+        subject = self.subjects.get(str(mri))
+        completed = {}
+        if not reset and subject is not None and \
+                (subject["fingerprint"], subject["config"]) == (current, config):
+            completed = {
+                stage: record
+                for stage, record in subject["stages"].items()
+                if all(Path(output).exists() for output in record["outputs"])
+            }
+
+        # Only hashed when the MRI is new or changed
+        xxh3 = subject["xxh3"] if subject is not None and \
+            subject["fingerprint"] == current else None
+        self._append({
+            "mri": str(mri),
+            "stage": "started",
+            "fingerprint": current,
+            "config": config,
+            "xxh3": xxh3 or get_hash(str(mri)),
+        })
+        for record in completed.values():
+            self._append(dict(record))
+
+        return {
+            stage: record["outputs"] for stage, record in completed.items()
+        }
+
+    def record(self,
+               mri: PosixPath,
+               stage: str,
+               outputs: Iterable[Union[str, PosixPath]] = (),
+               errors: Optional[List[str]] = None,
+               **info) -> None:
+        """
+        Records that a stage completed, or failed.
+
+        Args:
+            mri (PosixPath): Path to the MRI.
+            stage (str): One of `STAGES`.
+            outputs (Iterable[Union[str, PosixPath]]): Files written by the
+                stage, which must be on disk.
+            errors (List[str], optional): If not empty, the stage failed.
+            **info: Results of the stage (e.g. volumes), added to the record.
+        """
+        if errors:
+            self.fail(mri, "; ".join(errors), stage)
+            return
+        self._append({
+            "mri": str(mri),
+            "stage": stage,
+            "outputs": [str(output) for output in outputs],
+            **info
+        })
+
+    def fail(self, mri: PosixPath, error: str,
+             stage: Optional[str] = None) -> None:
+        """
+        Records an error. The completed stages are kept, so that the next
+        run resumes after them.
+
+        Args:
+            mri (PosixPath): Path to the MRI.
+            error (str): Error message.
+            stage (str, optional): Stage that failed, if known.
+        """
+        self._append({
+            "mri": str(mri),
+            "stage": "failed",
+            "failed_stage": stage,
+            "error": error
+        })
+
+    def close(self) -> None:
+        """Stops recording."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_manifest_path(cfg: DictConfig) -> Optional[PosixPath]:
+    """
+    Returns the path of the manifest of a run, relative to `files.path`.
+
+    Args:
+        cfg (DictConfig): Configuration.
+
+    Returns:
+        Optional[PosixPath]: Path of the manifest, None if disabled.
+    """
+    manifest = cfg.files.get("manifest")
+    if not manifest:
+        return None
+    return Path(cfg.files.path).expanduser() / Path(manifest).expanduser()
@@ -1,6 +1,6 @@
 import logging
 from pathlib import PosixPath
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 import ants
 from omegaconf import DictConfig
@@ -8,6 +8,7 @@ from rich.logging import RichHandler
 from roiloc._cache import handle_cache
 from roiloc.locator import RoiLocator
 
+from hsf.async_io import write_image
 from hsf.roiloc_wrapper import save_hippocampi
 
 FORMAT = "%(message)s"
@@ -81,11 +82,24 @@ def register(mri: PosixPath,
     output_dir = mri.parent / cfg.files.output_dir
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    ants.image_write(registered, str(output_dir / fname))
+    write_image(registered, output_dir / fname)
 
     return output_dir / fname
 
 
+def _save_additional_hippocampi(mri: PosixPath, second_contrast: PosixPath,
+                                right_mri: ants.ANTsImage,
+                                left_mri: ants.ANTsImage,
+                                cfg: DictConfig) -> Tuple[PosixPath]:
+    extensions = "".join(second_contrast.suffixes)
+    fname = mri.name.replace(extensions, "") + "_second-contrast.nii.gz"
+
+    return save_hippocampi(right_mri=right_mri,
+                           left_mri=left_mri,
+                           dir_name=cfg.files.output_dir,
+                           original_mri_path=mri.parent / fname)
+
+
 def get_additional_hippocampi(mri: PosixPath, second_contrast: PosixPath,
                               locator: RoiLocator,
                               cfg: DictConfig) -> Tuple[PosixPath]:
@@ -105,10 +119,101 @@ def get_additional_hippocampi(mri: PosixPath, second_contrast: PosixPath,
 
     right_mri, left_mri = locator.transform(image)
 
-    extensions = "".join(second_contrast.suffixes)
-    fname = mri.name.replace(extensions, "") + "_second-contrast.nii.gz"
+    return _save_additional_hippocampi(mri, second_contrast, right_mri,
+                                       left_mri, cfg)
 
-    return save_hippocampi(right_mri=right_mri,
-                           left_mri=left_mri,
-                           dir_name=cfg.files.output_dir,
-                           original_mri_path=mri.parent / fname)
+
+def pad_coords(coords: List[int], shape: Tuple[int], padding: int) -> list:
+    """
+    Enlarges a bounding box, within the bounds of the image.
+
+    Args:
+        coords (List[int]): Coordinates in xyzxyz format.
+        shape (Tuple[int]): Shape of the image.
+        padding (int): Padding, in voxels.
+
+    Returns:
+        list: Padded coordinates in xyzxyz format.
+    """
+    return [max(c - padding, 0) for c in coords[:3]] + \
+        [min(c + padding, s) for c, s in zip(coords[3:], shape)]
+
+
+@handle_cache
+def register_crops(mri: PosixPath,
+                   second_contrast: PosixPath,
+                   locator: RoiLocator,
+                   cfg: DictConfig,
+                   outprefix: Optional[str] = None) -> Tuple[PosixPath]:
+    """
+    Registers the second contrast to the first one inside the (padded)
+    bounding boxes of ROILoc only, and crops it on the grid of the
+    hippocampi.
+
+    The second contrast starts from its scanner-space alignment with the
+    first one or, with `crop_registration.coarse_to_fine`, from a rigid
+    registration of both images downsampled to `coarse_spacing`.
+
+    Args:
+        mri (PosixPath): Path to the first MRI.
+        second_contrast (PosixPath): Path to the second MRI.
+        locator (RoiLocator): RoiLocator fitted to the first MRI.
+        cfg (DictConfig): Configuration.
+        outprefix (str, optional): Prefix for the output.
+
+    Returns:
+        Tuple[PosixPath]: Paths to the additional hippocampi.
+    """
+    crop_cfg = cfg.multispectrality.get("crop_registration") or {}
+    padding = crop_cfg.get("padding", 8)
+    registration_params = dict(cfg.multispectrality.registration)
+    registration_params.pop("outprefix", None)
+
+    image = locator._image
+    moving = ants.image_read(str(second_contrast), reorient="LPI")
+
+    initial = []
+    if crop_cfg.get("coarse_to_fine", False):
+        spacing = [crop_cfg.get("coarse_spacing", 2.)] * 3
+        log.info(f"Coarsely registering {str(second_contrast)} to {str(mri)}")
+        initial = ants.registration(
+            fixed=ants.resample_image(image, spacing, False, 0),
+            moving=ants.resample_image(moving, spacing, False, 0),
+            type_of_transform=crop_cfg.get("coarse_transform", "Rigid"),
+            outprefix=f"{outprefix}coarse_")["fwdtransforms"]
+
+    hippocampi = []
+    for side in ("right", "left"):
+        coords = locator.coords[side]
+        fixed = ants.crop_indices(image,
+                                  *_split(pad_coords(coords, image.shape,
+                                                     padding)))
+        # Room for the second contrast to move within the fixed box
+        context = ants.crop_indices(
+            image, *_split(pad_coords(coords, image.shape, 2 * padding)))
+        if initial:
+            prealigned = ants.apply_transforms(fixed=context,
+                                               moving=moving,
+                                               transformlist=initial)
+        else:
+            prealigned = ants.resample_image_to_target(moving, context)
+
+        log.info(f"Registering {str(second_contrast)} to the {side} "
+                 f"hippocampus of {str(mri)}")
+        transformation = ants.registration(fixed=fixed,
+                                           moving=prealigned,
+                                           outprefix=f"{outprefix}{side}_",
+                                           **registration_params)
+
+        # Both transforms are applied at once, to interpolate only once
+        hippocampi.append(
+            ants.apply_transforms(
+                fixed=ants.crop_indices(image, *_split(coords)),
+                moving=moving,
+                transformlist=transformation["fwdtransforms"] + initial))
+
+    return _save_additional_hippocampi(mri, second_contrast, *hippocampi, cfg)
+
+
+def _split(coords: List[int]) -> Tuple[List[int], List[int]]:
+    return coords[:3], coords[3:]
@@ -0,0 +1,210 @@
+import logging
+import os
+import random
+from pathlib import Path, PosixPath
+from typing import Iterable, List, Optional
+
+import hydra
+import numpy as np
+from omegaconf import DictConfig
+from rich.logging import RichHandler
+
+from hsf.fetch_models import fetch_models_from_config, get_model_hash
+
+# Quantization tools need the `onnx` package, which is optional
+try:
+    import onnx
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat,
+                                          QuantType, quantize_dynamic,
+                                          quantize_static)
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+    QUANTIZATION_AVAILABLE = True
+except ImportError:
+    CalibrationDataReader = object
+    QUANTIZATION_AVAILABLE = False
+
+FORMAT = "%(message)s"
+logging.basicConfig(level=logging.INFO,
+                    format=FORMAT,
+                    datefmt="[%X]",
+                    handlers=[RichHandler()])
+
+log = logging.getLogger(__name__)
+
+PRECISIONS = ("fp32", "fp16", "int8_dynamic", "int8_static")
+
+
+def variant_path(model: PosixPath, precision: str) -> PosixPath:
+    """
+    Returns where the variant of a model is cached, keyed by the xxh3_64 of
+    the source model.
+
+    Args:
+        model (PosixPath): Path to the fp32 model.
+        precision (str): One of `PRECISIONS`.
+
+    Returns:
+        PosixPath: Path to the variant, in `models_path/variants/`.
+    """
+    model = Path(model)
+    return model.parent / "variants" / \
+        f"{model.stem}_{get_model_hash(str(model))}_{precision}.onnx"
+
+
+class CropsDataReader(CalibrationDataReader):
+    """
+    Feeds preprocessed crops to the static quantization calibrator.
+
+    Args:
+        input_name (str): Name of the input of the model.
+        crops (Iterable[np.ndarray]): Crops in CHWD format.
+    """
+
+    def __init__(self, input_name: str, crops: Iterable[np.ndarray]):
+        self._inputs = iter([{
+            input_name: crop[None].astype(np.float32)
+        } for crop in crops])
+
+    def get_next(self) -> Optional[dict]:
+        return next(self._inputs, None)
+
+
+def _check_available() -> None:
+    if not QUANTIZATION_AVAILABLE:
+        raise ImportError(
+            "Mixed precision and INT8 variants need the `onnx` package. "
+            "Please install it using `pip install onnx`.")
+
+
+def build_variant(model: PosixPath,
+                  precision: str,
+                  crops: Optional[List[np.ndarray]] = None) -> PosixPath:
+    """
+    Builds (or overwrites) the variant of a model.
+
+    Args:
+        model (PosixPath): Path to the fp32 model.
+        precision (str): One of `PRECISIONS`, except "fp32".
+        crops (List[np.ndarray], optional): Preprocessed crops in CHWD
+            format, to calibrate "int8_static" variants.
+
+    Returns:
+        PosixPath: Path to the variant.
+    """
+    _check_available()
+    output = variant_path(model, precision)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tmp = output.with_suffix(f".tmp{os.getpid()}")
+
+    log.info(f"Building the {precision} variant of {Path(model).name}...")
+    try:
+        if precision == "fp16":
+            # Inputs and outputs stay in fp32
+            onnx.save(
+                convert_float_to_float16(onnx.load(str(model)),
+                                         keep_io_types=True), str(tmp))
+        elif precision == "int8_dynamic":
+            quantize_dynamic(str(model), str(tmp), weight_type=QuantType.QInt8)
+        elif precision == "int8_static":
+            if not crops:
+                raise ValueError("int8_static variants need calibration crops.")
+            input_name = onnx.load(str(model)).graph.input[0].name
+            quantize_static(str(model),
+                            str(tmp),
+                            CropsDataReader(input_name, crops),
+                            quant_format=QuantFormat.QDQ,
+                            activation_type=QuantType.QUInt8,
+                            weight_type=QuantType.QInt8)
+        else:
+            raise ValueError(f"Unknown precision ({precision}). "
+                             f"Precision must be one of {PRECISIONS}.")
+        os.replace(tmp, output)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+    return output
+
+
+def get_model_variant(model: PosixPath, precision: str = "fp32") -> PosixPath:
+    """
+    Returns the model to run for a given precision, building its variant
+    if it is not cached yet.
+
+    Args:
+        model (PosixPath): Path to the fp32 model.
+        precision (str): One of `PRECISIONS`. Defaults to "fp32".
+
+    Returns:
+        PosixPath: Path to the model to run.
+    """
+    if precision == "fp32":
+        return model
+
+    path = variant_path(model, precision)
+    if path.exists():
+        return path
+
+    if precision == "int8_static":
+        raise FileNotFoundError(
+            f"No calibrated int8_static variant of {model}. "
+            "Please run `hsf-calibrate files.path=...` first.")
+    return build_variant(model, precision)
+
+
+def load_crops(crops: List[PosixPath]) -> List[np.ndarray]:
+    """
+    Loads and preprocesses crops like the segmentation does.
+
+    Args:
+        crops (List[PosixPath]): Paths to hippocampal crops.
+
+    Returns:
+        List[np.ndarray]: Preprocessed crops in CHWD format.
+    """
+    from hsf.segment import mri_to_subject
+
+    return [mri_to_subject(crop).mri.data.numpy() for crop in crops]
+
+
+def calibrate(models_path: PosixPath, crops: List[PosixPath]) -> List[PosixPath]:
+    """
+    Builds the int8_static variants of every model of a directory.
+
+    Args:
+        models_path (PosixPath): Directory of the fp32 models.
+        crops (List[PosixPath]): Paths to hippocampal crops.
+
+    Returns:
+        List[PosixPath]: Paths to the calibrated variants.
+    """
+    data = load_crops(crops)
+    models = sorted(Path(models_path).expanduser().glob("*.onnx"))
+
+    return [
+        build_variant(model, "int8_static", crops=data) for model in models
+    ]
+
+
+@hydra.main(config_path="conf", config_name="config", version_base="1.1")
+def main(cfg: DictConfig) -> None:
+    fetch_models_from_config(cfg)
+
+    calibration = cfg.hardware.get("calibration", {})
+    crops = sorted(
+        Path(cfg.files.path).expanduser().glob(
+            calibration.get("pattern", "**/*_hippocampus.nii.gz")))
+    if not crops:
+        raise FileNotFoundError(
+            "No crop found for calibration. Segment a few MRIs with HSF first.")
+
+    random.Random(0).shuffle(crops)
+    crops = crops[:calibration.get("num_crops", 8)]
+    log.info(f"Calibrating on {len(crops)} crops.")
+
+    for variant in calibrate(cfg.segmentation.models_path, crops):
+        log.info(f"Saved {variant}")
+
+
+def start():
+    main()
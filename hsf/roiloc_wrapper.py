@@ -1,11 +1,23 @@
+import json
 import logging
+import os
+import shutil
+import tempfile
 from pathlib import Path, PosixPath
-from typing import Optional
+from typing import Optional, Tuple, Union
 
 import ants
+import numpy as np
+import roiloc
+import xxhash
+from omegaconf import OmegaConf
 from omegaconf.dictconfig import DictConfig
 from rich.logging import RichHandler
+from roiloc.location import get_coords
 from roiloc.locator import RoiLocator
+from roiloc.registration import get_roi
+
+from hsf.async_io import AsyncWriter, write_image
 
 FORMAT = "%(message)s"
 logging.basicConfig(level=logging.INFO,
@@ -15,6 +27,9 @@ logging.basicConfig(level=logging.INFO,
 
 log = logging.getLogger(__name__)
 
+# Keys of the roiloc configuration which are not RoiLocator arguments
+FIT_OPTIONS = ("resolution",)
+
 
 def load_from_config(path: str, pattern: str) -> list:
     """
@@ -59,9 +74,238 @@ def get_mri(mri: PosixPath, mask_pattern: Optional[str] = None) -> tuple:
     return ants.image_read(str(mri)), mask
 
 
+def make_locator(roiloc_cfg: DictConfig,
+                 mask: Optional[ants.ANTsImage] = None) -> RoiLocator:
+    """
+    Builds a RoiLocator from the roiloc configuration.
+
+    Args:
+        roiloc_cfg (DictConfig): Roiloc configuration.
+        mask (ants.ANTsImage, optional): Brain mask.
+
+    Returns:
+        RoiLocator: Unfitted locator.
+    """
+    kwargs = {k: v for k, v in roiloc_cfg.items() if k not in FIT_OPTIONS}
+    return RoiLocator(**kwargs, mask=mask)
+
+
+def fit_locator(locator: RoiLocator,
+                image: ants.ANTsImage,
+                outprefix: str,
+                resolution: Optional[float] = None,
+                random_seed: Optional[int] = None) -> None:
+    """
+    Fits a RoiLocator, as `RoiLocator.fit`, but keeps the forward
+    transforms in `outprefix` instead of a temporary directory.
+
+    If `resolution` is given, the template is registered to a copy of the
+    image (and of the mask) resampled to this isotropic spacing, which is
+    much faster for high resolution scans. The atlas is then warped onto the
+    full resolution grid, so that the bounding boxes (and the margins) are
+    computed in full resolution voxels, as without downsampling.
+
+    This localization is approximate: the boxes do not match those of the
+    full resolution registration, and the margin should cover the
+    difference (see `benchmarks/benchmark_roiloc.py`).
+
+    Args:
+        locator (RoiLocator): RoiLocator to fit.
+        image (ants.ANTsImage): Image to fit the ROI to.
+        outprefix (str): Prefix for ANTs' output files.
+        resolution (float, optional): Spacing of the registration in mm. If
+            None, the image is registered at full resolution.
+        random_seed (int, optional): Seed of the metric sampling, to make
+            the registration reproducible.
+    """
+    locator._image = image
+
+    fixed, mask = image, locator.mask
+    if resolution:
+        fixed = ants.resample_image(image, [float(resolution)] * 3,
+                                    use_voxels=False,
+                                    interp_type=0)
+        if mask is not None:
+            mask = ants.resample_image_to_target(mask,
+                                                 fixed,
+                                                 interp_type="nearestNeighbor")
+
+    registration = ants.registration(fixed=fixed,
+                                     moving=locator._mni,
+                                     type_of_transform=locator.transform_type,
+                                     mask=mask,
+                                     outprefix=outprefix,
+                                     random_seed=random_seed)
+
+    locator._fwdtransforms = registration["fwdtransforms"]
+    locator._invtransforms = registration["invtransforms"]
+
+    registered_atlas = ants.apply_transforms(
+        fixed=image,
+        moving=locator._atlas,
+        transformlist=locator._fwdtransforms,
+        interpolator="nearestNeighbor")
+
+    for i, side in enumerate(["right", "left"]):
+        region = get_roi(registered_atlas=registered_atlas,
+                         idx=int(locator._roi_idx[i]),
+                         save=False)
+        offset = locator.rightoffset if side == "right" else locator.leftoffset
+        locator.coords[side] = get_coords(region.numpy(),
+                                          margin=locator.margin,
+                                          offset=offset)
+
+
+def hash_image(xxh: xxhash.xxh3_64, image: Optional[ants.ANTsImage]) -> None:
+    """
+    Updates a hash with the voxels and the geometry of an image.
+
+    Args:
+        xxh (xxhash.xxh3_64): Hash to update.
+        image (ants.ANTsImage, optional): Image to hash.
+    """
+    if image is None:
+        xxh.update(b"none")
+        return
+
+    xxh.update(image.numpy().tobytes())
+    xxh.update(
+        json.dumps([
+            image.shape, image.spacing, image.origin,
+            image.direction.tolist()
+        ]).encode())
+
+
+class LocatorCache:
+    """
+    Persistent cache of fitted RoiLocators.
+
+    Each entry is a directory named after the xxh3 hash of the image, the
+    mask and the ROILoc configuration. It stores the bounding boxes of both
+    hippocampi and the template's forward and inverse transforms. The least recently used
+    entries are evicted once the cache exceeds `max_size` MB.
+
+    Args:
+        path (str): Directory of the cache.
+        max_size (float): Maximum size of the cache in MB.
+    """
+
+    def __init__(self, path: str, max_size: float = 1024):
+        self.path = Path(path).expanduser()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size * 1024**2
+
+    @staticmethod
+    def key(image: ants.ANTsImage, mask: Optional[ants.ANTsImage],
+            roiloc_cfg: DictConfig) -> str:
+        """
+        Computes the cache key of a localization.
+
+        Args:
+            image (ants.ANTsImage): Image to locate hippocampi in.
+            mask (ants.ANTsImage, optional): Brain mask.
+            roiloc_cfg (DictConfig): Roiloc configuration.
+
+        Returns:
+            str: xxh3_64 hex digest.
+        """
+        xxh = xxhash.xxh3_64()
+        hash_image(xxh, image)
+        hash_image(xxh, mask)
+        config = OmegaConf.to_container(OmegaConf.create(dict(roiloc_cfg)))
+        xxh.update(json.dumps(config, sort_keys=True).encode())
+        xxh.update(roiloc.__version__.encode())
+
+        return xxh.hexdigest()
+
+    def load(self, key: str, locator: RoiLocator,
+             image: ants.ANTsImage) -> bool:
+        """
+        Restores a fitted locator from the cache.
+
+        Args:
+            key (str): Cache key.
+            locator (RoiLocator): Unfitted locator.
+            image (ants.ANTsImage): Image the locator was fitted to.
+
+        Returns:
+            bool: Whether the entry was found.
+        """
+        entry = self.path / key
+        try:
+            with open(entry / "locator.json", "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        locator._image = image
+        locator.coords = state["coords"]
+        locator._fwdtransforms = [str(entry / t) for t in state["transforms"]]
+        # Older entries only stored the forward transforms
+        invtransforms = state.get("invtransforms")
+        locator._invtransforms = [
+            str(entry / t) for t in invtransforms
+        ] if invtransforms is not None else None
+
+        # Mark the entry as recently used
+        os.utime(entry)
+
+        return True
+
+    def save(self, key: str, locator: RoiLocator) -> None:
+        """
+        Stores a fitted locator, then evicts old entries if needed.
+
+        Args:
+            key (str): Cache key.
+            locator (RoiLocator): Fitted locator.
+        """
+        tmp = Path(tempfile.mkdtemp(dir=self.path, prefix=".tmp_"))
+        # The affine is shared by both lists, and copied once
+        for transform in {*locator._fwdtransforms,
+                          *(locator._invtransforms or [])}:
+            shutil.copy(transform, tmp / Path(transform).name)
+        transforms = [Path(t).name for t in locator._fwdtransforms]
+        invtransforms = [
+            Path(t).name for t in locator._invtransforms
+        ] if locator._invtransforms is not None else None
+
+        with open(tmp / "locator.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "coords": locator.coords,
+                "transforms": transforms,
+                "invtransforms": invtransforms
+            }, f)
+
+        try:
+            # Atomic, so that concurrent workers never see partial entries
+            os.rename(tmp, self.path / key)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self) -> None:
+        """Removes the least recently used entries above `max_size`."""
+        entries = []
+        for entry in self.path.iterdir():
+            if entry.name.startswith(".tmp_") or not entry.is_dir():
+                continue
+            size = sum(f.stat().st_size for f in entry.iterdir())
+            entries.append((entry.stat().st_mtime, size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
 def get_hippocampi(mri: ants.ANTsImage,
                    roiloc_cfg: DictConfig,
-                   mask: Optional[ants.ANTsImage] = None) -> tuple:
+                   mask: Optional[ants.ANTsImage] = None,
+                   cache_cfg: Optional[DictConfig] = None) -> tuple:
     """
     Locate right and left hippocampi from a given mri.
 
@@ -70,28 +314,148 @@ def get_hippocampi(mri: ants.ANTsImage,
         roiloc_cfg (DictConfig): Roiloc configuration.
             See `github.com/clementpoiret/ROILoc` for more information.
         mask (ants.ANTsImage, optional): Loaded mask.
+        cache_cfg (DictConfig, optional): ROILoc cache configuration.
 
     Returns:
         RoiLocator: fitted roilocator.
         right_mri (ants.ANTsImage): Right hippocampus.
         left_mri (ants.ANTsImage): Left hippocampus.
     """
-    locator = RoiLocator(**roiloc_cfg, mask=mask)
+    locator = make_locator(roiloc_cfg, mask)
+    resolution = roiloc_cfg.get("resolution")
+
+    if not (cache_cfg and cache_cfg.get("enabled")):
+        if not resolution:
+            right_mri, left_mri = locator.fit_transform(mri)
+            return locator, right_mri, left_mri
+        cache = key = None
+    else:
+        cache = LocatorCache(cache_cfg.path, cache_cfg.get("max_size", 1024))
+        key = cache.key(mri, mask, roiloc_cfg)
 
-    right_mri, left_mri = locator.fit_transform(mri)
+    if cache is not None and cache.load(key, locator, mri):
+        log.info(f"Reusing cached ROILoc localization ({key}).")
+    else:
+        outprefix = tempfile.mkdtemp() + "/"
+        try:
+            fit_locator(locator, mri, outprefix, resolution)
+            if cache is not None:
+                cache.save(key, locator)
+        finally:
+            shutil.rmtree(outprefix)
+
+    right_mri, left_mri = locator.transform(mri)
 
     return locator, right_mri, left_mri
 
 
-def save_hippocampi(right_mri: ants.ANTsImage, left_mri: ants.ANTsImage,
-                    dir_name: str, original_mri_path: PosixPath) -> tuple:
+def voxel_to_physical(image: ants.ANTsImage) -> np.ndarray:
     """
-    Saves right and left hippocampus from a given mri.
+    Returns the matrix mapping the voxel indices of an image to physical
+    (LPS) coordinates.
 
     Args:
-        right_mri (ants.ANTsImage): Right hippocampus.
-        left_mri (ants.ANTsImage): Left hippocampus.
-        dir_name (str): Name of the directory to save the hippocampus.
+        image (ants.ANTsImage): The image.
+
+    Returns:
+        np.ndarray: 4x4 homogeneous matrix.
+    """
+    matrix = np.eye(4)
+    matrix[:3, :3] = np.asarray(image.direction) @ np.diag(image.spacing)
+    matrix[:3, 3] = image.origin
+    return matrix
+
+
+def native_indices(crop: ants.ANTsImage,
+                   native: ants.ANTsImage) -> Tuple[tuple, tuple]:
+    """
+    Nearest-neighbour correspondence between the voxels of a crop and the
+    voxels of the native image, whatever the orientation of both images.
+
+    Only the bounding box of the crop in the native grid is visited, so
+    the cost does not depend on the size of the native image.
+
+    Args:
+        crop (ants.ANTsImage): The crop (e.g. a hippocampus from ROILoc).
+        native (ants.ANTsImage): The image in its original grid and
+            orientation.
+
+    Returns:
+        tuple: Native indices, and the crop indices they are mapped to,
+            ready for numpy advanced indexing.
+    """
+    crop_to_native = np.linalg.inv(voxel_to_physical(native)) @ \
+        voxel_to_physical(crop)
+
+    corners = np.array(np.meshgrid(*[[0, n - 1] for n in crop.shape],
+                                   indexing="ij")).reshape(3, -1)
+    corners = crop_to_native[:3, :3] @ corners + crop_to_native[:3, 3:]
+    lower = np.clip(np.floor(corners.min(axis=1)).astype(int), 0, None)
+    upper = np.minimum(np.ceil(corners.max(axis=1)).astype(int) + 1,
+                       native.shape)
+
+    box = np.indices(upper - lower).reshape(3, -1) + lower[:, None]
+    native_to_crop = np.linalg.inv(crop_to_native)
+    source = np.rint(native_to_crop[:3, :3] @ box +
+                     native_to_crop[:3, 3:]).astype(int)
+    inside = np.all((source >= 0) &
+                    (source < np.array(crop.shape)[:, None]),
+                    axis=0)
+
+    return tuple(box[:, inside]), tuple(source[:, inside])
+
+
+def to_native_space(array: np.ndarray,
+                    crop: ants.ANTsImage,
+                    native: ants.ANTsImage,
+                    background: Union[float, np.ndarray] = 0.,
+                    indices: Optional[Tuple[tuple, tuple]] = None
+                    ) -> ants.ANTsImage:
+    """
+    Places an array defined on the grid of a crop into the grid of the
+    native image, with nearest-neighbour resampling. This fuses ROILoc's
+    `inverse_transform` and the reorientation to the original orientation.
+
+    Args:
+        array (np.ndarray): Array of shape (*crop.shape) or
+            (*crop.shape, C) for multi-channel data.
+        crop (ants.ANTsImage): The crop.
+        native (ants.ANTsImage): The image in its original grid and
+            orientation.
+        background (Union[float, np.ndarray]): Value outside the crop, per
+            channel for multi-channel data. Defaults to 0.
+        indices (Tuple[tuple, tuple], optional): Precomputed output of
+            `native_indices`.
+
+    Returns:
+        ants.ANTsImage: The array in native space (a 4D image for
+            multi-channel data).
+    """
+    native_idx, crop_idx = indices or native_indices(crop, native)
+
+    output = np.empty(native.shape + array.shape[3:], dtype=array.dtype)
+    output[...] = background
+    output[native_idx] = array[crop_idx]
+
+    if output.ndim == 3:
+        return native.new_image_like(output)
+
+    direction = np.eye(4)
+    direction[:3, :3] = native.direction
+    return ants.from_numpy(output,
+                           origin=list(native.origin) + [0.],
+                           spacing=list(native.spacing) + [1.],
+                           direction=direction)
+
+
+def get_hippocampi_paths(dir_name: str,
+                         original_mri_path: PosixPath) -> tuple:
+    """
+    Returns the paths of the right and left hippocampi of a given mri, and
+    creates their directory.
+
+    Args:
+        dir_name (str): Name of the directory of the hippocampi.
         original_mri_path (PosixPath): Path to the original mri.
 
     Returns:
@@ -105,9 +469,35 @@ def save_hippocampi(right_mri: ants.ANTsImage, left_mri: ants.ANTsImage,
 
     output_pattern = str(output_path / (fname + "_{}_hippocampus.nii.gz"))
 
-    right_output_path = output_pattern.format("right")
-    left_output_path = output_pattern.format("left")
-    ants.image_write(right_mri, right_output_path)
-    ants.image_write(left_mri, left_output_path)
+    return output_pattern.format("right"), output_pattern.format("left")
+
+
+def save_hippocampi(right_mri: ants.ANTsImage,
+                    left_mri: ants.ANTsImage,
+                    dir_name: str,
+                    original_mri_path: PosixPath,
+                    writer: Optional[AsyncWriter] = None) -> tuple:
+    """
+    Saves right and left hippocampus from a given mri.
+
+    Args:
+        right_mri (ants.ANTsImage): Right hippocampus.
+        left_mri (ants.ANTsImage): Left hippocampus.
+        dir_name (str): Name of the directory to save the hippocampus.
+        original_mri_path (PosixPath): Path to the original mri.
+        writer (AsyncWriter, optional): Write-behind queue. If None, images
+            are written synchronously.
+
+    Returns:
+        tuple: Path to the right & left hippocampi.
+    """
+    right_output_path, left_output_path = get_hippocampi_paths(
+        dir_name, original_mri_path)
+    if writer:
+        writer.submit(right_mri, right_output_path)
+        writer.submit(left_mri, left_output_path)
+    else:
+        write_image(right_mri, right_output_path)
+        write_image(left_mri, left_output_path)
 
     return right_output_path, left_output_path
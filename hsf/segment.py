@@ -1,6 +1,7 @@
 import itertools
+from collections import Counter
 from pathlib import PosixPath
-from typing import Generator, List
+from typing import Iterable, List, Optional, Sequence, Union
 
 import ants
 import numpy as np
@@ -9,22 +10,30 @@ import torchio as tio
 from omegaconf.dictconfig import DictConfig
 from rich.progress import track
 
-from hsf.augmentation import get_augmented_subject
+from hsf.aggregation import ConvergenceMonitor, EnsembleAggregator
+from hsf.async_io import AsyncWriter, write_image
+from hsf.augmentation import get_augmented_subject, get_batched_augmentation
 from hsf.engines import InferenceEngine
+from hsf.logits import LogitsCache
+from hsf.tracing import span
 
 
-def mri_to_subject(mri: PosixPath) -> tio.Subject:
+def mri_to_subject(mri: Union[PosixPath, ants.ANTsImage]) -> tio.Subject:
     """
-    Loads the MRI data from the given path and returns the preprocessed subject.
+    Loads the MRI data and returns the preprocessed subject.
 
     Args:
-        mri (PosixPath): Path to the MRI data.
-        second_mri (Optional[PosixPath]): Path to the second MRI data.
+        mri (Union[PosixPath, ants.ANTsImage]): Path to the MRI data, or the
+            MRI itself. An ANTs image is shared with torchio without copy.
 
     Returns:
         tio.Subject: The preprocessed MRI data.
     """
-    subject = tio.Subject(mri=tio.ScalarImage(mri))
+    if isinstance(mri, ants.ANTsImage):
+        image = ants_to_tio(mri)
+    else:
+        image = tio.ScalarImage(mri)
+    subject = tio.Subject(mri=image)
 
     preprocessing_pipeline = tio.Compose([
         tio.ZNormalization(),
@@ -34,6 +43,32 @@ def mri_to_subject(mri: PosixPath) -> tio.Subject:
     return preprocessing_pipeline(subject)
 
 
+def ants_to_tio(image: ants.ANTsImage) -> tio.ScalarImage:
+    """
+    Wraps an ANTs image into a torchio image, sharing its buffer.
+
+    ITK works in LPS coordinates while torchio follows NIfTI's RAS
+    convention, so the first two axes of the affine are flipped.
+
+    Args:
+        image (ants.ANTsImage): The image.
+
+    Returns:
+        tio.ScalarImage: The same image, in torchio.
+    """
+    if image.pixeltype != "float":
+        image = image.clone("float")
+
+    lps_to_ras = np.diag([-1., -1., 1.])
+    affine = np.eye(4)
+    affine[:3, :3] = lps_to_ras @ np.asarray(image.direction) @ np.diag(
+        image.spacing)
+    affine[:3, 3] = lps_to_ras @ np.asarray(image.origin)
+
+    return tio.ScalarImage(tensor=torch.from_numpy(image.view()[None]),
+                           affine=affine)
+
+
 def to_ca_mode(logits: torch.Tensor, ca_mode: str = "1/2/3") -> torch.Tensor:
     """
     Converts the logits to the ca_mode.
@@ -76,6 +111,27 @@ def to_ca_mode(logits: torch.Tensor, ca_mode: str = "1/2/3") -> torch.Tensor:
         f"Unknown `ca_mode` ({ca_mode}). `ca_mode` must be 1/2/3, 1/23 or 123")
 
 
+def infer(samples: Sequence[torch.Tensor], engine: InferenceEngine) -> torch.Tensor:
+    """
+    Runs a batch of samples through an engine.
+
+    Samples are copied once, into the input buffer of the engine, and the
+    output is wrapped without copy. It may be a buffer reused by the next
+    call of the engine, so it must be consumed before.
+
+    Args:
+        samples (Sequence[torch.Tensor]): Samples in CHWD format.
+        engine (InferenceEngine): HSF's Inference Engine.
+
+    Returns:
+        torch.Tensor: Logits in NCHWD format.
+    """
+    inp = engine.input_buffer((len(samples), *samples[0].shape))
+    np.stack([sample.numpy() for sample in samples], out=inp)
+
+    return torch.from_numpy(engine.infer(inp))
+
+
 def predict(mris: list,
             engine: InferenceEngine,
             ca_mode: str = "1/2/3") -> torch.Tensor:
@@ -91,11 +147,27 @@ def predict(mris: list,
     Returns:
         torch.Tensor: Segmentations.
     """
-    inp = np.stack([mri.mri.data.numpy() for mri in mris])
+    with span("inference",
+              engine=PosixPath(str(engine.model)).name,
+              batch_size=len(mris)):
+        logits = infer([mri.mri.data for mri in mris], engine)
+        logits = to_ca_mode(logits, ca_mode)
+
+    with span("inverse", batch_size=len(mris)):
+        return invert(logits, mris)
+
+
+def invert(logits: torch.Tensor, mris: list) -> List[torch.Tensor]:
+    """
+    Warps predictions back into the space of their original subject.
 
-    logits = engine(inp)
-    logits = to_ca_mode(torch.tensor(logits[0]), ca_mode)
+    Args:
+        logits (torch.Tensor): Predictions in NCHWD format.
+        mris (List[tio.Subject]): The augmented subjects.
 
+    Returns:
+        List[torch.Tensor]: Segmentations.
+    """
     results = []
     for lab, aug in zip(logits, mris):
         lm_temp = tio.LabelMap(tensor=torch.rand(1, 1, 1, 1),
@@ -108,11 +180,229 @@ def predict(mris: list,
     return results
 
 
+def predict_augmented(samples: list,
+                      engine: InferenceEngine,
+                      ca_mode: str = "1/2/3") -> List[torch.Tensor]:
+    """
+    Predict segmentations from samples of batched augmentations.
+
+    Args:
+        samples (list): (BatchedAugmentation, sample index, tensor) tuples,
+            as returned by `get_batched_augmentation`.
+        engine (InferenceEngine): HSF's Inference Engine.
+        ca_mode (str, optional): The cornu ammoni division mode.
+            Defaults to "1/2/3".
+
+    Returns:
+        List[torch.Tensor]: Segmentations.
+    """
+    with span("inference",
+              engine=PosixPath(str(engine.model)).name,
+              batch_size=len(samples)):
+        logits = infer([data for _, _, data in samples], engine)
+        logits = to_ca_mode(logits, ca_mode)
+
+    with span("inverse", batch_size=len(samples)):
+        return invert_augmented(logits, samples)
+
+
+def invert_augmented(logits: torch.Tensor,
+                     samples: list) -> List[torch.Tensor]:
+    """
+    Warps predictions back into the space of their original subject.
+
+    Args:
+        logits (torch.Tensor): Predictions in NCHWD format.
+        samples (list): (BatchedAugmentation, sample index, tensor) tuples.
+
+    Returns:
+        List[torch.Tensor]: Segmentations.
+    """
+    # Consecutive samples of the same subject are inverted at once
+    results = []
+    start = 0
+    for augmentation, group in itertools.groupby(samples, key=lambda s: s[0]):
+        indices = [k for _, k, _ in group]
+        stop = start + len(indices)
+        results.extend(augmentation.inverse(logits[start:stop], indices))
+        start = stop
+
+    return results
+
+
+def segment_sides(groups: List[List[tio.Subject]],
+                  augmentation_cfg: DictConfig,
+                  segmentation_cfg: DictConfig,
+                  n_engines: int,
+                  engines: Iterable,
+                  ca_mode: str = "1/2/3",
+                  batch_size: int = 1,
+                  logits_cache: Optional[LogitsCache] = None
+                  ) -> List[EnsembleAggregator]:
+    """
+    Segments several groups of subjects (e.g. right and left hippocampi)
+    in a single pass per model.
+
+    Only samples of the same shape share a batch: zero-padding a crop (whose
+    mean intensity is 0 after normalization) would make its predictions near
+    the borders depend on the other crops.
+
+    Args:
+        groups (List[List[tio.Subject]]): Groups of subjects to segment.
+        augmentation_cfg (DictConfig): Augmentation configuration.
+        segmentation_cfg (DictConfig): Segmentation configuration.
+        n_engines (int): Number of engines.
+        engines (Iterable[InferenceEngine]): Inference Engines.
+        ca_mode (str): The cornu ammoni division mode. Defaults to "1/2/3".
+        batch_size (int): Batch size. Defaults to 1.
+        logits_cache (LogitsCache, optional): Store of raw predictions.
+            Cached (crop, model) pairs are read instead of being inferred.
+
+    Returns:
+        List[EnsembleAggregator]: Aggregated segmentations of each group.
+    """
+    engines = list(engines)
+    flat = [subject for group in groups for subject in group]
+    owners = [g for g, group in enumerate(groups) for _ in group]
+
+    keys = [
+        logits_cache.key(subject, augmentation_cfg, segmentation_cfg)
+        for subject in flat
+    ] if logits_cache else None
+
+    def _is_cached(s, engine):
+        return logits_cache is not None and logits_cache.exists(
+            keys[s], engine.model_hash)
+
+    if augmentation_cfg.get("batched", False):
+        augment, run = get_batched_augmentation, predict_augmented
+    else:
+        augment, run = get_augmented_subject, predict
+
+    # Raw predictions are cached, `ca_mode` is applied afterwards
+    run_ca_mode = "1/2/3" if logits_cache else ca_mode
+
+    samples = {}
+    for s, subject in enumerate(flat):
+        if not all(_is_cached(s, engine) for engine in engines):
+            with span("tta", shape=list(subject.spatial_shape)):
+                samples[s] = augment(subject, augmentation_cfg,
+                                     segmentation_cfg)
+
+    adaptive = augmentation_cfg.get("adaptive", {})
+    monitors = [
+        ConvergenceMonitor(tolerance=adaptive.get("tolerance", 0.005),
+                           patience=adaptive.get("patience", 2))
+        for _ in groups
+    ] if adaptive.get("enabled", False) else None
+    if monitors:
+        # The original sample goes first, and subjects of the same group are
+        # interleaved, so that stopping early keeps a balanced ensemble
+        samples = {s: samples[s][-1:] + samples[s][:-1] for s in samples}
+    # Groups whose ensemble does not change anymore when adding a model
+    stopped = set()
+
+    aggregators = [EnsembleAggregator() for _ in groups]
+    for n, engine in enumerate(engines, start=1):
+        # Convergence is judged on the predictions of the current model only,
+        # as a few samples barely move an ensemble filled by previous models
+        partials = [EnsembleAggregator() for _ in groups]
+        consensus = [
+            aggregator.hard_prediction if aggregator.count else None
+            for aggregator in aggregators
+        ] if monitors else None
+        queues = []
+        for s in range(len(flat)):
+            if owners[s] in stopped:
+                continue
+            if _is_cached(s, engine):
+                for prediction in logits_cache.load(keys[s],
+                                                    engine.model_hash):
+                    prediction = to_ca_mode(prediction[None], ca_mode)[0]
+                    aggregators[owners[s]].update(prediction)
+                    if monitors:
+                        partials[owners[s]].update(prediction)
+            else:
+                queues.append([(sample, s) for sample in samples[s]])
+
+        if monitors:
+            queue = [
+                item for items in itertools.zip_longest(*queues)
+                for item in items if item is not None
+            ]
+            for monitor in monitors:
+                monitor.reset()
+        else:
+            queue = [item for items in queues for item in items]
+
+        if not queue:
+            continue
+        # Groups whose TTA has converged for the current model
+        converged = set()
+
+        def _batches():
+            batches = {}
+            for sample, s in queue:
+                if owners[s] in converged:
+                    continue
+                batch = batches.setdefault(flat[s].spatial_shape, [])
+                batch.append((sample, s))
+                if len(batch) == batch_size:
+                    yield batches.pop(flat[s].spatial_shape)
+            yield from batches.values()
+
+        writers = {
+            s: logits_cache.writer(keys[s], engine.model_hash)
+            for s in {s for _, s in queue}
+        } if logits_cache else {}
+
+        try:
+            for batch in track(
+                    _batches(),
+                    total=sum(-(-n // batch_size) for n in Counter(
+                        flat[s].spatial_shape for _, s in queue).values()),
+                    description=f"Segmenting (TTA: {len(queue)} | "
+                    f"MODEL {n}/{n_engines})..."):
+                sub = [sample for sample, _ in batch]
+                predictions = run(sub, engine, run_ca_mode)
+                with span("aggregation", batch_size=len(batch)):
+                    for prediction, (_, s) in zip(predictions, batch):
+                        if logits_cache:
+                            writers[s].add(prediction)
+                            prediction = to_ca_mode(prediction[None],
+                                                    ca_mode)[0]
+                        aggregators[owners[s]].update(prediction)
+                        if monitors:
+                            partials[owners[s]].update(prediction)
+
+                for g in ({owners[s] for _, s in batch} if monitors else ()):
+                    if monitors[g].update(partials[g]):
+                        converged.add(g)
+                        # The new model agrees with the previous ones
+                        if consensus[g] is not None and monitors[g].agrees(
+                                partials[g], consensus[g]):
+                            stopped.add(g)
+        except BaseException:
+            # No temporary archive is left behind
+            for writer in writers.values():
+                writer.abort()
+            raise
+
+        for s, writer in writers.items():
+            # Archives of a model stopped early are never reused
+            writer.close(partial=writer.count < len(samples[s]))
+
+    if logits_cache:
+        logits_cache.evict()
+
+    return aggregators
+
+
 def segment(subjects: List[tio.Subject],
             augmentation_cfg: DictConfig,
             segmentation_cfg: DictConfig,
             n_engines: int,
-            engines: Generator,
+            engines: Iterable,
             ca_mode: str = "1/2/3",
             batch_size: int = 1) -> tuple:
     """
@@ -122,43 +412,48 @@ def segment(subjects: List[tio.Subject],
         subjects (List): List of the subject to segment.
         augmentation_cfg (DictConfig): Augmentation configuration.
         segmentation_cfg (DictConfig): Segmentation configuration.
-        engines (Generator[InferenceEngine]): Inference Engines.
+        engines (Iterable[InferenceEngine]): Inference Engines.
         ca_mode (str): The cornu ammoni division mode. Defaults to "1/2/3".
         batch_size (int): Batch size. Defaults to 1.
 
     Returns:
-        torch.Tensor: The segmented subject.
+        tuple: The mean soft segmentation (NCHWD with N=1), and the hard
+            segmentation of the subject.
     """
-    subjects = list(
-        itertools.chain(*[
-            get_augmented_subject(subject, augmentation_cfg, segmentation_cfg)
-            for subject in subjects
-        ]))
+    aggregator = segment_sides(groups=[subjects],
+                               augmentation_cfg=augmentation_cfg,
+                               segmentation_cfg=segmentation_cfg,
+                               n_engines=n_engines,
+                               engines=engines,
+                               ca_mode=ca_mode,
+                               batch_size=batch_size)[0]
 
-    batched_subjects = [
-        subjects[x:x + batch_size] for x in range(0, len(subjects), batch_size)
-    ]
+    return aggregator.mean, aggregator.hard_prediction
 
-    results = []
-    n = 0
-    for engine in engines:
-        n += 1
-        for sub in track(
-                batched_subjects,
-                description=
-                f"Segmenting (TTA: {len(subjects)} | MODEL {n}/{n_engines})..."
-        ):
-            results.extend(predict(sub, engine, ca_mode))
-    soft_predictions = torch.stack(results, dim=0)
-    hard_prediction = soft_predictions.argmax(dim=1).long().mode(dim=0).values
 
-    return soft_predictions, hard_prediction
+def prediction_path(mri: PosixPath, suffix: str = "seg") -> PosixPath:
+    """
+    Returns the path of a prediction saved by `save_prediction`.
+
+    Args:
+        mri (PosixPath): Path to the MRI data.
+        suffix (str): The suffix of the output file.
+
+    Returns:
+        PosixPath: Path of the prediction, next to the MRI.
+    """
+    extensions = "".join(mri.suffixes)
+    fname = mri.name.replace(extensions, "") + "_" + suffix + ".nii.gz"
+
+    return mri.parent / fname
 
 
 def save_prediction(mri: PosixPath,
                     prediction: torch.Tensor,
                     suffix: str = "seg",
-                    astype: str = "uint8") -> ants.ANTsImage:
+                    astype: str = "uint8",
+                    reference: Optional[ants.ANTsImage] = None,
+                    writer: Optional[AsyncWriter] = None) -> ants.ANTsImage:
     """
     Saves the prediction to the given path.
 
@@ -167,20 +462,24 @@ def save_prediction(mri: PosixPath,
         prediction (torch.Tensor): The prediction.
         suffix (str): The suffix of the output file.
         astype (str): The type of the output file.
+        reference (ants.ANTsImage, optional): The loaded MRI, to avoid
+            reading it again.
+        writer (AsyncWriter, optional): Write-behind queue. If None, the
+            prediction is written synchronously.
 
     Returns:
         ants.ANTsImage: The predicted segmentation.
     """
-    raw_img = ants.image_read(str(mri))
+    raw_img = reference if reference is not None else ants.image_read(str(mri))
     array = prediction.numpy() * 1.
     raw_segmentation = raw_img.new_image_like(array.squeeze())
 
-    extensions = "".join(mri.suffixes)
-    fname = mri.name.replace(extensions, "") + "_" + suffix + ".nii.gz"
-
-    output_path = mri.parent / fname
+    output_path = prediction_path(mri, suffix)
 
     segmentation = raw_segmentation.astype(astype)
-    ants.image_write(segmentation, str(output_path))
+    if writer:
+        writer.submit(segmentation, output_path)
+    else:
+        write_image(segmentation, output_path)
 
     return segmentation
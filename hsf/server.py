@@ -0,0 +1,409 @@
+import io
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import hydra
+import numpy as np
+import requests
+from omegaconf import DictConfig
+from rich.logging import RichHandler
+
+from hsf.engines import InferenceEnginePool
+from hsf.fetch_models import fetch_models_from_config
+from hsf.threads import budget_engine_settings, configure_from_config
+
+FORMAT = "%(message)s"
+logging.basicConfig(level=logging.INFO,
+                    format=FORMAT,
+                    datefmt="[%X]",
+                    handlers=[RichHandler()])
+
+log = logging.getLogger(__name__)
+
+
+def to_bytes(array: np.ndarray) -> bytes:
+    """Serializes an array in the `.npy` format."""
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def from_bytes(data: bytes) -> np.ndarray:
+    """Deserializes an array from the `.npy` format."""
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+class MicroBatcher:
+    """
+    Gathers the samples of concurrent requests into shared batches for one
+    engine.
+
+    A batch is run as soon as it is full, or when its oldest sample has
+    waited for `max_latency` seconds. Only samples of the same shape share
+    a batch, as padding them would make the predictions near the borders
+    depend on the other requests.
+
+    Args:
+        engine (InferenceEngine): The engine.
+        max_batch_size (int): Maximum number of samples per batch.
+        max_latency (float): Latency budget of a sample, in seconds.
+    """
+
+    def __init__(self, engine, max_batch_size: int, max_latency: float):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self.batches = 0
+        self.samples = 0
+        self.wait_time = 0.
+
+        # Samples waiting for a batch, per shape
+        self._queues: Dict[tuple, deque] = {}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of samples waiting for a batch."""
+        return sum(len(queue) for queue in list(self._queues.values()))
+
+    def submit(self, x: np.ndarray) -> List[Future]:
+        """
+        Queues a batch of samples.
+
+        Args:
+            x (np.ndarray): Samples in NCHWD format.
+
+        Returns:
+            List[Future]: Prediction of each sample.
+        """
+        futures = [Future() for _ in x]
+        now = time.monotonic()
+        with self._condition:
+            self._queues.setdefault(x.shape[1:], deque()).extend(
+                (now, sample, future) for sample, future in zip(x, futures))
+            self._condition.notify()
+        return futures
+
+    def close(self) -> None:
+        """Runs the queued samples, then stops the batching thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queues and not self._closed:
+                    self._condition.wait()
+                if not self._queues:
+                    return
+
+                while True:
+                    # The shape whose oldest sample waited the longest
+                    shape = min(self._queues,
+                                key=lambda shape: self._queues[shape][0][0])
+                    full = [
+                        shape for shape, queue in self._queues.items()
+                        if len(queue) >= self.max_batch_size
+                    ]
+                    remaining = self._queues[shape][0][0] + \
+                        self.max_latency - time.monotonic()
+                    if full or self._closed or remaining <= 0:
+                        shape = full[0] if full else shape
+                        break
+                    self._condition.wait(remaining)
+
+                queue = self._queues[shape]
+                n = min(len(queue), self.max_batch_size)
+                items = [queue.popleft() for _ in range(n)]
+                if not queue:
+                    del self._queues[shape]
+
+            self._run(items)
+
+    def _run(self, items: list) -> None:
+        batch = np.stack([sample for _, sample, _ in items])
+
+        now = time.monotonic()
+        self.batches += 1
+        self.samples += len(items)
+        self.wait_time += sum(now - arrival for arrival, _, _ in items)
+
+        try:
+            predictions = self.engine(batch)[0]
+        except Exception as e:
+            for _, _, future in items:
+                future.set_exception(e)
+            return
+
+        for prediction, (_, _, future) in zip(predictions, items):
+            future.set_result(prediction)
+
+    def metrics(self) -> dict:
+        """
+        Returns the batching metrics of the engine.
+
+        Returns:
+            dict: Queue depth, number of batches and samples, mean batch
+                fill rate, and mean waiting time of a sample (in ms).
+        """
+        return {
+            "queue_depth": self.queue_depth,
+            "batches": self.batches,
+            "samples": self.samples,
+            "fill_rate": self.samples / max(self.batches * self.max_batch_size,
+                                            1),
+            "mean_wait_ms": 1000 * self.wait_time / max(self.samples, 1),
+        }
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """
+    HTTP server keeping a pool of engines resident, and batching the samples
+    of concurrent requests together.
+
+    Routes:
+        - `GET /models`: Names and hashes of the models.
+        - `GET /metrics`: Batching metrics, per model hash.
+        - `POST /predict/<model hash>`: Body and response are `.npy` arrays.
+
+    Args:
+        engines (Iterable[InferenceEngine]): The engines.
+        host (str): Address to bind. Defaults to "127.0.0.1".
+        port (int): Port to bind, 0 for any free port. Defaults to 8765.
+        max_batch_size (int): Maximum number of samples per batch.
+        max_latency_ms (float): Latency budget of a sample, in ms.
+    """
+
+    daemon_threads = True
+
+    def __init__(self,
+                 engines,
+                 host: str = "127.0.0.1",
+                 port: int = 8765,
+                 max_batch_size: int = 16,
+                 max_latency_ms: float = 20.):
+        self.batchers = {
+            engine.model_hash:
+                MicroBatcher(engine, max_batch_size, max_latency_ms / 1000)
+            for engine in engines
+        }
+        super().__init__((host, port), _RequestHandler)
+
+    @property
+    def url(self) -> str:
+        """Address of the server."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def server_close(self) -> None:
+        super().server_close()
+        for batcher in self.batchers.values():
+            batcher.close()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: InferenceServer
+
+    def _send(self, body: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, obj, status: int = 200):
+        self._send(json.dumps(obj).encode(), "application/json", status)
+
+    def do_GET(self):
+        batchers = self.server.batchers
+        if self.path == "/models":
+            self._send_json([{
+                "name": Path(batcher.engine.model).name,
+                "hash": model_hash
+            } for model_hash, batcher in batchers.items()])
+        elif self.path == "/metrics":
+            metrics = {
+                model_hash: batcher.metrics()
+                for model_hash, batcher in batchers.items()
+            }
+            self._send_json({
+                "queue_depth":
+                    sum(m["queue_depth"] for m in metrics.values()),
+                "models":
+                    metrics
+            })
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        model_hash = self.path.rsplit("/", 1)[-1]
+        if not self.path.startswith("/predict/") or \
+                model_hash not in self.server.batchers:
+            self._send_json({"error": "unknown model"}, 404)
+            return
+
+        length = int(self.headers["Content-Length"])
+        x = from_bytes(self.rfile.read(length))
+        futures = self.server.batchers[model_hash].submit(x)
+        try:
+            predictions = np.stack([future.result() for future in futures])
+        except Exception as e:
+            self._send_json({"error": f"{type(e).__name__}: {e}"}, 500)
+            return
+        self._send(to_bytes(predictions), "application/octet-stream")
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class RemoteEngine:
+    """
+    Client of a model served by an `InferenceServer`, usable in place of an
+    `InferenceEngine`.
+
+    Args:
+        url (str): Address of the server.
+        model (str): Name of the model.
+        model_hash (str): Hash of the model.
+        session (requests.Session): HTTP session.
+        timeout (float, optional): Seconds to wait for the server to answer,
+            None to wait forever. Defaults to None.
+    """
+
+    def __init__(self,
+                 url: str,
+                 model: str,
+                 model_hash: str,
+                 session: requests.Session,
+                 timeout: Optional[float] = None):
+        self.url = url
+        self.model = model
+        self.model_hash = model_hash
+        self.timeout = timeout
+        self._session = session
+
+    def __call__(self, x: np.ndarray) -> List[np.ndarray]:
+        try:
+            response = self._session.post(
+                f"{self.url}/predict/{self.model_hash}",
+                data=to_bytes(np.ascontiguousarray(x)),
+                headers={"Content-Type": "application/octet-stream"},
+                timeout=self.timeout)
+        except requests.Timeout as e:
+            # Fails the current subject only
+            raise TimeoutError(
+                f"HSF server did not answer within {self.timeout}s") from e
+        if not response.ok:
+            raise RuntimeError(
+                f"HSF server failed ({response.status_code}): {response.text}")
+        return [from_bytes(response.content)]
+
+    def input_buffer(self, shape) -> np.ndarray:
+        """Returns a new input batch, requests are never zero-copy."""
+        return np.empty(shape, dtype=np.float32)
+
+    def infer(self, x: np.ndarray) -> np.ndarray:
+        """Runs the model on a batch and returns its first output."""
+        return self(x)[0]
+
+    def close(self):
+        """Nothing to release, the server owns the session."""
+
+
+class RemoteEnginePool:
+    """
+    Pool of the engines of an `InferenceServer`, usable in place of an
+    `InferenceEnginePool`.
+
+    Args:
+        url (str): Address of the server (e.g. "http://127.0.0.1:8765").
+        timeout (float, optional): Seconds to wait for the server to answer
+            each request, None to wait forever. Defaults to None.
+    """
+
+    def __init__(self, url: str, timeout: Optional[float] = None):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._session = requests.Session()
+        response = self._session.get(f"{self.url}/models", timeout=timeout)
+        response.raise_for_status()
+        self.engines = [
+            RemoteEngine(self.url, model["name"], model["hash"],
+                         self._session, timeout) for model in response.json()
+        ]
+
+    def __iter__(self) -> Iterator[RemoteEngine]:
+        return iter(self.engines)
+
+    def __len__(self) -> int:
+        return len(self.engines)
+
+    def __enter__(self) -> "RemoteEnginePool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes the HTTP session."""
+        self._session.close()
+        self.engines = []
+
+    def metrics(self) -> dict:
+        """
+        Returns the batching metrics of the server.
+
+        Returns:
+            dict: Metrics, as returned by `GET /metrics`.
+        """
+        response = self._session.get(f"{self.url}/metrics",
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+
+@hydra.main(config_path="conf", config_name="config", version_base="1.1")
+def main(cfg: DictConfig) -> None:
+    fetch_models_from_config(cfg)
+
+    server_cfg = cfg.get("server", {})
+    threads = configure_from_config(cfg, jobs=1)
+    with InferenceEnginePool(
+            cfg.segmentation.models_path,
+            engine_name=cfg.hardware.engine,
+            engine_settings=budget_engine_settings(
+                cfg.hardware.engine, cfg.hardware.engine_settings,
+                threads)) as engines:
+        server = InferenceServer(
+            engines,
+            host=server_cfg.get("host", "127.0.0.1"),
+            port=server_cfg.get("port", 8765),
+            max_batch_size=server_cfg.get("max_batch_size", 16),
+            max_latency_ms=server_cfg.get("max_latency_ms", 20))
+
+        log.info(f"HSF server listening on {server.url}, "
+                 f"serving {len(engines)} models.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def start():
+    main()
@@ -0,0 +1,223 @@
+import csv
+import json
+import logging
+import os
+from pathlib import Path, PosixPath
+from typing import Dict, List, Optional, Tuple
+
+import hydra
+import xxhash
+from omegaconf import DictConfig
+from rich.logging import RichHandler
+
+from hsf.manifest import (RunManifest, apply_record, get_manifest_path,
+                          read_records)
+
+FORMAT = "%(message)s"
+logging.basicConfig(level=logging.INFO,
+                    format=FORMAT,
+                    datefmt="[%X]",
+                    handlers=[RichHandler()])
+
+log = logging.getLogger(__name__)
+
+SIDES = {"side_1": "right", "side_2": "left"}
+
+
+def _is_done(subject: dict) -> bool:
+    return all(stage in subject["stages"] for stage in SIDES)
+
+
+def parse_shard(shard: Optional[str]) -> Optional[Tuple[int, int]]:
+    """
+    Parses a shard specification.
+
+    Args:
+        shard (str, optional): "i/N", the i-th of N shards, from 0 to N-1
+            (e.g. `${oc.env:SLURM_ARRAY_TASK_ID}/100`).
+
+    Returns:
+        Optional[Tuple[int, int]]: Index and number of shards, None if the
+            run is not sharded.
+    """
+    if shard is None or str(shard).strip() == "":
+        return None
+    try:
+        index, count = (int(part) for part in str(shard).split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard ({shard}), expected i/N.")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard ({shard}), i must be in [0, N).")
+
+    return index, count
+
+
+def shard_of(mri: PosixPath, root: PosixPath, count: int) -> int:
+    """
+    Assigns an MRI to a shard, from its path relative to the root of the
+    cohort, so that every node agrees whatever the glob order or the mount
+    point.
+
+    Args:
+        mri (PosixPath): Path to the MRI.
+        root (PosixPath): Root of the cohort (`files.path`).
+        count (int): Number of shards.
+
+    Returns:
+        int: Shard of the MRI.
+    """
+    relative = Path(mri).relative_to(root).as_posix()
+    return xxhash.xxh3_64_intdigest(relative.encode()) % count
+
+
+def select_shard(mris: List[PosixPath], root: PosixPath,
+                 shard: Optional[str]) -> List[PosixPath]:
+    """
+    Keeps the MRIs of a shard.
+
+    Args:
+        mris (List[PosixPath]): List of MRI paths.
+        root (PosixPath): Root of the cohort (`files.path`).
+        shard (str, optional): Shard specification, see `parse_shard`.
+
+    Returns:
+        List[PosixPath]: MRIs of the shard, all of them if not sharded.
+    """
+    parsed = parse_shard(shard)
+    if parsed is None:
+        return mris
+
+    index, count = parsed
+    root = Path(root).expanduser()
+    selected = [mri for mri in mris if shard_of(mri, root, count) == index]
+    log.info(f"Shard {index}/{count}: {len(selected)} of {len(mris)} MRIs.")
+
+    return selected
+
+
+def shard_manifest_path(path: PosixPath, index: int, count: int) -> PosixPath:
+    """
+    Returns the manifest of a shard, next to the manifest of the cohort.
+
+    Args:
+        path (PosixPath): Path of the manifest of the cohort.
+        index (int): Index of the shard.
+        count (int): Number of shards.
+
+    Returns:
+        PosixPath: Path of the manifest of the shard.
+    """
+    return path.with_name(f"{path.stem}.shard-{index}-of-{count}{path.suffix}")
+
+
+def get_run_manifest(cfg: DictConfig) -> Optional[RunManifest]:
+    """
+    Opens the manifest of a run. Each shard writes its own manifest, as
+    appends to a shared file are not atomic on network filesystems, but
+    also reads the merged manifest of the cohort.
+
+    Args:
+        cfg (DictConfig): Configuration.
+
+    Returns:
+        Optional[RunManifest]: The manifest, None if disabled.
+    """
+    path = get_manifest_path(cfg)
+    if path is None:
+        return None
+
+    shard = parse_shard(cfg.files.get("shard"))
+    if shard is None:
+        return RunManifest(path)
+    return RunManifest(shard_manifest_path(path, *shard), previous=[path])
+
+
+def collect(path: PosixPath) -> Dict[str, dict]:
+    """
+    Merges the manifests of the shards into the manifest of the cohort.
+
+    Records are deduplicated and sorted by time, so that collecting again
+    after new runs is safe. The shard manifests are kept.
+
+    Args:
+        path (PosixPath): Path of the manifest of the cohort.
+
+    Returns:
+        Dict[str, dict]: State of each MRI, see `apply_record`.
+    """
+    paths = [path] if path.exists() else []
+    paths += sorted(path.parent.glob(f"{path.stem}.shard-*{path.suffix}"))
+
+    lines = set()
+    for manifest in paths:
+        lines.update(
+            json.dumps(record, sort_keys=True)
+            for record in read_records(manifest))
+    records = sorted((json.loads(line) for line in lines),
+                     key=lambda record: record.get("time", 0))
+
+    tmp = path.with_suffix(f".tmp{os.getpid()}")
+    tmp.write_text("".join(json.dumps(record) + "\n" for record in records))
+    os.replace(tmp, path)
+    log.info(f"Merged {len(records)} records of {len(paths)} manifests "
+             f"into {path}")
+
+    subjects = {}
+    for record in records:
+        apply_record(subjects, record)
+    return subjects
+
+
+def write_volumes(subjects: Dict[str, dict], path: PosixPath) -> None:
+    """
+    Writes the status and the volumes of each subject as a CSV table.
+
+    Args:
+        subjects (Dict[str, dict]): State of each MRI, from `collect`.
+        path (PosixPath): Path of the table.
+    """
+    labels = {
+        label for subject in subjects.values()
+        for record in subject["stages"].values()
+        for label in record.get("volumes", {})
+    }
+    labels = sorted(labels, key=int)
+    columns = [f"{side}_{label}" for side in SIDES.values() for label in labels]
+
+    tmp = path.with_suffix(f".tmp{os.getpid()}")
+    with open(tmp, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["mri", "xxh3", "status"] + columns + ["error"])
+        for mri, subject in sorted(subjects.items()):
+            stages = subject["stages"]
+            if _is_done(subject):
+                status = "done"
+            else:
+                status = "failed" if subject["error"] else "incomplete"
+            volumes = [
+                stages.get(stage, {}).get("volumes", {}).get(label, "")
+                for stage in SIDES
+                for label in labels
+            ]
+            writer.writerow([mri, subject["xxh3"], status] + volumes +
+                            [subject["error"] or ""])
+    os.replace(tmp, path)
+
+
+@hydra.main(config_path="conf", config_name="config", version_base="1.1")
+def main(cfg: DictConfig) -> None:
+    path = get_manifest_path(cfg)
+    if path is None:
+        raise ValueError("Collecting a sharded run requires files.manifest.")
+
+    subjects = collect(path)
+    volumes = path.parent / cfg.files.get("volumes", "hsf_volumes.csv")
+    write_volumes(subjects, volumes)
+
+    done = sum(_is_done(subject) for subject in subjects.values())
+    log.info(f"{done}/{len(subjects)} MRIs segmented. Volumes saved to "
+             f"{volumes}")
+
+
+def start():
+    main()
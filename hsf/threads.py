@@ -0,0 +1,181 @@
+import logging
+import os
+from contextlib import contextmanager
+from typing import Optional, Union
+
+import SimpleITK as sitk
+import torch
+from omegaconf import DictConfig, OmegaConf
+from rich.logging import RichHandler
+
+FORMAT = "%(message)s"
+logging.basicConfig(level=logging.INFO,
+                    format=FORMAT,
+                    datefmt="[%X]",
+                    handlers=[RichHandler()])
+
+log = logging.getLogger(__name__)
+
+# Read by OpenMP/BLAS and ANTs' ITK when they start their thread pools, so
+# they apply to the worker processes spawned afterwards
+ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+            "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS")
+
+# Threads of the current process, None if libraries pick their own
+_BUDGET = None
+
+
+def available_cores() -> int:
+    """
+    Returns the number of cores this process may run on, which is less
+    than the cores of the node under a SLURM or cgroup CPU set.
+
+    Returns:
+        int: Number of usable cores.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def thread_budget(threads: Optional[Union[int, str]],
+                  jobs: int = 1) -> Optional[int]:
+    """
+    Splits `hardware.threads` between the worker processes of a run.
+
+    Args:
+        threads (Union[int, str], optional): Threads of the whole run,
+            "auto" for all the usable cores, None or 0 to let each library
+            pick its own.
+        jobs (int): Number of worker processes. Defaults to 1.
+
+    Returns:
+        Optional[int]: Threads of each process, None if not budgeted.
+    """
+    if not threads:
+        return None
+    if threads == "auto":
+        threads = available_cores()
+    return max(int(threads) // max(jobs, 1), 1)
+
+
+def configure(threads: Optional[int]) -> None:
+    """
+    Caps the thread pools of the current process (torch, SimpleITK,
+    OpenMP/BLAS and ANTs) to a budget.
+
+    The stages of a subject run one after another, so each of them may use
+    the whole budget. The environment variables are read when a library
+    starts its pool: set them before the first registration, and before
+    spawning worker processes.
+
+    Args:
+        threads (int, optional): Threads of the process, from
+            `thread_budget`. If None, nothing is changed.
+    """
+    global _BUDGET
+    _BUDGET = threads
+    if threads is None:
+        return
+
+    for var in ENV_VARS:
+        os.environ[var] = str(threads)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(threads)
+    except RuntimeError:
+        # Only possible before the first parallel work
+        pass
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+
+def get_budget() -> Optional[int]:
+    """
+    Returns the thread budget of the current process.
+
+    Returns:
+        Optional[int]: Threads of the process, None if not budgeted.
+    """
+    return _BUDGET
+
+
+@contextmanager
+def augmentation_pool(n_aug: int):
+    """
+    Splits the budget between the test-time augmentation threads and the
+    SimpleITK filters they run.
+
+    Args:
+        n_aug (int): Number of augmentations.
+
+    Yields:
+        int: Number of augmentation threads.
+    """
+    if _BUDGET is None:
+        yield n_aug
+        return
+
+    pool = min(n_aug, _BUDGET)
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(max(_BUDGET // pool, 1))
+    try:
+        yield pool
+    finally:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(_BUDGET)
+
+
+def budget_engine_settings(engine_name: str, engine_settings: DictConfig,
+                           threads: Optional[int]) -> DictConfig:
+    """
+    Gives the inference engine the thread budget, unless its number of
+    threads is set explicitly.
+
+    Args:
+        engine_name (str): Name of the engine.
+        engine_settings (DictConfig): Engine settings.
+        threads (int, optional): Threads of the process.
+
+    Returns:
+        DictConfig: Engine settings.
+    """
+    if threads is None:
+        return engine_settings
+
+    if engine_name == "deepsparse":
+        if engine_settings.get("num_cores"):
+            return engine_settings
+        return OmegaConf.merge(engine_settings, {"num_cores": threads})
+
+    options = engine_settings.get("session_options") or {}
+    if options.get("intra_op_num_threads") or options.get("use_autotune"):
+        return engine_settings
+    inter = options.get("inter_op_num_threads") or 1
+    return OmegaConf.merge(
+        engine_settings, {
+            "session_options": {
+                "intra_op_num_threads": max(threads // inter, 1),
+                "inter_op_num_threads": inter
+            }
+        })
+
+
+def configure_from_config(cfg: DictConfig,
+                          jobs: Optional[int] = None) -> Optional[int]:
+    """
+    Applies `hardware.threads` to the current process.
+
+    Args:
+        cfg (DictConfig): Configuration.
+        jobs (int, optional): Number of worker processes sharing the
+            budget. Defaults to `hardware.jobs`.
+
+    Returns:
+        Optional[int]: Threads of the process, None if not budgeted.
+    """
+    if jobs is None:
+        jobs = cfg.hardware.get("jobs", 1)
+    threads = thread_budget(cfg.hardware.get("threads"), jobs)
+    configure(threads)
+    if threads is not None:
+        log.info(f"Using {threads} threads per process.")
+
+    return threads
@@ -0,0 +1,365 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path, PosixPath
+from typing import List, Optional
+
+from omegaconf import DictConfig
+from rich.console import Console
+from rich.table import Table
+
+# `resource` is not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+FORMATS = ("chrome", "jsonl")
+
+
+def current_rss() -> Optional[float]:
+    """
+    Returns the current resident set size of the process.
+
+    Returns:
+        Optional[float]: RSS in MB, None if unknown.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def process_peak_rss() -> Optional[float]:
+    """
+    Returns the peak resident set size of the process since it started,
+    whatever was running at the time.
+
+    Returns:
+        Optional[float]: Peak RSS in MB, None if unknown.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+class Tracer:
+    """
+    Records timed spans around the stages of the pipeline, with the
+    resident memory of the process at their end and its peak during the
+    span, as JSON lines or Chrome trace events (`chrome://tracing`,
+    Perfetto).
+
+    While spans are open, a background thread samples the resident memory
+    every `sample_interval` seconds, so that the peak of a span includes
+    the transient allocations freed before its end. Allocations living
+    less than `sample_interval` may still be missed.
+
+    Events are appended to the trace as soon as a span ends, so that the
+    worker processes of a cohort can share the same file.
+
+    Args:
+        path (PosixPath, optional): Path of the trace. If None, spans are
+            not recorded.
+        trace_format (str): "chrome" or "jsonl". Defaults to "chrome".
+        truncate (bool): Whether to start a new trace, instead of appending
+            to an existing one. Defaults to False.
+        sample_interval (float): Seconds between two samples of the
+            resident memory. Defaults to 0.01.
+    """
+
+    def __init__(self,
+                 path: Optional[PosixPath] = None,
+                 trace_format: str = "chrome",
+                 truncate: bool = False,
+                 sample_interval: float = 0.01):
+        if trace_format not in FORMATS:
+            raise ValueError(f"Unknown trace format ({trace_format}). "
+                             f"Format must be one of {FORMATS}.")
+        self.path = Path(path) if path else None
+        self.trace_format = trace_format
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._file = None
+        self.sample_interval = sample_interval
+        # Peak RSS of each open span, updated by the sampler
+        self._peaks = {}
+        self._sampler = None
+        self._stopped = threading.Event()
+
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if truncate or not self.path.exists():
+                # The closing bracket of Chrome traces is optional
+                self.path.write_text("[\n" if trace_format == "chrome" else "")
+            self._file = open(self.path, "a")
+
+    @property
+    def enabled(self) -> bool:
+        """Whether spans are recorded."""
+        return self._file is not None
+
+    def span(self, name: str, **attrs):
+        """
+        Times a block of code.
+
+        Args:
+            name (str): Name of the stage.
+            **attrs: Attributes of the span (e.g. batch size, engine name).
+                The `subject` of the enclosing span is inherited.
+
+        Returns:
+            ContextManager: The span.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, attrs)
+
+    @contextmanager
+    def _span(self, name: str, attrs: dict):
+        stack = self._local.__dict__.setdefault("stack", [])
+        if "subject" not in attrs and stack:
+            attrs["subject"] = stack[-1]
+        stack.append(attrs.get("subject"))
+
+        rss = current_rss()
+        token = object()
+        if rss is not None:
+            with self._lock:
+                self._peaks[token] = rss
+            self._start_sampler()
+        start = time.time()
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - begin
+            stack.pop()
+            with self._lock:
+                peak = self._peaks.pop(token, None)
+            self._emit(name, start, duration, rss, peak, attrs)
+
+    def _start_sampler(self) -> None:
+        with self._lock:
+            if self._sampler is not None or self._stopped.is_set():
+                return
+            self._sampler = threading.Thread(target=self._sample,
+                                             name="hsf-tracer",
+                                             daemon=True)
+        self._sampler.start()
+
+    def _sample(self) -> None:
+        while not self._stopped.wait(self.sample_interval):
+            with self._lock:
+                if not self._peaks:
+                    continue
+            rss = current_rss()
+            with self._lock:
+                for token, peak in self._peaks.items():
+                    self._peaks[token] = max(peak, rss)
+
+    def _emit(self, name: str, start: float, duration: float,
+              start_rss: Optional[float], peak_rss: Optional[float],
+              attrs: dict) -> None:
+        rss = current_rss()
+        if peak_rss is not None and rss is not None:
+            peak_rss = max(peak_rss, rss)
+        memory = {
+            "rss_mb": rss,
+            "peak_rss_mb": peak_rss,
+            "peak_rss_delta_mb": peak_rss - start_rss
+            if peak_rss is not None and start_rss is not None else None
+        }
+        if self.trace_format == "chrome":
+            event = {
+                "name": name,
+                "cat": "hsf",
+                "ph": "X",
+                "ts": round(start * 1e6),
+                "dur": round(duration * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {
+                    **attrs,
+                    **memory
+                },
+            }
+            line = json.dumps(event, default=str) + ",\n"
+        else:
+            event = {
+                "name": name,
+                "start": start,
+                "duration_s": duration,
+                "pid": os.getpid(),
+                "thread": threading.current_thread().name,
+                **memory,
+                **attrs,
+            }
+            line = json.dumps(event, default=str) + "\n"
+
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+                self._file.flush()
+
+    def close(self) -> None:
+        """Stops recording."""
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# Tracer of the current process, disabled unless configured
+_TRACER = Tracer()
+
+
+def configure(trace_cfg: Optional[DictConfig],
+              truncate: bool = False) -> Tracer:
+    """
+    Sets the tracer of the current process from the `trace` configuration.
+
+    Args:
+        trace_cfg (DictConfig, optional): Trace configuration.
+        truncate (bool): Whether to start a new trace. Defaults to False.
+
+    Returns:
+        Tracer: The tracer.
+    """
+    global _TRACER
+    _TRACER.close()
+
+    if trace_cfg and trace_cfg.get("enabled", False):
+        _TRACER = Tracer(Path(trace_cfg.path).expanduser(),
+                         trace_cfg.get("format", "chrome"), truncate,
+                         trace_cfg.get("sample_interval_ms", 10) / 1000)
+    else:
+        _TRACER = Tracer()
+
+    return _TRACER
+
+
+def span(name: str, **attrs):
+    """
+    Times a block of code with the tracer of the current process.
+
+    Args:
+        name (str): Name of the stage.
+        **attrs: Attributes of the span.
+
+    Returns:
+        ContextManager: The span.
+    """
+    return _TRACER.span(name, **attrs)
+
+
+def read_trace(path: PosixPath) -> List[dict]:
+    """
+    Reads the spans of a trace, whatever its format.
+
+    Args:
+        path (PosixPath): Path of the trace.
+
+    Returns:
+        List[dict]: Spans, with their `name`, `duration_s`, `rss_mb`,
+            `peak_rss_mb`, `peak_rss_delta_mb` and attributes.
+    """
+    spans = []
+    for line in Path(path).read_text().splitlines():
+        line = line.strip().rstrip(",")
+        if line in ("", "[", "]"):
+            continue
+        event = json.loads(line)
+        if "ph" in event:
+            event = {
+                "name": event["name"],
+                "duration_s": event["dur"] / 1e6,
+                **event["args"]
+            }
+        spans.append(event)
+
+    return spans
+
+
+def summarize(spans: List[dict]) -> List[dict]:
+    """
+    Aggregates the spans of each stage.
+
+    Args:
+        spans (List[dict]): Spans, as returned by `read_trace`.
+
+    Returns:
+        List[dict]: Count, total, mean and maximum duration, and maximum
+            peak memory and peak memory growth during a span of each stage,
+            in order of decreasing total duration.
+    """
+    stages = defaultdict(list)
+    for s in spans:
+        stages[s["name"]].append(s)
+
+    rows = []
+    for name, group in stages.items():
+        durations = [s["duration_s"] for s in group]
+        peaks = [
+            s["peak_rss_mb"]
+            for s in group
+            if s.get("peak_rss_mb") is not None
+        ]
+        deltas = [
+            s["peak_rss_delta_mb"]
+            for s in group
+            if s.get("peak_rss_delta_mb") is not None
+        ]
+        rows.append({
+            "stage": name,
+            "count": len(group),
+            "total_s": sum(durations),
+            "mean_s": sum(durations) / len(durations),
+            "max_s": max(durations),
+            "peak_rss_mb": max(peaks) if peaks else None,
+            "peak_rss_delta_mb": max(deltas) if deltas else None,
+        })
+
+    return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+
+def print_summary(spans: List[dict]) -> None:
+    """
+    Prints the time spent in each stage.
+
+    Args:
+        spans (List[dict]): Spans, as returned by `read_trace`.
+    """
+    table = Table(title="HSF stages")
+    for column in ("Stage", "Count", "Total (s)", "Mean (s)", "Max (s)",
+                   "Peak RSS (MB)", "Peak RSS growth (MB)"):
+        table.add_column(column, justify="left" if column == "Stage" else "right")
+
+    for row in summarize(spans):
+        table.add_row(
+            row["stage"], str(row["count"]), f"{row['total_s']:.2f}",
+            f"{row['mean_s']:.3f}", f"{row['max_s']:.3f}",
+            f"{row['peak_rss_mb']:.0f}"
+            if row["peak_rss_mb"] is not None else "-",
+            f"{row['peak_rss_delta_mb']:+.0f}"
+            if row["peak_rss_delta_mb"] is not None else "-")
+
+    Console().print(table)
@@ -1,19 +1,45 @@
+import os
 import shutil
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
 import ants
+import numpy as np
 import pytest
+import SimpleITK as sitk
 import torch
-from omegaconf import DictConfig
+import torchio as tio
+import xxhash
+from omegaconf import DictConfig, OmegaConf
+from roiloc.locator import RoiLocator
 
+import hsf.aggregation
+import hsf.autotune
+import hsf.bench
+import hsf.augmentation
+import hsf.bundle
 import hsf.engines
 import hsf.factory
 import hsf.fetch_models
+import hsf.logits
+import hsf.manifest
 import hsf.multispectrality
+import hsf.quantization
 import hsf.roiloc_wrapper
 import hsf.segment
+import hsf.sharding
+import hsf.threads
+import hsf.tracing
 import hsf.uncertainty
 from hsf import __version__
+from hsf.async_io import AsyncWriter, prefetch
+from hsf.logits import LogitsCache
+from hsf.manifest import RunManifest
+from hsf.server import InferenceServer, RemoteEnginePool
 
 
 def test_version():
@@ -42,6 +68,20 @@ def models_path(tmpdir_factory):
     return tmpdir_path
 
 
+@pytest.fixture
+def tiny_model(tmp_path):
+    """Exports a single convolution, with a dynamic batch size."""
+    model = tmp_path / "model.onnx"
+    torch.onnx.export(torch.nn.Conv3d(1, 2, 3, padding=1).eval(),
+                      torch.randn(1, 1, 8, 8, 8),
+                      str(model),
+                      input_names=["input"],
+                      dynamic_axes={"input": {0: "batch"}},
+                      dynamo=False)
+
+    return model
+
+
 @pytest.fixture(scope="session")
 def config(models_path):
     """Setup DictConfig."""
@@ -127,6 +167,129 @@ def test_main(config):
     hsf.factory.main(config)
 
 
+def test_inference_server():
+    """Tests that concurrent requests are batched together by the server."""
+    class Doubler:
+        model = "doubler.onnx"
+        model_hash = "0123456789abcdef"
+
+        def __call__(self, x):
+            return [np.concatenate([x, 2 * x], axis=1)]
+
+    class Centerer:
+        """Depends on the whole volume, like convolutions near borders."""
+        model = "centerer.onnx"
+        model_hash = "fedcba9876543210"
+
+        def __call__(self, x):
+            return [x - x.mean(axis=(2, 3, 4), keepdims=True)]
+
+    class Sleeper:
+        model = "sleeper.onnx"
+        model_hash = "00000000ffffffff"
+
+        def __call__(self, x):
+            time.sleep(1)
+            return [x]
+
+    server = InferenceServer([Doubler(), Centerer(), Sleeper()],
+                             port=0,
+                             max_batch_size=8,
+                             max_latency_ms=200)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        with RemoteEnginePool(server.url) as engines:
+            centerer, doubler, _ = sorted(engines,
+                                          key=lambda engine: engine.model)
+            assert doubler.model_hash == Doubler.model_hash
+
+            inputs = [
+                np.random.rand(3, 1, 8, 16, 8).astype(np.float32),
+                np.random.rand(2, 1, 8, 16, 8).astype(np.float32),
+                np.random.rand(2, 1, 16, 8, 8).astype(np.float32),
+            ]
+
+            def _requests(engine):
+                outputs = [None] * len(inputs)
+
+                def _request(i):
+                    outputs[i] = engine(inputs[i])[0]
+
+                threads = [
+                    threading.Thread(target=_request, args=(i,))
+                    for i in range(len(inputs))
+                ]
+                for request in threads:
+                    request.start()
+                for request in threads:
+                    request.join()
+                return outputs
+
+            for x, y in zip(inputs, _requests(doubler)):
+                assert np.array_equal(y, Doubler()(x)[0])
+
+            # Batched results match the unbatched ones
+            for x, y in zip(inputs, _requests(centerer)):
+                assert np.allclose(y, Centerer()(x)[0], atol=1e-6)
+
+            metrics = engines.metrics()
+            assert metrics["queue_depth"] == 0
+            assert metrics["models"][Doubler.model_hash]["samples"] == 7
+            # One batch per shape
+            assert metrics["models"][Doubler.model_hash]["batches"] == 2
+
+        # Requests which time out fail instead of blocking the run
+        with RemoteEnginePool(server.url, timeout=.2) as engines:
+            sleeper = max(engines, key=lambda engine: engine.model)
+            with pytest.raises(TimeoutError):
+                sleeper(np.zeros((1, 1, 8, 8, 8), dtype=np.float32))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_run_cohort_reports_failures(models_path, config):
+    """Tests that a failing subject is reported instead of aborting the run."""
+    failures = hsf.factory.run_cohort([models_path / "missing_tse.nii.gz"], config)
+
+    assert len(failures) == 1
+    assert failures[0][0] == models_path / "missing_tse.nii.gz"
+
+
+def test_run_cohort_survives_broken_pool(tmp_path, config, monkeypatch):
+    """Tests that a dying worker fails its subjects, not the whole run."""
+    class Executor:
+        """Process pool whose workers die on MRIs named crash."""
+
+        def __init__(self, **kwargs):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            pass
+
+        def submit(self, fn, mri, cfg, subject):
+            future = Future()
+            if mri.name == "crash":
+                future.set_exception(BrokenProcessPool("worker died"))
+            else:
+                future.set_result((mri, None))
+            return future
+
+    monkeypatch.setattr(hsf.factory, "ProcessPoolExecutor", Executor)
+    cfg = config.copy()
+    cfg.hardware.jobs = 2
+    mris = [tmp_path / name for name in ("a", "crash", "b", "c", "d", "e")]
+    failures = hsf.factory.run_cohort(mris, cfg)
+
+    assert [mri.name for mri, _ in failures] == ["crash"]
+    assert "BrokenProcessPool" in failures[0][1]
+
+
 def test_main_compute_uncertainty(models_path):
     """Tests that the main script can compute uncertainty."""
     soft_pred = torch.randn(5, 6, 448, 30, 448)
@@ -135,6 +298,146 @@ def test_main_compute_uncertainty(models_path):
     hsf.factory.compute_uncertainty(models_path / "sub0_tse.nii.gz", soft_pred)
 
 
+def test_run_padded():
+    """Tests that batches of any size run on fixed batch sizes."""
+    calls = []
+
+    def run(size, chunk):
+        assert len(chunk) == size
+        calls.append(size)
+        return [chunk * 2]
+
+    x = np.arange(11, dtype=np.float32).reshape(11, 1)
+    outputs = hsf.engines.run_padded(x, [4], run)
+    assert np.array_equal(outputs[0], x * 2)
+    assert calls == [4, 4, 4]
+
+    calls.clear()
+    outputs = hsf.engines.run_padded(x, [1, 4], run)
+    assert np.array_equal(outputs[0], x * 2)
+    assert calls == [4, 4, 4]
+
+    calls.clear()
+    hsf.engines.run_padded(x[:9], [1, 2, 8], run)
+    assert calls == [8, 1]
+
+
+def test_model_variants(tmp_path, tiny_model):
+    """Tests that reduced precision variants are built and cached."""
+    model = tiny_model
+    assert hsf.quantization.get_model_variant(model, "fp32") == model
+    with pytest.raises(FileNotFoundError):
+        hsf.quantization.get_model_variant(model, "int8_static")
+
+    settings = OmegaConf.create({
+        "execution_providers": ["CPUExecutionProvider"],
+        "batch_size": 1
+    })
+    x = np.random.rand(1, 1, 8, 8, 8).astype(np.float32)
+    reference = hsf.engines.InferenceEngine("onnxruntime", settings, model)(x)[0]
+
+    for precision in ("fp16", "int8_dynamic"):
+        variant = hsf.quantization.get_model_variant(model, precision)
+        assert variant == hsf.quantization.variant_path(model, precision)
+        assert variant.parent == tmp_path / "variants"
+        assert hsf.fetch_models.get_hash(str(model)) in variant.name
+
+        engine = hsf.engines.InferenceEngine("onnxruntime", settings, variant)
+        assert engine.model_hash != hsf.fetch_models.get_hash(str(model))
+        assert np.allclose(engine(x)[0], reference, atol=0.1)
+
+    calibrated = hsf.quantization.build_variant(model,
+                                                "int8_static",
+                                                crops=[x[0]])
+    assert hsf.quantization.get_model_variant(model,
+                                              "int8_static") == calibrated
+
+
+def test_session_options(tmp_path, tiny_model):
+    """Tests the session options and the optimized model cache."""
+    model = tiny_model
+    providers = ["CPUExecutionProvider"]
+    autotune_file = tmp_path / "autotune.json"
+    hsf.autotune.save_thread_layout(autotune_file, providers, {
+        "intra_op_num_threads": 1,
+        "inter_op_num_threads": 1,
+        "execution_mode": "sequential"
+    })
+    options = OmegaConf.create({
+        "graph_optimization_level": "extended",
+        "execution_mode": "parallel",
+        "cache_optimized_model": True,
+        "use_autotune": True,
+        "autotune_file": str(autotune_file)
+    })
+    sess_options = hsf.engines.get_session_options(options, providers)
+    assert sess_options.intra_op_num_threads == 1
+    assert sess_options.execution_mode == \
+        hsf.engines.EXECUTION_MODES["sequential"]
+
+    settings = OmegaConf.create({
+        "execution_providers": providers,
+        "batch_size": 1,
+        "session_options": options
+    })
+    x = np.random.rand(1, 1, 8, 8, 8).astype(np.float32)
+    first = hsf.engines.InferenceEngine("onnxruntime", settings, model)
+    optimized = hsf.engines.optimized_model_path(model, providers, options)
+    assert optimized.exists()
+
+    second = hsf.engines.InferenceEngine("onnxruntime", settings, model)
+    assert second.model_hash == first.model_hash
+    assert np.allclose(first(x)[0], second(x)[0])
+
+    # Models are not hashed for a cache that is disabled
+    def _optimized_model_path(*args):
+        raise AssertionError("hashed without cache")
+
+    settings.session_options.cache_optimized_model = False
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(hsf.engines, "optimized_model_path",
+                   _optimized_model_path)
+        hsf.engines.InferenceEngine("onnxruntime", settings, model)
+
+
+def test_io_binding(tmp_path, tiny_model):
+    """Tests that IOBinding reuses buffers and matches regular runs."""
+    model = tiny_model
+    engine = hsf.engines.InferenceEngine(
+        "onnxruntime",
+        OmegaConf.create({
+            "execution_providers": ["CPUExecutionProvider"],
+            "batch_size": 2,
+            "io_binding": True
+        }), model)
+
+    samples = [torch.rand(1, 8, 8, 8) for _ in range(2)]
+    reference = engine(torch.stack(samples).numpy())[0]
+
+    first = hsf.segment.infer(samples, engine)
+    assert np.allclose(first.numpy(), reference, atol=1e-6)
+    second = hsf.segment.infer(samples, engine)
+    assert second.data_ptr() == first.data_ptr()
+
+    # Partial batches get their own buffers
+    last = hsf.segment.infer(samples[:1], engine)
+    assert np.allclose(last.numpy(), reference[:1], atol=1e-6)
+
+
+def test_inference_engine_pool(models_path, config):
+    """Tests that the engine pool keeps sessions until it is closed."""
+    with hsf.engines.InferenceEnginePool(
+        models_path,
+        engine_name="onnxruntime",
+        engine_settings=config.hardware.engine_settings,
+    ) as engines:
+        assert len(engines) == 1
+        # Engines can be iterated several times (e.g. for both sides)
+        assert list(engines) == list(engines)
+
+    assert len(engines) == 0
+
+
 # fetch_models
 def test_fetch_models(models_path, config):
     """Tests that models can be (down)loaded"""
@@ -149,6 +452,133 @@ def test_fetch_models(models_path, config):
     hsf.fetch_models.fetch_models(models_path, config.segmentation.models)
 
 
+def test_model_verification(tmp_path, monkeypatch):
+    """Tests that unchanged models are not hashed again, unless verified."""
+    model = tmp_path / "model.onnx"
+    model.write_bytes(b"model" * 1000)
+    xxh3 = xxhash.xxh3_64(b"model" * 1000).hexdigest()
+
+    monkeypatch.setattr(hsf.fetch_models, "HASH_BUFFER_SIZE", 1024)
+    assert hsf.fetch_models.get_hash(model) == xxh3
+
+    hashed = []
+    get_hash = hsf.fetch_models.get_hash
+    monkeypatch.setattr(hsf.fetch_models, "get_hash",
+                        lambda fname: hashed.append(fname) or get_hash(fname))
+
+    models = {"model.onnx": {"url": "http://localhost:1/model.onnx", "xxh3_64": xxh3}}
+    hsf.fetch_models.fetch_models(tmp_path, models)
+    hsf.fetch_models.fetch_models(tmp_path, models)
+    assert len(hashed) == 1
+
+    hsf.fetch_models.fetch_models(tmp_path, models, verify=True)
+    assert len(hashed) == 2
+
+    # Modified in place, with the same size
+    model.write_bytes(b"MODEL" * 1000)
+    assert hsf.fetch_models.get_model_hash(model) != xxh3
+    assert len(hashed) == 3
+
+    # Concurrent downloads of the same process update the cache
+    names = [f"model{i}.onnx" for i in range(32)]
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(
+            lambda name: hsf.fetch_models.update_verification_cache(
+                tmp_path / name, {"xxh3_64": name}), names))
+    # And so do other processes (workers, shards, hsf-server)
+    others = [f"other{i}.onnx" for i in range(32)]
+    with ProcessPoolExecutor(4) as executor:
+        list(executor.map(hsf.fetch_models.update_verification_cache,
+                          [tmp_path / name for name in others],
+                          [{"xxh3_64": name} for name in others]))
+    cache = hsf.fetch_models._read_verification_cache(tmp_path)
+    assert set(names + others) <= set(cache)
+    assert [p.name for p in tmp_path.iterdir() if p.suffix == ".tmp"] == []
+    assert not list(tmp_path.glob("*.lock"))
+
+
+def test_download_resume_and_bundle(tmp_path, monkeypatch):
+    """Tests that interrupted downloads resume, and that models can be bundled."""
+    content = bytes(range(256)) * 4096
+    requests_log = []
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            start = 0
+            if self.headers.get("Range"):
+                start = int(self.headers["Range"][6:].split("-")[0])
+            requests_log.append(start)
+            self.send_response(206 if start else 200)
+            self.send_header("Content-Length", str(len(content) - start))
+            self.end_headers()
+            if len(requests_log) == 1:
+                # First download interrupted halfway
+                self.wfile.write(content[:len(content) // 2])
+                self.close_connection = True
+                return
+            self.wfile.write(content[start:])
+
+    monkeypatch.setattr(hsf.fetch_models, "DOWNLOAD_CHUNK_SIZE", 64 * 1024)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/model.onnx"
+        xxh3 = xxhash.xxh3_64(content).hexdigest()
+        models_path = tmp_path / "models"
+        hsf.fetch_models.fetch(models_path, "model.onnx", url, xxh3)
+
+        assert requests_log == [0, len(content) // 2]
+        assert (models_path / "model.onnx").read_bytes() == content
+        assert not (models_path / "model.onnx.part").exists()
+        assert not list(models_path.glob(".*.lock"))
+
+        # A corrupted partial download is downloaded again from scratch
+        (models_path / "model.onnx").unlink()
+        (models_path / "model.onnx.part").write_bytes(b"corrupted")
+        hsf.fetch_models.fetch(models_path, "model.onnx", url, xxh3)
+        assert requests_log[-2:] == [len(b"corrupted"), 0]
+        assert (models_path / "model.onnx").read_bytes() == content
+
+        preset = OmegaConf.create({
+            "models_path": str(models_path),
+            "models": {
+                "model.onnx": {"url": url, "xxh3_64": xxh3},
+                "copy.onnx": {"url": url, "xxh3_64": xxh3},
+            },
+        })
+        bundle = tmp_path / "hsf_models.tar"
+        hsf.bundle.export_bundle(bundle, {"preset": preset})
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Download locks stay exclusive while their files are removed
+    holders = []
+
+    def locked(_):
+        with hsf.fetch_models._file_lock(models_path / ".model.onnx.lock"):
+            holders.append(1)
+            time.sleep(.01)
+            concurrent = len(holders)
+            holders.pop()
+        return concurrent
+
+    with ThreadPoolExecutor(8) as executor:
+        assert set(executor.map(locked, range(32))) == {1}
+    assert not list(models_path.glob(".*.lock"))
+
+    shutil.rmtree(models_path)
+    assert hsf.bundle.import_bundle(bundle) == 2
+    assert hsf.bundle.import_bundle(bundle) == 0
+    assert (models_path / "copy.onnx").read_bytes() == content
+
+
 # # ROILoc
 def test_roiloc(models_path):
     """Tests that we can locate and save hippocampi."""
@@ -172,6 +602,284 @@ def test_roiloc(models_path):
     hsf.roiloc_wrapper.save_hippocampi(right, left, models_path, mris[0])
 
 
+def test_roiloc_resolution():
+    """Tests that hippocampi are cropped at full resolution from a coarse registration."""
+    mri = ants.image_read("tests/mri/sub0_tse.nii.gz", reorient="LPI")
+    roiloc_cfg = {
+        "contrast": "t2",
+        "margin": [2, 0, 2],
+        "roi": "hippocampus",
+        "resolution": 3.0
+    }
+
+    locator, right, left = hsf.roiloc_wrapper.get_hippocampi(mri, roiloc_cfg)
+
+    assert right.spacing == mri.spacing
+    for side, crop in zip(("right", "left"), (right, left)):
+        coords = locator.coords[side]
+        assert all(0 <= coords[i] < coords[i + 3] <= mri.shape[i]
+                   for i in range(3))
+        assert crop.shape == tuple(coords[i + 3] - coords[i] for i in range(3))
+
+
+def test_locator_cache(tmp_path):
+    """Tests that fitted locators are stored, restored and evicted."""
+    image = ants.from_numpy(np.random.rand(8, 8, 8).astype("float32"))
+    roiloc_cfg = {"contrast": "t2", "roi": "hippocampus", "margin": [2, 0, 2]}
+
+    cache = hsf.roiloc_wrapper.LocatorCache(tmp_path / "cache", max_size=1)
+    key = cache.key(image, None, roiloc_cfg)
+    assert key == cache.key(image.clone(), None, roiloc_cfg)
+    assert key != cache.key(image, None, {**roiloc_cfg, "margin": [4, 0, 4]})
+    assert not cache.load(key, RoiLocator(**roiloc_cfg), image)
+
+    transform = tmp_path / "0GenericAffine.mat"
+    transform.write_bytes(b"affine")
+    warp = tmp_path / "1Warp.nii.gz"
+    inverse_warp = tmp_path / "1InverseWarp.nii.gz"
+    warp.write_bytes(b"warp")
+    inverse_warp.write_bytes(b"inverse warp")
+    locator = RoiLocator(**roiloc_cfg)
+    locator.coords = {"right": [0, 0, 0, 4, 4, 4], "left": [4, 0, 0, 8, 4, 4]}
+    locator._fwdtransforms = [str(warp), str(transform)]
+    locator._invtransforms = [str(transform), str(inverse_warp)]
+    cache.save(key, locator)
+
+    restored = RoiLocator(**roiloc_cfg)
+    assert cache.load(key, restored, image)
+    assert restored.coords == locator.coords
+    assert [Path(t).read_bytes() for t in restored._invtransforms] == [
+        b"affine", b"inverse warp"
+    ]
+    assert [Path(t).name for t in restored._fwdtransforms] == [
+        "1Warp.nii.gz", "0GenericAffine.mat"
+    ]
+    right, _ = restored.transform(image)
+    assert right.shape == (4, 4, 4)
+
+    cache.max_size = 0
+    cache.evict()
+    assert not cache.load(key, RoiLocator(**roiloc_cfg), image)
+
+
+def test_logits_cache(tmp_path):
+    """Tests that raw predictions are stored per crop and per model."""
+    subject = tio.Subject(mri=tio.ScalarImage(tensor=torch.rand(1, 8, 8, 8)))
+    augmentation_cfg = DictConfig({"flip": {"p": 0.5}})
+    segmentation_cfg = DictConfig({"test_time_augmentation": True})
+
+    cache = LogitsCache(tmp_path / "logits")
+    key = cache.key(subject, augmentation_cfg, segmentation_cfg)
+    assert key != cache.key(subject, DictConfig({"flip": {"p": 1.0}}),
+                            segmentation_cfg)
+    assert not cache.exists(key, "model")
+
+    predictions = torch.softmax(torch.randn(3, 6, 8, 8, 8), dim=1)
+    writer = cache.writer(key, "model")
+    for prediction in predictions:
+        writer.add(prediction)
+    assert not cache.exists(key, "model")
+    writer.close()
+
+    assert cache.exists(key, "model")
+    assert not cache.exists(key, "other_model")
+    restored = torch.stack(list(cache.load(key, "model")))
+    assert restored.dtype == torch.float32
+    assert torch.allclose(restored, predictions, atol=1e-3)
+
+    # Stopped early
+    writer = cache.writer(key, "partial_model")
+    writer.add(predictions[0])
+    writer.close(partial=writer.count < len(predictions))
+    assert not cache.exists(key, "partial_model")
+    assert len(list((tmp_path / "logits").glob("*.partial.npz"))) == 1
+
+    # Failed inferences leave no temporary file
+    writer = cache.writer(key, "failed_model")
+    writer.add(predictions[0])
+    writer.abort()
+    assert not cache.exists(key, "failed_model")
+    assert list((tmp_path / "logits").glob("*.tmp")) == []
+
+    # The least recently used archives are evicted first
+    list(cache.load(key, "model"))
+    cache.max_size = (tmp_path / "logits" / f"{key}_model.npz").stat().st_size
+    cache.evict()
+    assert cache.exists(key, "model")
+    assert [p.name for p in (tmp_path / "logits").iterdir()] == [
+        f"{key}_model.npz"
+    ]
+
+
+def test_async_writer(tmp_path):
+    """Tests that queued images are written, and that failures are reported."""
+    image = ants.from_numpy(np.random.rand(8, 8, 8).astype("float32"))
+
+    with AsyncWriter(compression_level=1) as writer:
+        writer.submit(image, tmp_path / "image.nii.gz")
+        writer.submit(image, tmp_path / "missing" / "image.nii.gz")
+        errors = writer.flush()
+
+    assert len(errors) == 1
+    assert errors[0][0] == str(tmp_path / "missing" / "image.nii.gz")
+    written = ants.image_read(str(tmp_path / "image.nii.gz"))
+    assert np.allclose(written.numpy(), image.numpy())
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["image.nii.gz"]
+
+    loaded = [(i, f.result()) for i, f in prefetch(range(4), lambda i: i * 2)]
+    assert loaded == [(0, 0), (1, 2), (2, 4), (3, 6)]
+
+
+def test_run_manifest(tmp_path):
+    """Tests that completed stages are replayed, and reused on resume."""
+    mri = tmp_path / "sub0.nii.gz"
+    mri.write_bytes(b"mri")
+    image = ants.from_numpy(np.random.rand(8, 8, 8).astype("float32"))
+    crop = tmp_path / "sub0_right_hippocampus.nii.gz"
+
+    with RunManifest(tmp_path / "manifest.jsonl") as manifest:
+        assert manifest.start(mri, "config") == {}
+        with AsyncWriter(compression_level=1) as writer:
+            writer.submit(image, crop)
+            writer.when_written([crop], lambda errors: manifest.record(
+                mri, "located", [crop], errors))
+        manifest.record(mri, "side_1", [crop])
+        assert not manifest.is_done(mri, "config")
+
+    # Interrupted in the middle of a record
+    with open(tmp_path / "manifest.jsonl", "a") as f:
+        f.write('{"mri": "')
+
+    manifest = RunManifest(tmp_path / "manifest.jsonl")
+    assert manifest.knows(mri) and not manifest.is_done(mri, "config")
+    assert manifest.start(mri, "other config") == {}
+    assert manifest.start(mri, "config") == {}
+    manifest.record(mri, "located", [crop])
+    manifest.record(mri, "side_1", [crop])
+    crop.unlink()
+    assert manifest.start(mri, "config") == {}
+
+    manifest.record(mri, "side_1", [])
+    manifest.record(mri, "side_2", [])
+    manifest.close()
+    manifest = RunManifest(tmp_path / "manifest.jsonl")
+    assert manifest.is_done(mri, "config")
+    assert list(manifest.start(mri, "config")) == ["side_1", "side_2"]
+    mri.write_bytes(b"new mri")
+    assert not manifest.is_done(mri, "config")
+    manifest.close()
+
+
+def test_run_manifest_reruns(tmp_path, monkeypatch):
+    """Tests that done subjects are re-run without outputs or on new configs."""
+    mri = tmp_path / "sub0.nii.gz"
+    mri.write_bytes(b"mri")
+    segmentations = [
+        tmp_path / f"sub0_{side}_hippocampus_seg.nii.gz"
+        for side in ("left", "right")
+    ]
+    for segmentation in segmentations:
+        segmentation.write_bytes(b"seg")
+
+    with RunManifest(tmp_path / "manifest.jsonl") as manifest:
+        manifest.start(mri, "config")
+        manifest.record(mri, "side_1", segmentations[:1])
+        manifest.record(mri, "side_2", segmentations[1:])
+
+        assert hsf.factory.filter_mris([mri], False, manifest,
+                                       "config") == []
+        assert hsf.factory.filter_mris([mri], False, manifest,
+                                       "other config") == [mri]
+
+        segmentations[1].unlink()
+        assert not manifest.is_done(mri, "config")
+        assert hsf.factory.filter_mris([mri], False, manifest,
+                                       "config") == [mri]
+
+        # Unchanged MRIs are not hashed again when resumed
+        hashed = []
+        monkeypatch.setattr(hsf.manifest, "get_hash",
+                            lambda fname: hashed.append(fname) or "hash")
+        manifest.start(mri, "config")
+        assert hashed == []
+
+
+def test_sharding(tmp_path):
+    """Tests that shards partition the cohort, and that they are merged."""
+    mris = [tmp_path / f"sub{i}" / "t2.nii.gz" for i in range(20)]
+    shards = [hsf.sharding.select_shard(mris, tmp_path, f"{i}/3")
+              for i in range(3)]
+    assert sorted(sum(shards, [])) == sorted(mris)
+    assert shards[1] == hsf.sharding.select_shard(mris[::-1], tmp_path,
+                                                  "1/3")[::-1]
+    assert hsf.sharding.select_shard(mris, tmp_path, None) == mris
+    with pytest.raises(ValueError):
+        hsf.sharding.parse_shard("3/3")
+
+    path = tmp_path / "manifest.jsonl"
+    for i, mri in enumerate(mris[:2]):
+        mri.parent.mkdir()
+        mri.write_bytes(b"mri")
+        shard_path = hsf.sharding.shard_manifest_path(path, i, 2)
+        with RunManifest(shard_path, previous=[path]) as manifest:
+            manifest.start(mri, "config")
+            manifest.record(mri, "side_1", volumes={"1": 10., "2": 5.})
+            if i == 0:
+                manifest.record(mri, "side_2", volumes={"1": 12.})
+
+    hsf.sharding.collect(path)
+    subjects = hsf.sharding.collect(path)
+    assert len(path.read_text().splitlines()) == 5
+    assert RunManifest(path).is_done(mris[0], "config")
+    assert not RunManifest(path).is_done(mris[1], "config")
+
+    hsf.sharding.write_volumes(subjects, tmp_path / "volumes.csv")
+    rows = (tmp_path / "volumes.csv").read_text().splitlines()
+    assert rows[0].split(",")[3:] == [
+        "right_1", "right_2", "left_1", "left_2", "error"
+    ]
+    assert rows[1].split(",")[2:] == ["done", "10.0", "5.0", "12.0", "", ""]
+    assert rows[2].split(",")[2] == "incomplete"
+
+
+def test_to_native_space():
+    """Tests that crops are mapped back like ROILoc's decrop + reorientation."""
+    image = ants.image_read("tests/mri/sub0_tse.nii.gz")
+    native = ants.reorient_image2(image, "RAS")
+    crop = ants.crop_indices(ants.reorient_image2(native, "LPI"), (10, 5, 10),
+                             (100, 25, 90))
+    labels = crop.new_image_like(
+        np.random.randint(0, 5, crop.shape).astype("uint8"))
+
+    lpi = ants.reorient_image2(native, "LPI")
+    expected = ants.reorient_image2(
+        ants.decrop_image(labels, lpi.new_image_like(np.zeros_like(
+            lpi.numpy()))), "RAS")
+
+    result = hsf.roiloc_wrapper.to_native_space(labels.numpy(), crop, native)
+    assert np.array_equal(result.numpy(), expected.numpy())
+    assert result.pixeltype == "unsigned char"
+
+    soft = np.random.rand(*crop.shape, 3).astype("float32")
+    result = hsf.roiloc_wrapper.to_native_space(soft, crop, native,
+                                                background=np.array([1, 0, 0]))
+    assert result.shape == (*native.shape, 3)
+    assert np.array_equal(result.numpy()[0, 0, 0], [1, 0, 0])
+
+
+def test_mri_to_subject_from_image(tmp_path):
+    """Tests that in-memory crops match the crops read from disk."""
+    image = ants.image_read("tests/mri/sub0_tse.nii.gz")
+    crop = ants.crop_indices(image, (10, 5, 10), (100, 25, 90))
+    ants.image_write(crop, str(tmp_path / "crop.nii.gz"))
+
+    from_image = hsf.segment.mri_to_subject(crop)
+    from_disk = hsf.segment.mri_to_subject(tmp_path / "crop.nii.gz")
+
+    assert torch.equal(from_image.mri.data, from_disk.mri.data)
+    assert np.allclose(from_image.mri.affine, from_disk.mri.affine, atol=1e-5)
+
+
 # Segmentation
 def test_segment(models_path, config, deepsparse_inference_engines):
     """Tests that we can segment and save a hippocampus."""
@@ -193,6 +901,93 @@ def test_segment(models_path, config, deepsparse_inference_engines):
     hsf.segment.save_prediction(mri, pred)
 
 
+def test_segment_sides_shapes(tmp_path):
+    """Tests that batched sides of different shapes match separate passes."""
+    class Engine:
+        """Depends on the whole volume, like convolutions near borders."""
+        model = "engine.onnx"
+        model_hash = "0123456789abcdef"
+
+        def __init__(self):
+            self.batches = []
+
+        def input_buffer(self, shape):
+            return np.empty(shape, dtype=np.float32)
+
+        def infer(self, x):
+            self.batches.append(x.shape)
+            centered = x - x.mean(axis=(2, 3, 4), keepdims=True)
+            return np.concatenate([centered] * 6, axis=1)
+
+    right = tio.Subject(mri=tio.ScalarImage(tensor=torch.rand(1, 16, 8, 24)))
+    left = tio.Subject(mri=tio.ScalarImage(tensor=torch.rand(1, 24, 8, 16)))
+    augmentation_cfg = OmegaConf.create({"batched": False})
+    segmentation_cfg = OmegaConf.create({"test_time_augmentation": False})
+
+    engine = Engine()
+    both = hsf.segment.segment_sides([[right], [left]], augmentation_cfg,
+                                     segmentation_cfg, 1, [engine],
+                                     batch_size=2)
+    assert engine.batches == [(1, 1, 16, 8, 24), (1, 1, 24, 8, 16)]
+    for subject, aggregator in zip((right, left), both):
+        alone, = hsf.segment.segment_sides([[subject]], augmentation_cfg,
+                                           segmentation_cfg, 1, [Engine()])
+        assert torch.equal(aggregator.mean, alone.mean)
+
+    # A failed inference leaves no temporary archive in the logits cache
+    def _fail(x):
+        raise RuntimeError("inference failed")
+
+    engine.infer = _fail
+    cache = hsf.logits.LogitsCache(tmp_path / "logits")
+    with pytest.raises(RuntimeError):
+        hsf.segment.segment_sides([[right]], augmentation_cfg,
+                                  segmentation_cfg, 1, [engine],
+                                  logits_cache=cache)
+    assert list((tmp_path / "logits").iterdir()) == []
+
+
+def test_batched_augmentation():
+    """Tests that batched augmentations match TorchIO's transforms."""
+    affine = np.diag([-0.4, -2.6, 0.4, 1.0])
+    affine[:3, 3] = [10, 20, -30]
+    data = torch.nn.functional.avg_pool3d(torch.rand(1, 1, 24, 12, 32), 3, 1, 1)
+    subject = tio.Subject(mri=tio.ScalarImage(tensor=data[0], affine=affine))
+
+    augmentation_cfg = OmegaConf.load("hsf/conf/augmentation/default.yaml")
+    augmentation = hsf.augmentation.BatchedAugmentation(
+        subject, augmentation_cfg, n_aug=2
+    )
+    scales, degrees, translation = [0.9, 1.1, 1.05], [10.0, -5.0, 7.0], [1.0, -2.0, 0.5]
+    control_points = tio.RandomElasticDeformation.get_params((4, 4, 4), (4, 4, 4), 0)
+
+    augmentation.flips[:] = False
+    augmentation.flips[0, 0] = True
+    augmentation.is_elastic[:] = torch.tensor([False, True, False])
+    augmentation.matrices[0] = augmentation._affine_matrix(
+        *[torch.tensor(p, dtype=torch.float64) for p in (scales, degrees, translation)]
+    )
+    augmentation.displacements = augmentation._elastic_displacements([control_points])
+
+    references = [
+        tio.Compose([tio.Flip(0), tio.Affine(scales, degrees, translation)]),
+        tio.ElasticDeformation(control_points=control_points, max_displacement=(4, 4, 4)),
+    ]
+    augmented = augmentation.augment()
+    logits = torch.rand(2, 6, 24, 12, 32)
+    inverted = augmentation.inverse(logits, [0, 1])
+
+    for n, reference in enumerate(references):
+        transformed = reference(subject)
+        assert torch.allclose(augmented[n], transformed.mri.data, atol=1e-4)
+
+        transformed.add_image(tio.LabelMap(tensor=logits[n], affine=affine), "label")
+        back = transformed.apply_inverse_transform(warn=False)
+        assert torch.allclose(inverted[n], back.label.data)
+
+    assert torch.equal(augmented[-1], subject.mri.data)
+
+
 def test_multispectrality(models_path):
     """Tests that we can co-locate hippocampi in another contrast."""
     config = DictConfig(
@@ -224,6 +1019,42 @@ def test_multispectrality(models_path):
     )
 
 
+def test_crop_registration(tmp_path):
+    """Tests that the second contrast is registered inside the crops only."""
+    mri = tmp_path / "sub0_tse.nii.gz"
+    shutil.copy("tests/mri/sub0_tse.nii.gz", mri)
+    image = ants.image_read(str(mri), reorient="LPI")
+
+    # Second contrast shifted by 1mm
+    second = image.clone()
+    second.set_origin(tuple(np.array(image.origin) + [1., 0., -1.]))
+    ants.image_write(second, str(tmp_path / "sub0_t1.nii.gz"))
+
+    locator = RoiLocator(contrast="t2", roi="hippocampus")
+    locator._image = image
+    locator.coords = {
+        "right": [120, 4, 180, 200, 26, 260],
+        "left": [250, 4, 180, 330, 26, 260]
+    }
+    config = DictConfig({
+        "files": {"output_dir": "hsf_outputs"},
+        "multispectrality": {
+            "same_space": False,
+            "registration": {"type_of_transform": "Rigid"},
+            "crop_registration": {"padding": 4},
+        },
+    })
+
+    paths = hsf.multispectrality.register_crops(mri, tmp_path / "sub0_t1.nii.gz",
+                                                locator, config)
+    for path, crop in zip(paths, locator.transform(image)):
+        registered = ants.image_read(str(path))
+        assert registered.shape == crop.shape
+        assert np.allclose(registered.origin, crop.origin)
+        assert np.corrcoef(registered.numpy().ravel(),
+                           crop.numpy().ravel())[0, 1] > 0.9
+
+
 def test_uncertainty():
     """Tests that uncertainty can be computed."""
     n_classes = 1
@@ -232,3 +1063,151 @@ def test_uncertainty():
     unc = hsf.uncertainty.voxelwise_uncertainty(sample_probs)
 
     assert unc.shape == (16, 16, 16)
+
+
+def test_ensemble_aggregator():
+    """Tests that streaming aggregation matches the stacked predictions."""
+    predictions = torch.softmax(torch.randn(7, 6, 8, 5, 9), dim=1)
+
+    aggregator = hsf.aggregation.EnsembleAggregator()
+    for prediction in predictions:
+        aggregator.update(prediction)
+
+    assert aggregator.count == 7
+    assert torch.equal(
+        aggregator.hard_prediction,
+        predictions.argmax(dim=1).long().mode(dim=0).values,
+    )
+    assert torch.allclose(aggregator.mean[0], predictions.mean(dim=0), atol=1e-6)
+    assert torch.allclose(
+        aggregator.uncertainty(),
+        hsf.uncertainty.voxelwise_uncertainty(predictions),
+        atol=1e-5,
+    )
+
+
+def test_convergence_monitor():
+    """Tests that the ensemble converges once predictions stop changing."""
+    prediction = torch.softmax(torch.randn(6, 8, 5, 9), dim=0)
+
+    aggregator = hsf.aggregation.EnsembleAggregator()
+    monitor = hsf.aggregation.ConvergenceMonitor(tolerance=1e-3, patience=2)
+    converged = []
+    for _ in range(4):
+        aggregator.update(prediction)
+        converged.append(monitor.update(aggregator))
+    assert converged == [False, False, True, True]
+
+    monitor.reset()
+    aggregator.update(torch.softmax(torch.randn(6, 8, 5, 9) * 10, dim=0))
+    assert not monitor.update(aggregator)
+    assert monitor.checks == 1
+
+    # A new model is compared with the consensus of the previous ones
+    consensus = aggregator.hard_prediction
+    agreeing, disagreeing = (hsf.aggregation.EnsembleAggregator()
+                             for _ in range(2))
+    agreeing.update(prediction)
+    disagreeing.update(torch.softmax(torch.randn(6, 8, 5, 9) * 10, dim=0))
+    assert monitor.agrees(agreeing, consensus)
+    assert not monitor.agrees(disagreeing, consensus)
+
+
+def test_thread_budget(monkeypatch):
+    """Tests that the thread budget is split between processes and pools."""
+    # Restored after the test
+    for var in hsf.threads.ENV_VARS:
+        monkeypatch.setenv(var, os.environ.get(var, "1"))
+
+    assert hsf.threads.thread_budget(None) is None
+    assert hsf.threads.thread_budget(16, jobs=3) == 5
+    assert hsf.threads.thread_budget(2, jobs=4) == 1
+    assert hsf.threads.thread_budget("auto") == \
+        hsf.threads.available_cores()
+
+    settings = OmegaConf.create({"session_options": {"inter_op_num_threads": 2}})
+    budgeted = hsf.threads.budget_engine_settings("onnxruntime", settings, 8)
+    assert budgeted.session_options.intra_op_num_threads == 4
+    settings.session_options.intra_op_num_threads = 3
+    assert hsf.threads.budget_engine_settings("onnxruntime", settings,
+                                              8) == settings
+    assert hsf.threads.budget_engine_settings(
+        "deepsparse", OmegaConf.create({"num_cores": 0}), 8).num_cores == 8
+
+    sitk_threads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    torch_threads = torch.get_num_threads()
+    try:
+        hsf.threads.configure(4)
+        assert torch.get_num_threads() == 4
+        with hsf.threads.augmentation_pool(20) as pool:
+            assert pool == 4
+            assert sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() == 1
+        assert sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() == 4
+    finally:
+        hsf.threads.configure(None)
+        torch.set_num_threads(torch_threads)
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(sitk_threads)
+
+    with hsf.threads.augmentation_pool(20) as pool:
+        assert pool == 20
+
+
+def test_stage_recorder():
+    """Tests the records of the benchmark stages."""
+    recorder = hsf.bench.StageRecorder(repeats=2)
+    calls = []
+    output = recorder.run("stage", lambda: calls.append(1) or len(calls),
+                          items=4,
+                          input="synthetic")
+
+    assert output == 2
+    record = recorder.results[0]
+    assert record["stage"] == "stage" and record["input"] == "synthetic"
+    assert record["repeats"] == 2
+    assert record["min_wall_time_s"] <= record["wall_time_s"]
+    assert record["throughput_per_s"] > 0
+
+    volume = hsf.bench.synthetic_volume([16, 8, 12], [0.4, 2., 0.4])
+    assert volume.shape == (16, 8, 12)
+    assert volume.spacing == (0.4, 2., 0.4)
+
+
+@pytest.mark.parametrize("trace_format", ["chrome", "jsonl"])
+def test_tracer(tmp_path, trace_format):
+    """Tests that spans are recorded and summarized in both formats."""
+    path = tmp_path / "trace"
+    tracer = hsf.tracing.configure(
+        OmegaConf.create({
+            "enabled": True,
+            "path": str(path),
+            "format": trace_format
+        }),
+        truncate=True)
+
+    with hsf.tracing.span("subject", subject="sub0"):
+        for batch_size in (4, 2):
+            with hsf.tracing.span("inference", batch_size=batch_size):
+                # Transient allocation, freed before the end of the span
+                buffer = b"\x01" * 2**27
+                time.sleep(.1)
+                del buffer
+    tracer.close()
+    hsf.tracing.configure(None)
+
+    spans = hsf.tracing.read_trace(path)
+    assert [s["name"] for s in spans] == ["inference", "inference", "subject"]
+    assert all(s["subject"] == "sub0" for s in spans)
+    assert spans[1]["batch_size"] == 2
+
+    rows = {row["stage"]: row for row in hsf.tracing.summarize(spans)}
+    assert rows["inference"]["count"] == 2
+    if hsf.tracing.current_rss() is not None:
+        assert all(s["peak_rss_mb"] >= s["rss_mb"] > 0 for s in spans)
+        assert all(s["peak_rss_delta_mb"] > 64 for s in spans)
+        assert rows["subject"]["peak_rss_mb"] > spans[-1]["rss_mb"] + 64
+    assert rows["subject"]["total_s"] >= rows["inference"]["total_s"]
+
+    # Disabled tracers record nothing
+    with hsf.tracing.span("inference"):
+        pass
+    assert len(hsf.tracing.read_trace(path)) == 3